@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+"""デプロイパイプラインのベンチマーク
+
+AWS（ECR・ECS・ELBv2・Logs・EC2・IAM・STS）をmotoで、docker・gitを所要時間を設定できる代役
+（benchmarks/fakebin）で置き換え、FastAPIアプリへ/deployを同時に送って次を計測する。
+
+- デプロイ1件ごとの所要時間（受付→完了、待ち時間、サービスが正常になるまで）とステージごとの所要時間
+- デプロイ1件あたりのAWS API呼び出し回数（botocoreのbefore-callイベントで数える）
+- 同時実行数ごとのスループット
+
+結果はJSONで出力し、--baselineに前回の結果を渡すと悪化した項目を表示して終了コード1を返す。
+
+    uv run --with moto python benchmarks/deploy_bench.py --deploys 8 --concurrency 1,4 --output bench.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEPLOY_SERVER_DIR = os.path.dirname(BENCH_DIR)
+FAKEBIN_DIR = os.path.join(BENCH_DIR, "fakebin")
+
+# cold: 新規作成（ビルドあり） / redeploy: 同じ内容の再デプロイ / update: ソースを変更して再デプロイ
+SCENARIOS = ("cold", "redeploy", "update")
+# ヘルスチェックの監視間隔（環境変数で指定されていなければベンチマーク向けに短くする）
+_WAITER_DEFAULTS = {
+    "WAITER_MIN_DELAY_SECONDS": "0.2",
+    "WAITER_MAX_DELAY_SECONDS": "1",
+    "WAITER_HEALTHY_TIMEOUT_SECONDS": "120",
+}
+# 結果を比べて悪化とみなす指標（値が大きいほど悪い）
+_COMPARED_METRICS = (
+    ("deploy_seconds", "p50"),
+    ("deploy_seconds", "p95"),
+    ("ready_seconds", "p50"),
+    ("aws_calls", "per_deploy"),
+)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--deploys", type=int, default=8, help="シナリオごとのデプロイ数（アプリ数）")
+    p.add_argument("--concurrency", default="1,4", help="同時に送るデプロイ数（カンマ区切りで複数）")
+    p.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"実行するシナリオ（{', '.join(SCENARIOS)}）")
+    p.add_argument("--source", choices=("git", "context"), default="git", help="git_repo_urlかdocker_contextか")
+    p.add_argument("--strategy", choices=("rolling", "blue_green"), default="rolling")
+    p.add_argument("--build-backend", choices=("docker", "buildx"), default="docker")
+    p.add_argument("--cpu", default="512")
+    p.add_argument("--memory", default="1024")
+    p.add_argument("--build-seconds", type=float, default=2.0, help="docker build（代役）の所要時間")
+    p.add_argument("--push-seconds", type=float, default=1.0, help="docker push（代役）の所要時間")
+    p.add_argument("--git-seconds", type=float, default=0.3, help="git clone/fetch/ls-remote（代役）の所要時間")
+    p.add_argument("--aws-latency-ms", type=float, default=0.0, help="AWS API呼び出し1回ごとに加える遅延")
+    p.add_argument("--jitter", type=float, default=0.0, help="代役の所要時間のばらつき（0.2なら±20%%）")
+    p.add_argument("--healthy-seconds", type=float, default=1.0,
+                   help="ターゲットグループ作成からターゲットが正常になるまでの秒数（負の値ならヘルスを待たない）")
+    p.add_argument("--health-timeout", type=float, default=60.0, help="ジョブ完了後にヘルスを待つ上限（秒）")
+    p.add_argument("--deploy-workers", type=int, help="DEPLOY_WORKERS（未指定なら環境変数・デフォルト値）")
+    p.add_argument("--build-capacity", type=int, help="BUILD_LOCAL_CAPACITY（未指定なら環境変数・デフォルト値）")
+    p.add_argument("--output", default="deploy_bench.json", help="結果のJSONファイル")
+    p.add_argument("--baseline", help="比較する前回の結果のJSONファイル")
+    p.add_argument("--max-regression", type=float, default=0.2, help="悪化とみなす割合（0.2なら20%%）")
+    p.add_argument("--log-level", default="WARNING", help="デプロイサーバーのログを表示するレベル")
+    p.add_argument("--keep", action="store_true", help="作業ディレクトリ（ログ・レジストリ・ソース）を残す")
+    args = p.parse_args(argv)
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        p.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def summarize(values) -> dict:
+    """件数・平均・p50・p95・最大（値がなければcountのみ）"""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {"count": 0}
+
+    def percentile(p):
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(50), 3),
+        "p95": round(percentile(95), 3),
+        "max": round(values[-1], 3),
+    }
+
+
+class ApiCallCounter:
+    """共有boto3セッションのbefore-callイベントで、操作ごとの呼び出し回数を数える
+
+    latency_secondsを指定すると呼び出しごとにその秒数だけ待ち、ネットワークの往復を模擬する。
+    """
+
+    def __init__(self, latency_seconds: float = 0.0, before_call=None):
+        self.latency_seconds = latency_seconds
+        self.before_call = before_call
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def __call__(self, model=None, **kwargs):
+        service = model.service_model.service_name
+        with self._lock:
+            self.calls[f"{service}.{model.name}"] += 1
+        if self.before_call:
+            self.before_call(service, model.name)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.calls)
+
+
+class RegistryStandIn:
+    """dockerの代役がプッシュしたイメージ（BENCH_SPOOL_DIR/pushed）をmotoのECRへ登録する
+
+    ECRへの問い合わせの直前に呼ばれ、それまでにプッシュされたイメージを反映する。
+    """
+
+    def __init__(self, spool_dir: str, region: str):
+        import boto3
+
+        self.pushed_dir = os.path.join(spool_dir, "pushed")
+        # デプロイサーバーの共有セッションとは別のクライアント（呼び出し回数に含めない）
+        self._ecr = boto3.session.Session().client("ecr", region_name=region)
+        self._lock = threading.Lock()
+        self.images = 0
+
+    def __call__(self, service: str, operation: str):
+        if service == "ecr":
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            if not os.path.isdir(self.pushed_dir):
+                return
+            for name in sorted(os.listdir(self.pushed_dir)):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.pushed_dir, name)
+                with open(path) as f:
+                    pushed = json.load(f)
+                manifest = {
+                    "schemaVersion": 2,
+                    "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                    "config": {"mediaType": "application/vnd.docker.container.image.v1+json", "digest": pushed["digest"], "size": 1574},
+                    "layers": [],
+                }
+                try:
+                    self._ecr.put_image(
+                        repositoryName=pushed["repository"],
+                        imageManifest=json.dumps(manifest),
+                        imageManifestMediaType=manifest["mediaType"],
+                        imageTag=pushed["tag"],
+                        imageDigest=pushed["digest"],
+                    )
+                    self.images += 1
+                except self._ecr.exceptions.ImageAlreadyExistsException:
+                    pass
+                os.remove(path)
+
+
+class TargetRegistrar(threading.Thread):
+    """作成されたターゲットグループへ、一定時間後に正常なターゲットを登録する（ECSタスクの起動の代役）"""
+
+    def __init__(self, region: str, healthy_seconds: float, prefix: str = "bench-"):
+        super().__init__(daemon=True)
+        import boto3
+
+        self._elbv2 = boto3.session.Session().client("elbv2", region_name=region)
+        self.healthy_seconds = healthy_seconds
+        self.prefix = prefix
+        self._first_seen = {}
+        self._registered = set()
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(0.1):
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"target registrar: {e}", file=sys.stderr)
+
+    def _tick(self):
+        now = time.time()
+        for tg in self._elbv2.describe_target_groups()["TargetGroups"]:
+            arn = tg["TargetGroupArn"]
+            if not tg["TargetGroupName"].startswith(self.prefix) or arn in self._registered:
+                continue
+            first_seen = self._first_seen.setdefault(arn, now)
+            if now - first_seen >= self.healthy_seconds:
+                self._elbv2.register_targets(TargetGroupArn=arn, Targets=[{"Id": "10.0.1.10", "Port": 7860}])
+                self._registered.add(arn)
+
+    def stop(self):
+        self._stop.set()
+
+
+def prepare_environment(args, work_dir: str) -> dict:
+    """デプロイサーバーのモジュールを読み込む前に設定する環境変数（.envより優先する）"""
+    spool_dir = os.path.join(work_dir, "spool")
+    os.makedirs(spool_dir, exist_ok=True)
+    # 設定はすべて環境変数で渡すため、Terraformの出力は空にしておく
+    tfstate_path = os.path.join(work_dir, "terraform.tfstate")
+    with open(tfstate_path, "w") as f:
+        json.dump({"outputs": {}}, f)
+    real_git = shutil.which("git")
+    if real_git is None:
+        raise SystemExit("git is required for the benchmark")
+    forced = {
+        "PATH": f"{FAKEBIN_DIR}{os.pathsep}{os.environ.get('PATH', '')}",
+        "BENCH_SPOOL_DIR": spool_dir,
+        "BENCH_REAL_GIT": real_git,
+        "BENCH_BUILD_SECONDS": str(args.build_seconds),
+        "BENCH_PUSH_SECONDS": str(args.push_seconds),
+        "BENCH_GIT_SECONDS": str(args.git_seconds),
+        "BENCH_JITTER": str(args.jitter),
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "CLONE_BASE_DIR": os.path.join(work_dir, "clone"),
+        "GIT_MIRROR_DIR": os.path.join(work_dir, "clone", "mirrors"),
+        "DEPLOY_LOG_DIR": os.path.join(work_dir, "deploy_logs"),
+        "DEPLOY_REGISTRY_PATH": os.path.join(work_dir, "deploy_registry.sqlite3"),
+        "DEPLOY_REGISTRY_RECONCILE_SECONDS": "0",
+        "TERRAFORM_STATE_PATH": tfstate_path,
+        "BUILD_WORKERS": "",
+        "MOTO_ECS_SERVICE_RUNNING": "1",
+    }
+    for key, default in _WAITER_DEFAULTS.items():
+        forced[key] = os.environ.get(key, default)
+    if args.deploy_workers is not None:
+        forced["DEPLOY_WORKERS"] = str(args.deploy_workers)
+    if args.build_capacity is not None:
+        forced["BUILD_LOCAL_CAPACITY"] = str(args.build_capacity)
+    return forced
+
+
+def apply_environment(forced: dict):
+    os.environ.update(forced)
+    for key in ("AWS_PROFILE", "AWS_SESSION_TOKEN", "AWS_ENDPOINT_URL"):
+        os.environ.pop(key, None)
+
+
+def create_stand_in_infra(region: str, cluster_name: str) -> dict:
+    """Terraformで作るネットワーク・ALB・ロール・クラスターをmotoに作成し、設定の環境変数を返す"""
+    import boto3
+
+    session = boto3.session.Session(region_name=region)
+    ec2, elbv2, iam = session.client("ec2"), session.client("elbv2"), session.client("iam")
+    vpc_id = ec2.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    subnets = [
+        ec2.create_subnet(VpcId=vpc_id, CidrBlock=f"10.0.{i}.0/24", AvailabilityZone=f"{region}{zone}")["Subnet"]["SubnetId"]
+        for i, zone in enumerate("ac", start=1)
+    ]
+    ecs_sg = ec2.create_security_group(GroupName="bench-ecs", Description="bench", VpcId=vpc_id)["GroupId"]
+    alb_sg = ec2.create_security_group(GroupName="bench-alb", Description="bench", VpcId=vpc_id)["GroupId"]
+    alb = elbv2.create_load_balancer(Name="bench-alb", Subnets=subnets, SecurityGroups=[alb_sg])["LoadBalancers"][0]
+    default_tg = elbv2.create_target_group(
+        Name="default-tg", Protocol="HTTP", Port=80, VpcId=vpc_id, TargetType="ip"
+    )["TargetGroups"][0]["TargetGroupArn"]
+    listener_arn = elbv2.create_listener(
+        LoadBalancerArn=alb["LoadBalancerArn"], Protocol="HTTP", Port=80,
+        DefaultActions=[{"Type": "forward", "TargetGroupArn": default_tg}],
+    )["Listeners"][0]["ListenerArn"]
+    roles = [
+        iam.create_role(RoleName=name, AssumeRolePolicyDocument="{}")["Role"]["Arn"]
+        for name in ("bench-task-execution", "bench-task")
+    ]
+    session.client("ecs").create_cluster(clusterName=cluster_name)
+    return {
+        "ALB_ARN": alb["LoadBalancerArn"],
+        "ALB_DNS_NAME": alb["DNSName"],
+        "ALB_LISTENER_ARN": listener_arn,
+        "VPC_ID": vpc_id,
+        "ECS_CLUSTER_NAME": cluster_name,
+        "ECS_TASK_EXECUTION_ROLE_ARN": roles[0],
+        "ECS_TASK_ROLE_ARN": roles[1],
+        "ECS_SECURITY_GROUP_ID": ecs_sg,
+        "ALB_SECURITY_GROUP_ID": alb_sg,
+        "SUBNETS": ",".join(subnets),
+        "SECURITY_GROUPS": ecs_sg,
+    }
+
+
+class AppSource:
+    """ベンチマーク用のGradioアプリのソース（gitリポジトリまたはビルドコンテキスト）"""
+
+    def __init__(self, base_dir: str, app_name: str, use_git: bool):
+        self.app_name = app_name
+        self.path = os.path.join(base_dir, app_name)
+        self.use_git = use_git
+        self.revision = 0
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "Dockerfile"), "w") as f:
+            f.write("FROM python:3.11-slim\nRUN pip install gradio\nCOPY . /app\nCMD [\"python\", \"/app/app.py\"]\n")
+        if use_git:
+            self._git("init", "--quiet")
+        self.bump()
+
+    def _git(self, *args):
+        subprocess.check_call(
+            ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com", *args],
+            cwd=self.path, stdout=subprocess.DEVNULL,
+        )
+
+    def bump(self):
+        """ソースを変更する（内容キーが変わり、次のデプロイでビルドが必要になる）"""
+        self.revision += 1
+        with open(os.path.join(self.path, "app.py"), "w") as f:
+            f.write(f"import gradio as gr\n\ngr.Interface(lambda x: x, 'text', 'text', title='{self.app_name} r{self.revision}').launch()\n")
+        if self.use_git:
+            self._git("add", "-A")
+            self._git("commit", "--quiet", "-m", f"revision {self.revision}")
+
+    def request_fields(self) -> dict:
+        if self.use_git:
+            return {"git_repo_url": self.path}
+        return {"docker_context": self.path}
+
+
+class BenchmarkClient:
+    """TestClient経由でデプロイを送り、完了（とヘルス）までを待って計測値を返す"""
+
+    def __init__(self, client, wait_health: bool, health_timeout: float):
+        self.client = client
+        self.wait_health = wait_health
+        self.health_timeout = health_timeout
+
+    def deploy(self, body: dict) -> dict:
+        response = self.client.post("/deploy", json=body)
+        if response.status_code != 202:
+            return {"app_name": body["app_name"], "status": "rejected", "error": response.text[:500]}
+        job_id = response.json()["job_id"]
+        since = 0
+        while True:
+            events = self.client.get(f"/deploy/{job_id}/events", params={"since": since, "wait": 30}).json()
+            since = events["next_since"]
+            if events["status"] not in ("queued", "running"):
+                break
+        job = self.client.get(f"/deploy/{job_id}").json()
+        result = job.get("result") or {}
+        health = result.get("health") or {}
+        ready_at = None
+        if job["status"] == "succeeded" and self.wait_health:
+            deadline = time.time() + self.health_timeout
+            while health.get("status") == "pending" and time.time() < deadline:
+                time.sleep(0.1)
+                job = self.client.get(f"/deploy/{job_id}").json()
+                health = (job.get("result") or {}).get("health") or {}
+            if health.get("status") == "healthy":
+                ready_at = time.time()
+        return {
+            "app_name": job["app_name"],
+            "job_id": job_id,
+            "status": job["status"],
+            "error": job.get("error"),
+            "deployment_type": result.get("deployment_type"),
+            "cache_hit": (result.get("image") or {}).get("cache_hit"),
+            "health_status": health.get("status"),
+            "queue_seconds": (job["started_at"] or job["finished_at"]) - job["created_at"],
+            "deploy_seconds": job["finished_at"] - job["created_at"],
+            "ready_seconds": ready_at - job["created_at"] if ready_at else None,
+            "timings": job.get("timings") or {},
+        }
+
+
+def run_scenario(bench_client, counter, scenario: str, concurrency: int, sources: list, args) -> dict:
+    bodies = [
+        {
+            "app_name": source.app_name,
+            "alb_path": f"/{source.app_name}/*",
+            "cpu": args.cpu,
+            "memory": args.memory,
+            "build_backend": args.build_backend,
+            "deploy_strategy": args.strategy,
+            **source.request_fields(),
+        }
+        for source in sources
+    ]
+    counter.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        records = list(pool.map(bench_client.deploy, bodies))
+    wall_seconds = time.perf_counter() - started
+    calls = counter.snapshot()
+
+    succeeded = [r for r in records if r["status"] == "succeeded"]
+    stages = {}
+    for record in succeeded:
+        for stage, duration in record["timings"].items():
+            stages.setdefault(stage, []).append(duration)
+    total_calls = sum(calls.values())
+    by_service = Counter()
+    for operation, count in calls.items():
+        by_service[operation.split(".", 1)[0]] += count
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "deploys": len(records),
+        "succeeded": len(succeeded),
+        "failed": len(records) - len(succeeded),
+        "errors": [{"app_name": r["app_name"], "status": r["status"], "error": str(r["error"])[:500]} for r in records if r["status"] != "succeeded"],
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_minute": round(len(succeeded) / wall_seconds * 60, 2) if wall_seconds else None,
+        "deploy_seconds": summarize(r["deploy_seconds"] for r in succeeded),
+        "queue_seconds": summarize(r["queue_seconds"] for r in succeeded),
+        "ready_seconds": summarize(r["ready_seconds"] for r in succeeded),
+        "stages": {stage: summarize(durations) for stage, durations in sorted(stages.items())},
+        "deployment_types": dict(Counter(r["deployment_type"] for r in succeeded)),
+        "health": dict(Counter(r["health_status"] for r in succeeded)),
+        "image_cache_hits": sum(1 for r in succeeded if r["cache_hit"]),
+        "aws_calls": {
+            "total": total_calls,
+            "per_deploy": round(total_calls / len(records), 1) if records else None,
+            "by_service": dict(by_service.most_common()),
+            "by_operation": dict(calls.most_common()),
+        },
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """同じシナリオ・同時実行数の結果を比べ、max_regressionを超えて悪化した指標を返す"""
+    previous = {(run["scenario"], run["concurrency"]): run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in report["runs"]:
+        old = previous.get((run["scenario"], run["concurrency"]))
+        if old is None:
+            continue
+        for metric, field in _COMPARED_METRICS:
+            before, after = old.get(metric, {}).get(field), run.get(metric, {}).get(field)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if change > max_regression:
+                regressions.append({
+                    "scenario": run["scenario"],
+                    "concurrency": run["concurrency"],
+                    "metric": f"{metric}.{field}",
+                    "baseline": before,
+                    "current": after,
+                    "change": round(change, 3),
+                })
+    return regressions
+
+
+def print_summary(report: dict):
+    print(f"{'scenario':<10} {'conc':>4} {'ok':>4} {'fail':>4} {'wall_s':>8} {'per_min':>8} "
+          f"{'p50_s':>7} {'p95_s':>7} {'ready_p50':>9} {'aws/deploy':>10}")
+    for run in report["runs"]:
+        print(
+            f"{run['scenario']:<10} {run['concurrency']:>4} {run['succeeded']:>4} {run['failed']:>4} "
+            f"{run['wall_seconds']:>8} {run['throughput_per_minute'] or '-':>8} "
+            f"{run['deploy_seconds'].get('p50', '-'):>7} {run['deploy_seconds'].get('p95', '-'):>7} "
+            f"{run['ready_seconds'].get('p50', '-'):>9} {run['aws_calls']['per_deploy']:>10}"
+        )
+        for error in run["errors"][:3]:
+            print(f"  {error['app_name']}: {error['status']}: {error['error'].splitlines()[0] if error['error'] else ''}")
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(prefix="deploy-bench-")
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    forced = prepare_environment(args, work_dir)
+    apply_environment(forced)
+    sys.path.insert(0, DEPLOY_SERVER_DIR)
+    # ログファイル（deploy_server.log）などの相対パスは作業ディレクトリに作らせる
+    os.chdir(work_dir)
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise SystemExit("moto is required: uv run --with moto python benchmarks/deploy_bench.py")
+
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+
+    # utils.commonが.envを読み込むため、その後にベンチマークの設定を上書きし直す
+    import utils.common
+    apply_environment(forced)
+    region = utils.common.AWS_REGION
+    os.environ["AWS_REGION"] = os.environ["AWS_DEFAULT_REGION"] = region
+
+    mock = mock_aws()
+    mock.start()
+    registrar = None
+    try:
+        os.environ.update(create_stand_in_infra(region, utils.common.CLUSTER_NAME))
+
+        from utils.clients import get_session
+
+        registry = RegistryStandIn(forced["BENCH_SPOOL_DIR"], region)
+        counter = ApiCallCounter(args.aws_latency_ms / 1000, before_call=registry)
+        get_session().events.register("before-call", counter)
+
+        from fastapi.testclient import TestClient
+
+        import main as server
+        from utils.build_workers import build_pool
+        from utils.jobs import DEPLOY_WORKERS
+
+        # main.pyが追加するログファイルは作らない（--keepなら作業ディレクトリに残す）
+        logger.remove()
+        logger.add(sys.stderr, level=args.log_level.upper())
+        if args.keep:
+            logger.add(os.path.join(work_dir, "deploy_server.log"), level="DEBUG")
+
+        wait_health = args.healthy_seconds >= 0
+        if wait_health:
+            registrar = TargetRegistrar(region, args.healthy_seconds)
+            registrar.start()
+
+        report = {
+            "benchmark": "deploy_pipeline",
+            "started_at": time.time(),
+            "environment": {"python": platform.python_version(), "platform": platform.platform()},
+            "settings": {
+                "deploys": args.deploys,
+                "concurrency": args.concurrency,
+                "scenarios": args.scenarios,
+                "source": args.source,
+                "strategy": args.strategy,
+                "build_backend": args.build_backend,
+                "cpu": args.cpu,
+                "memory": args.memory,
+                "build_seconds": args.build_seconds,
+                "push_seconds": args.push_seconds,
+                "git_seconds": args.git_seconds,
+                "aws_latency_ms": args.aws_latency_ms,
+                "jitter": args.jitter,
+                "healthy_seconds": args.healthy_seconds,
+                "deploy_workers": DEPLOY_WORKERS,
+                "build_local_capacity": build_pool.local.capacity if build_pool.local else 0,
+            },
+            "runs": [],
+        }
+
+        with TestClient(server.app) as client:
+            bench_client = BenchmarkClient(client, wait_health, args.health_timeout)
+            for concurrency in args.concurrency:
+                sources = [
+                    AppSource(os.path.join(work_dir, "sources"), f"bench-c{concurrency}-{i:03d}", args.source == "git")
+                    for i in range(args.deploys)
+                ]
+                for scenario in SCENARIOS:
+                    if scenario == "update":
+                        for source in sources:
+                            source.bump()
+                    if scenario not in args.scenarios:
+                        if scenario == "cold" and set(args.scenarios) - {"cold"}:
+                            # 再デプロイの計測にはアプリが存在している必要がある
+                            run_scenario(bench_client, counter, scenario, concurrency, sources, args)
+                        continue
+                    print(f"Running {scenario} x{args.deploys} at concurrency {concurrency}...", file=sys.stderr)
+                    run = run_scenario(bench_client, counter, scenario, concurrency, sources, args)
+                    config = client.get("/config").json()
+                    run["server"] = {
+                        key: config.get(key)
+                        for key in ("service_waiter", "listener_rules", "task_definitions", "build_pool")
+                    }
+                    report["runs"].append(run)
+        report["finished_at"] = time.time()
+    finally:
+        if registrar is not None:
+            registrar.stop()
+        mock.stop()
+        os.chdir(BENCH_DIR)
+        if args.keep:
+            print(f"Work directory kept: {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if baseline is not None:
+        report["regressions"] = compare(report, baseline, args.max_regression)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print_summary(report)
+    print(f"Report written to {output}")
+    failed = sum(run["failed"] for run in report["runs"])
+    for regression in report.get("regressions", []):
+        print(
+            f"REGRESSION {regression['scenario']} x{regression['concurrency']} {regression['metric']}: "
+            f"{regression['baseline']} -> {regression['current']} (+{regression['change']:.0%})"
+        )
+    return 1 if failed or report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""ビルドワーカーエージェント
+
+デプロイサーバーから送られたビルドコンテキスト（tar.gz）を受け取り、このホストのDockerで
+ビルドしてECRへプッシュする。ログ・ステージ・結果（イメージダイジェスト）はNDJSONで逐次返す。
+
+    BUILD_WORKER_CAPACITY=4 BUILD_WORKER_TOKEN=secret BUILD_WORKER_HOST=0.0.0.0 uv run python build_worker.py
+
+トークン（BUILD_WORKER_TOKEN）なしではループバック以外で待ち受けない。
+"""
+import hmac
+import json
+import os
+import queue
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from loguru import logger
+
+from utils.build_workers import BUILD_WORKER_TOKEN, decode_spec
+from utils.builders import get_builder
+from utils.ecr_login import docker_login, ensure_docker_login, invalidate_registry_login
+
+# 同時に実行するビルド数
+BUILD_WORKER_CAPACITY = int(os.getenv("BUILD_WORKER_CAPACITY", "2"))
+BUILD_WORKER_PORT = int(os.getenv("BUILD_WORKER_PORT", "8010"))
+# 待ち受けるアドレス。他のホストから受け付ける場合は0.0.0.0などを指定する（BUILD_WORKER_TOKENが必須）
+BUILD_WORKER_HOST = os.getenv("BUILD_WORKER_HOST", "127.0.0.1")
+# 受け取ったビルドコンテキストを展開するディレクトリ
+BUILD_WORKER_WORK_DIR = os.getenv("BUILD_WORKER_WORK_DIR", os.path.join(tempfile.gettempdir(), "build-worker"))
+BUILD_WORKER_NAME = os.getenv("BUILD_WORKER_NAME", os.uname().nodename)
+
+logger.add("build_worker.log", rotation="1 MB")
+app = FastAPI()
+
+_lock = threading.Lock()
+_running = {}
+_completed = 0
+_failed = 0
+# レジストリごとに最後にdocker loginしたパスワード（トークンが変わったときだけ再ログイン）
+_logged_in = {}
+
+
+class _StreamLog:
+    """ビルダーのjob.logの代わり。行をNDJSONストリームへ流しつつ末尾を保持する"""
+
+    def __init__(self, events: queue.Queue, keep: int = 200):
+        self._events = events
+        self._lines = []
+        self._keep = keep
+        self.line_count = 0
+
+    def write(self, line: str):
+        self._lines.append(line)
+        del self._lines[:-self._keep]
+        self.line_count += 1
+        self._events.put({"type": "log", "line": line})
+
+    def tail(self, n: int):
+        return self._lines[-n:]
+
+
+class _WorkerJob:
+    """ビルダーが参照するDeployJobの一部（job_id・app_name・log・stage）"""
+
+    def __init__(self, spec: dict, events: queue.Queue):
+        self.job_id = spec["job_id"]
+        self.app_name = spec["app_name"]
+        self.log = _StreamLog(events)
+        self._events = events
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        self._events.put({"type": "stage", "stage": name, "status": "started", "worker": BUILD_WORKER_NAME})
+        try:
+            yield
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            self._events.put({
+                "type": "stage", "stage": name, "status": "failed", "message": str(detail)[:500],
+                "duration_seconds": round(time.perf_counter() - started, 3),
+            })
+            raise
+        self._events.put({
+            "type": "stage", "stage": name, "status": "completed",
+            "duration_seconds": round(time.perf_counter() - started, 3),
+        })
+
+
+def _extract(tar: tarfile.TarFile, dest: str):
+    """展開先の外を指すパスやリンクを含むアーカイブは拒否して展開する"""
+    root = os.path.realpath(dest)
+
+    def inside(path):
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+    for member in tar.getmembers():
+        target = os.path.join(root, member.name)
+        if not inside(target):
+            raise ValueError(f"Unsafe path in build context: {member.name}")
+        if member.issym() and not inside(os.path.join(os.path.dirname(target), member.linkname)):
+            raise ValueError(f"Unsafe symlink in build context: {member.name}")
+        if member.islnk() and not inside(os.path.join(root, member.linkname)):
+            raise ValueError(f"Unsafe hard link in build context: {member.name}")
+    tar.extractall(dest)
+
+
+def _check_token(request: Request):
+    if BUILD_WORKER_TOKEN and not hmac.compare_digest(
+        request.headers.get("authorization", "").encode(), f"Bearer {BUILD_WORKER_TOKEN}".encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid build worker token")
+
+
+def _login(registry):
+    """デプロイサーバーから渡された認証情報（TLS経由のときだけ渡される）か、このホストのAWS権限でECRにログインする"""
+    if registry is None:
+        ensure_docker_login()
+        return
+    with _lock:
+        if _logged_in.get(registry["server"]) == registry["password"]:
+            return
+    docker_login(registry["server"], registry["username"], registry["password"])
+    with _lock:
+        _logged_in[registry["server"]] = registry["password"]
+
+
+def _run_build(spec: dict, work_dir: str, events: queue.Queue):
+    """ビルドを実行する。クライアントが切断してもビルドは続くため、枠と作業ディレクトリはここで終了時に解放する"""
+    global _completed, _failed
+    job = _WorkerJob(spec, events)
+    registry = spec.get("registry")
+    try:
+        with job.stage("ecr_login"):
+            _login(registry)
+        builder = get_builder(spec["backend"])
+        build = builder.build_and_push(
+            job, work_dir, spec["dockerfile"], spec["platform"], spec["image_repo"], spec["tags"], spec.get("cache_repo")
+        )
+        events.put({"type": "result", "result": build})
+        with _lock:
+            _completed += 1
+        logger.info(f"Build {job.job_id} ({job.app_name}) pushed {build.get('digest')}")
+    except Exception as e:
+        # プッシュ失敗はトークン切れの可能性があるため、次回は必ずログインし直す
+        with _lock:
+            if registry is not None:
+                _logged_in.pop(registry["server"], None)
+            _failed += 1
+        if registry is None:
+            invalidate_registry_login()
+        status_code = e.status_code if isinstance(e, HTTPException) else 500
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Build {job.job_id} ({job.app_name}) failed: {detail}")
+        events.put({"type": "error", "status_code": status_code, "detail": str(detail)})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        with _lock:
+            _running.pop(spec["job_id"], None)
+        events.put(None)
+
+
+@app.get("/status")
+def get_status(request: Request):
+    """容量と実行中のビルド"""
+    _check_token(request)
+    with _lock:
+        return {
+            "name": BUILD_WORKER_NAME,
+            "capacity": BUILD_WORKER_CAPACITY,
+            "running": len(_running),
+            "builds": list(_running.values()),
+            "completed": _completed,
+            "failed": _failed,
+        }
+
+
+@app.post("/builds")
+async def create_build(request: Request):
+    """ビルドコンテキスト（tar.gz）を受け取ってビルド・プッシュし、進捗をNDJSONで返す
+
+    仕様はX-Build-Specヘッダ（base64エンコードしたJSON）で受け取る。満杯なら429を返す。
+    """
+    _check_token(request)
+    try:
+        spec = decode_spec(request.headers["x-build-spec"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Missing or invalid X-Build-Spec header")
+
+    with _lock:
+        if len(_running) >= BUILD_WORKER_CAPACITY:
+            raise HTTPException(status_code=429, detail="Build worker is at capacity")
+        _running[spec["job_id"]] = {"job_id": spec["job_id"], "app_name": spec["app_name"], "started_at": time.time()}
+
+    os.makedirs(BUILD_WORKER_WORK_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f"{spec['app_name']}-", dir=BUILD_WORKER_WORK_DIR)
+    try:
+        with tempfile.TemporaryFile() as archive:
+            async for chunk in request.stream():
+                archive.write(chunk)
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode="r:gz") as tar:
+                _extract(tar, work_dir)
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        with _lock:
+            _running.pop(spec["job_id"], None)
+        raise HTTPException(status_code=400, detail=f"Invalid build context: {e}")
+
+    events = queue.Queue()
+    threading.Thread(target=_run_build, args=(spec, work_dir, events), daemon=True).start()
+
+    def stream():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+if __name__ == "__main__":
+    import uvicorn
+    if not BUILD_WORKER_TOKEN and BUILD_WORKER_HOST not in ("127.0.0.1", "::1", "localhost"):
+        raise SystemExit(f"BUILD_WORKER_TOKEN is required to listen on {BUILD_WORKER_HOST}")
+    uvicorn.run(app, host=BUILD_WORKER_HOST, port=BUILD_WORKER_PORT)
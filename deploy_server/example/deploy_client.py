@@ -10,6 +10,21 @@ import argparse, json, requests, sys
 
 API_URL = "http://localhost:8002/deploy"
 
+
+def wait_for_job(job_id):
+    """ジョブ完了までステージ進捗を表示しながら待機"""
+    since = 0
+    while True:
+        resp = requests.get(f"{API_URL}/{job_id}/events", params={"since": since, "wait": 30})
+        resp.raise_for_status()
+        data = resp.json()
+        for ev in data["events"]:
+            print(f"[{ev['stage']}] {ev['status']} {ev.get('message', '')}".rstrip())
+        since = data["next_since"]
+        if data["status"] not in ("queued", "running"):
+            break
+    return requests.get(f"{API_URL}/{job_id}").json()
+
 def main():
     p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.add_argument("--app",    required=True,  help="アプリ名 (ECS Service 名と同じ)")
@@ -38,13 +53,21 @@ def main():
     print("-"*60)
 
     try:
-        data = resp.json()
+        queued = resp.json()
     except json.JSONDecodeError:
         sys.exit(resp.text)
 
-    print(json.dumps(data, indent=2))
+    if not resp.ok or "job_id" not in queued:
+        print(json.dumps(queued, indent=2))
+        sys.exit("\n❌ FAILED")
+
+    print(f"Job ID: {queued['job_id']}")
+    job = wait_for_job(queued["job_id"])
+    print("-"*60)
+    print(json.dumps(job.get("result") or {"error": job.get("error")}, indent=2))
 
-    if resp.ok and data.get("status") == "success":
+    data = job.get("result") or {}
+    if job["status"] == "succeeded" and data.get("status") == "success":
         print("\n✅ SUCCESS")
         print(f"URL: {data.get('deployed_url')}")
     else:
@@ -1,7 +1,7 @@
 import requests
 import json
 
-API_URL = "http://localhost:8001/deploy"
+API_URL = "http://localhost:8001/deploy?wait=true"
 
 payload = {
     "app_name": "myapp",
@@ -37,11 +37,9 @@ try:
         print(f"📍 Path Pattern: {response_data.get('alb_path')}")
         print(f"🔒 Protocol: {response_data.get('protocol')}")
         print(f"💾 CPU: {response_data.get('cpu')}, Memory: {response_data.get('memory')}")
-        print(f"⏱️  Estimated ready time: {response_data.get('estimated_ready_time')}")
+        print(f"⏱️  Time to healthy: {response_data.get('health', {}).get('time_to_healthy_seconds')}s")
         print("=" * 70)
         print("\n⚠️  IMPORTANT NOTES:")
-        print("• Allow 5-10 minutes for the service to become healthy")
-        print("• The app needs time to download dependencies and start")
         print("• Monitor CloudWatch logs for startup progress")
         print("• First request may take longer due to model loading")
         print("\n✨ Your application deployment is in progress!")
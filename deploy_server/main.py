@@ -1,369 +1,251 @@
-import os
-import subprocess
-import boto3
-from fastapi import FastAPI, HTTPException
+import time
+
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from loguru import logger
 
-from models.deploy import DeployRequest
+from models.deploy import DeployRequest, BatchDeployRequest, PromoteRequest
 from utils.common import (
     load_terraform_outputs,
-    get_config_value,
-    ensure_security_group_rules,
+    get_resolved_config,
+    get_terraform_cache_stats,
     AWS_REGION,
     CLUSTER_NAME,
     TERRAFORM_STATE_PATH,
 )
+from utils.alb_rules import listener_rules
+from utils.app_logs import app_logs
+from utils.build_workers import build_pool
+from utils.capacity import spot_monitor
+from utils.garbage_collector import garbage_collector
+from utils.jobs import DeployJobQueue
+from utils.metrics import render_metrics
+from utils.registry import deploy_registry
+from utils.pipeline import run_deployment, run_batch, run_promote, check_deploy_request, plan_deploy, plan_task_definition
+from utils.task_definitions import task_definitions
+from utils.validation import check_batch_paths, environment_validator
+from utils.waiters import service_waiter
 
 logger.add("deploy_server.log", rotation="1 MB")
 app = FastAPI()
+job_queue = DeployJobQueue(run_deployment, run_batch, on_finish=deploy_registry.record_job)
+deploy_registry.start_reconciler()
+garbage_collector.start(busy_apps=job_queue.busy_apps)
+spot_monitor.start(busy_apps=job_queue.busy_apps, store=deploy_registry)
 
 @app.get("/config")
 def get_current_config():
     """現在の設定情報を確認するためのエンドポイント"""
     try:
         tf_outputs = load_terraform_outputs()
+        resolved = get_resolved_config()
         config = {
             "aws_region": AWS_REGION,
             "cluster_name": CLUSTER_NAME,
             "terraform_state_path": TERRAFORM_STATE_PATH,
             "terraform_outputs_available": list(tf_outputs.keys()),
             "resolved_config": {
-                "alb_arn": get_config_value("ALB_ARN", "alb_arn", "not_configured"),
-                "alb_dns_name": get_config_value("ALB_DNS_NAME", "alb_dns_name", "not_configured"),
-                "alb_listener_arn": get_config_value("ALB_LISTENER_ARN", "alb_listener_arn", "not_configured"),
-                "vpc_id": get_config_value("VPC_ID", "vpc_id", "not_configured"),
-                "ecs_cluster_name": get_config_value("ECS_CLUSTER_NAME", "ecs_cluster_name", CLUSTER_NAME),
-                "ecs_task_execution_role_arn": get_config_value("ECS_TASK_EXECUTION_ROLE_ARN", "ecs_task_execution_role_arn", "not_configured"),
-                "ecs_task_role_arn": get_config_value("ECS_TASK_ROLE_ARN", "ecs_task_role_arn", "not_configured"),
-            }
+                "alb_arn": resolved.alb_arn or "not_configured",
+                "alb_dns_name": resolved.alb_dns_name or "not_configured",
+                "alb_listener_arn": resolved.alb_listener_arn or "not_configured",
+                "vpc_id": resolved.vpc_id or "not_configured",
+                "ecs_cluster_name": resolved.ecs_cluster_name,
+                "ecs_task_execution_role_arn": resolved.ecs_task_execution_role_arn or "not_configured",
+                "ecs_task_role_arn": resolved.ecs_task_role_arn or "not_configured",
+                "subnets": list(resolved.subnets),
+                "security_groups": list(resolved.security_groups),
+            },
+            "terraform_cache": get_terraform_cache_stats(),
+            "listener_rules": listener_rules.stats(),
+            "service_waiter": service_waiter.stats(),
+            "build_pool": build_pool.stats(),
+            "validation": environment_validator.stats(),
+            "task_definitions": task_definitions.stats(),
+            "registry": deploy_registry.stats(),
+            "gc": garbage_collector.stats(),
+            "app_logs": app_logs.stats(),
+            "capacity": spot_monitor.stats(),
         }
         return config
     except Exception as e:
         return {"error": str(e)}
 
-@app.post("/deploy")
-def deploy_app(req: DeployRequest):
-    import tempfile
-    import shutil
-
-    app_name = req.app_name
-    docker_context = req.docker_context
-    dockerfile = req.dockerfile
-
-    temp_dir = None
-    deployed_url = None
-    
-    # セキュリティグループルールの確認・追加
-    ensure_security_group_rules()
-    
-    # git_repo_urlが指定されていればクローン
-    if req.git_repo_url:
-        import datetime
-        tmp_base = os.getenv("CLONE_BASE_DIR", "/home/cc-company/gradio-fargate-factory/tmp")
-        tmp_base = os.path.abspath(tmp_base)
-        os.makedirs(tmp_base, exist_ok=True)
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        temp_dir = os.path.join(tmp_base, f"{app_name}_{timestamp}")
-        try:
-            subprocess.check_call([
-                "git", "clone", req.git_repo_url, temp_dir
-            ])
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Git clone failed: {e}")
-        docker_context = temp_dir
-
-    try:
-        # AWS情報取得
-        sts = boto3.client("sts", region_name=AWS_REGION)
-        account_id = sts.get_caller_identity()["Account"]
-        ecr = boto3.client("ecr", region_name=AWS_REGION)
-        ecs = boto3.client("ecs", region_name=AWS_REGION)
-        elbv2 = boto3.client("elbv2", region_name=AWS_REGION)
-        logs = boto3.client("logs", region_name=AWS_REGION)
-
-        # ECRリポジトリURL取得（なければ作成）
-        try:
-            ecr_url = ecr.describe_repositories(repositoryNames=[app_name])["repositories"][0]["repositoryUri"]
-        except ecr.exceptions.RepositoryNotFoundException:
-            repo = ecr.create_repository(repositoryName=app_name)
-            ecr_url = repo["repository"]["repositoryUri"]
-
-        # Dockerログイン
-        login_pw = subprocess.check_output([
-            "aws", "ecr", "get-login-password", "--region", AWS_REGION
-        ]).decode().strip()
-        login_cmd = [
-            "docker", "login",
-            "--username", "AWS",
-            "--password-stdin",
-            f"{account_id}.dkr.ecr.{AWS_REGION}.amazonaws.com"
-        ]
-        proc = subprocess.Popen(login_cmd, stdin=subprocess.PIPE)
-        proc.communicate(input=login_pw.encode())
-        if proc.returncode != 0:
-            raise Exception("Docker login failed")
-
-        # Dockerビルド＆プッシュ
-        import traceback
-        try:
-            result = subprocess.run(
-                [
-                    "docker", "build", "--platform", "linux/amd64", "-t", f"{app_name}:latest", "-f", dockerfile, "."
-                ],
-                capture_output=True,
-                text=True,
-                cwd=docker_context
-            )
-            if result.returncode != 0:
-                err_msg = (
-                    f"docker build failed (exit code {result.returncode})\n"
-                    f"stdout:\n{result.stdout}\n"
-                    f"stderr:\n{result.stderr}\n"
-                    f"{traceback.format_exc()}"
-                )
-                raise HTTPException(status_code=500, detail=err_msg)
-        except Exception as e:
-            err_msg = f"docker build exception: {e}\n{traceback.format_exc()}"
-            raise HTTPException(status_code=500, detail=err_msg)
-        
-        subprocess.check_call([
-            "docker", "tag", f"{app_name}:latest", f"{ecr_url}:latest"
-        ])
-        subprocess.check_call([
-            "docker", "push", f"{ecr_url}:latest"
-        ])
-
-        # ALB設定 - Terraform outputsと環境変数から取得
-        alb_listener_arn = get_config_value("ALB_LISTENER_ARN", "alb_listener_arn")
-        alb_dns_name = get_config_value("ALB_DNS_NAME", "alb_dns_name")
-        alb_vpc_id = get_config_value("VPC_ID", "vpc_id")
-        
-        alb_path = req.alb_path
-        
-        # プロトコル決定
-        protocol = "http"
-        try:
-            alb_arn = get_config_value("ALB_ARN", "alb_arn")
-            if alb_arn:
-                listeners = elbv2.describe_listeners(LoadBalancerArn=alb_arn)["Listeners"]
-                has_https = any(listener["Port"] == 443 for listener in listeners)
-                if has_https:
-                    protocol = "https"
-        except Exception:
-            protocol = "http"
-        
-        # URL設定
-        base_path = alb_path.rstrip("/*").rstrip("/")
-        deployed_url = f"{protocol}://{alb_dns_name}{base_path}"
-        gradio_root_path = base_path
-        health_check_path = "/"
-        
-        logger.info(f"ALB DNS Name: {alb_dns_name}")
-        logger.info(f"Target URL: {deployed_url}")
-        logger.info(f"Gradio Root Path: {gradio_root_path}")
-        logger.info(f"Health Check Path: {health_check_path}")
-
-        # ターゲットグループの確認・作成・更新（VPC整合性チェック付き）
-        tg_name = f"{app_name}-tg"
-        tg_arn = None
-
-        try:
-            existing_tgs = elbv2.describe_target_groups(Names=[tg_name])["TargetGroups"]
-            existing_tg = existing_tgs[0]
-            existing_vpc_id = existing_tg["VpcId"]
-            
-            # VPC IDの整合性をチェック
-            if existing_vpc_id != alb_vpc_id:
-                logger.warning(f"Target group '{tg_name}' exists in different VPC ({existing_vpc_id}) than ALB ({alb_vpc_id}). Deleting and recreating...")
-                
-                # 既存のターゲットグループを削除
-                elbv2.delete_target_group(TargetGroupArn=existing_tg["TargetGroupArn"])
-                logger.info(f"Deleted target group '{tg_name}' from incorrect VPC")
-                
-                # 新しいターゲットグループを作成（下記の作成処理に進む）
-                raise elbv2.exceptions.TargetGroupNotFoundException()
-            
-            else:
-                # VPCが一致している場合は既存のものを使用
-                tg_arn = existing_tg["TargetGroupArn"]
-                logger.info(f"Using existing target group: {tg_name} (VPC: {existing_vpc_id})")
-                
-                # ヘルスチェック設定を最適化
-                elbv2.modify_target_group(
-                    TargetGroupArn=tg_arn,
-                    HealthCheckPath=health_check_path,
-                    HealthCheckIntervalSeconds=30,
-                    HealthCheckTimeoutSeconds=5,
-                    HealthyThresholdCount=2,
-                    UnhealthyThresholdCount=3,
-                    Matcher={'HttpCode': '200'}
-                )
-                logger.info(f"Updated health check settings for target group '{tg_name}'")
-
-        except elbv2.exceptions.TargetGroupNotFoundException:
-            logger.info(f"Creating new target group: {tg_name} in VPC: {alb_vpc_id}")
-            tg = elbv2.create_target_group(
-                Name=tg_name,
-                Protocol="HTTP",
-                Port=7860,
-                VpcId=alb_vpc_id,
-                TargetType="ip",
-                HealthCheckPath=health_check_path,
-                HealthCheckProtocol="HTTP",
-                HealthCheckIntervalSeconds=30,
-                HealthCheckTimeoutSeconds=5,
-                HealthyThresholdCount=2,
-                UnhealthyThresholdCount=3,
-                Matcher={'HttpCode': '200'}
-            )
-            tg_arn = tg["TargetGroups"][0]["TargetGroupArn"]
-            logger.info(f"Created target group: {tg_name} in VPC: {alb_vpc_id}")
-            
-
-        # ALBルールの確認・作成
-        rules = elbv2.describe_rules(ListenerArn=alb_listener_arn)["Rules"]
-        rule_exists = False
-        for rule in rules:
-            for cond in rule.get("Conditions", []):
-                if cond.get("Field") == "path-pattern" and alb_path in cond.get("Values", []):
-                    rule_exists = True
-                    # ルールの転送先TGが正しいか確認・修正
-                    is_correct_tg = False
-                    for action in rule.get("Actions", []):
-                        if action.get("TargetGroupArn") == tg_arn:
-                            is_correct_tg = True
-                            break
-                    if not is_correct_tg:
-                        logger.warning(f"Rule for path '{alb_path}' exists but points to wrong TG. Modifying...")
-                        elbv2.modify_rule(
-                            RuleArn=rule['RuleArn'],
-                            Actions=[{'Type': 'forward', 'TargetGroupArn': tg_arn}]
-                        )
-                    break
-            if rule_exists:
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus形式のメトリクス（ステージ所要時間・実行中ジョブ数・アプリごとの成功/失敗数）"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/deploy", status_code=202)
+def deploy_app(req: DeployRequest, response: Response, wait: bool = False, timeout: float = None,
+               dry_run: bool = False, idempotency_key: str | None = Header(default=None)):
+    """デプロイをキューに登録し、ジョブIDを即座に返す
+
+    wait=trueの場合はサービスが正常になるまで待ち、デプロイ結果を返す（timeout秒を過ぎたら202を返す）。
+    同じアプリの同一内容のジョブが待機・実行中ならそれに合流し、待機中の古いジョブは新しいジョブで置き換える。
+    Idempotency-Keyヘッダーが登録済みなら、そのジョブを返す。
+    dry_run=trueの場合は検証だけを行い、デプロイで行う変更の一覧を返す（キューには登録しない）。
+    """
+    if dry_run:
+        response.status_code = 200
+        return plan_deploy(req)
+    check_deploy_request(req)
+    job, deduplicated = job_queue.submit_deploy(req, wait_healthy=wait, idempotency_key=idempotency_key)
+    return _job_response(job, response, wait, timeout, deduplicated)
+
+def _job_response(job, response: Response, wait: bool, timeout: float, deduplicated: str = None):
+    """wait=trueなら完了を待って結果を、そうでなければジョブIDを返す"""
+    deadline = None if timeout is None else time.time() + timeout
+    while wait and job.wait_finished(None if deadline is None else max(deadline - time.time(), 0)):
+        if job.status == "superseded":
+            # 新しいリクエストに置き換えられたら、そのジョブの完了を待つ
+            newer = job_queue.get(job.superseded_by)
+            if newer is None:
                 break
-        
-        if not rule_exists:
-            existing_priorities = [int(rule.get("Priority", 0)) for rule in rules if rule.get("Priority") != "default"]
-            next_priority = max(existing_priorities) + 1 if existing_priorities else 100
-            
-            elbv2.create_rule(
-                ListenerArn=alb_listener_arn,
-                Priority=next_priority,
-                Conditions=[{"Field": "path-pattern", "Values": [alb_path]}],
-                Actions=[{"Type": "forward", "TargetGroupArn": tg_arn}]
-            )
-            logger.info(f"Created ALB rule with priority {next_priority}")
-
-        # ECSタスク定義の設定 - Terraform outputsから取得
-        task_definition_family = app_name
-        execution_role_arn = get_config_value("ECS_TASK_EXECUTION_ROLE_ARN", "ecs_task_execution_role_arn")
-        task_role_arn = get_config_value("ECS_TASK_ROLE_ARN", "ecs_task_role_arn")
-
-        # CloudWatch Logsの確認
-        log_group_name = f"/ecs/{app_name}"
-        try:
-            logs.create_log_group(logGroupName=log_group_name)
-            logger.info(f"Created log group: {log_group_name}")
-        except logs.exceptions.ResourceAlreadyExistsException:
-            logger.info(f"Log group already exists: {log_group_name}")
-
-        # 新しいタスク定義を登録
-        from utils.aws import register_task_definition, update_ecs_service, delete_ecs_service, create_ecs_service
-        register_task_definition(
-            ecs, app_name, req, ecr_url, gradio_root_path, log_group_name, execution_role_arn, task_role_arn
-        )
-
-        # サブネット・セキュリティグループ設定 - Terraform outputsと環境変数から取得
-        # SUBNETSが設定されていればそれを使用、なければprivate_subnet_idsから取得
-        subnets_str = get_config_value("SUBNETS", "private_subnet_ids", None)
-        if not subnets_str:
-            # Terraform outputからprivate_subnet_idsを取得
-            tf_outputs = load_terraform_outputs()
-            private_subnets = tf_outputs.get("private_subnet_ids", [])
-            if isinstance(private_subnets, list):
-                subnets_str = ",".join(private_subnets)
-            else:
-                subnets_str = str(private_subnets)
-        
-        if isinstance(subnets_str, list):
-            subnets = [s.strip() for s in subnets_str if s.strip()]
-        else:
-            subnets = [s.strip() for s in str(subnets_str).split(",") if s.strip()]
-        
-        # セキュリティグループも同様に取得
-        security_groups_str = get_config_value("SECURITY_GROUPS", "ecs_security_group_id", None)
-        if not security_groups_str:
-            # ECSタスク用のセキュリティグループIDを取得
-            ecs_sg_id = get_config_value("ECS_SECURITY_GROUP_ID", "ecs_security_group_id", None)
-            if ecs_sg_id:
-                security_groups_str = ecs_sg_id
-        
-        if isinstance(security_groups_str, list):
-            security_groups = [s.strip() for s in security_groups_str if s.strip()]
-        else:
-            security_groups = [s.strip() for s in str(security_groups_str).split(",") if s.strip()]
-
-        # ECSサービスの処理
-        services = ecs.describe_services(cluster=CLUSTER_NAME, services=[app_name])["services"]
-        
-        if services and services[0]["status"] == "ACTIVE" and not req.force_recreate:
-            # 既存サービスを更新
-            logger.info(f"Updating existing ECS service: {app_name}")
-            deployment_type = update_ecs_service(ecs, app_name, task_definition_family)
-                
-        else:
-            # 新しいサービスを作成
-            if services and req.force_recreate:
-                deleted = delete_ecs_service(ecs, app_name)
-                if deleted:
-                    import time
-                    for i in range(30):
-                        time.sleep(10)
-                        try:
-                            remaining = ecs.describe_services(cluster=CLUSTER_NAME, services=[app_name])["services"]
-                            if not remaining or remaining[0]["status"] == "INACTIVE":
-                                logger.info(f"Service deletion completed after {(i+1)*10} seconds")
-                                break
-                        except:
-                            break
-            
-            deployment_type = create_ecs_service(
-                ecs, app_name, task_definition_family, tg_arn, subnets, security_groups
-            )
-
-        # 成功ログとレスポンス
-        logger.info(f"🚀 Deployment completed: {deployed_url}")
-        logger.info(f"💾 Resources: CPU={req.cpu}, Memory={req.memory}")
-        logger.info(f"⏱️  Allow 5-10 minutes for service to become healthy")
-        
-        return {
-            "status": "success",
-            "message": f"{app_name} deployed successfully!",
-            "deployed_url": deployed_url,
-            "alb_dns_name": alb_dns_name,
-            "alb_path": alb_path,
-            "app_name": app_name,
-            "protocol": protocol,
-            "cpu": req.cpu,
-            "memory": req.memory,
-            "deployment_type": deployment_type,
-            "estimated_ready_time": "5-10 minutes"
-        }
-        
-    except Exception as e:
-        logger.error(f"Deployment failed: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # クリーンアップ
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-                logger.info(f"Cleaned up: {temp_dir}")
-            except Exception as cleanup_e:
-                logger.warning(f"Cleanup failed: {cleanup_e}")
+            job = newer
+            continue
+        if job.status == "failed":
+            raise HTTPException(status_code=job.error_status_code or 500, detail=job.error)
+        response.status_code = 200
+        return job.result
+    return {
+        "status": job.status if deduplicated else "queued",
+        "job_id": job.job_id,
+        "app_name": job.app_name,
+        "deduplicated": deduplicated,
+        "status_url": f"/deploy/{job.job_id}",
+        "events_url": f"/deploy/{job.job_id}/events",
+    }
+
+@app.post("/deploy/batch", status_code=202)
+def deploy_batch(req: BatchDeployRequest):
+    """複数アプリのデプロイをまとめてキューに登録する"""
+    for deploy in req.deploys:
+        check_deploy_request(deploy)
+    check_batch_paths(req.deploys)
+    batch = job_queue.submit_batch(req.deploys, req.build_concurrency)
+    return {
+        "status": "queued",
+        "batch_id": batch.batch_id,
+        "status_url": f"/deploy/batch/{batch.batch_id}",
+        "jobs": {job.app_name: job.job_id for job in batch.jobs},
+    }
+
+@app.get("/deploy/batch/{batch_id}")
+def get_deploy_batch(batch_id: str):
+    """バッチの状態とアプリごとの結果を返す"""
+    batch = job_queue.get_batch(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail=f"Deploy batch not found: {batch_id}")
+    return batch.to_dict(include_events=True)
+
+@app.get("/deploy/{job_id}")
+def get_deploy_job(job_id: str):
+    """デプロイジョブの状態と結果を返す"""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Deploy job not found: {job_id}")
+    return job.to_dict(include_events=True)
+
+@app.get("/deploy/{job_id}/events")
+def get_deploy_events(job_id: str, since: int = 0, wait: float = 0):
+    """ステージごとの進捗イベントを返す（wait秒まで新着イベントを待機）"""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Deploy job not found: {job_id}")
+    if wait > 0:
+        events = job.wait_for_events(since, timeout=min(wait, 60))
+    else:
+        events = job.events[since:]
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "current_stage": job.current_stage,
+        "active_stages": job.stages_snapshot(),
+        "events": events,
+        "next_since": since + len(events),
+        "superseded_by": job.superseded_by,
+    }
+
+@app.get("/deploy/{job_id}/logs")
+def get_deploy_logs(job_id: str, tail: int = 200, follow: bool = False):
+    """ビルド・プッシュのログを返す（follow=trueならジョブ終了までストリーミング）"""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Deploy job not found: {job_id}")
+    if follow:
+        return StreamingResponse(job.log.follow(tail), media_type="text/plain; charset=utf-8")
+    lines = job.log.tail(tail)
+    return PlainTextResponse("".join(line + "\n" for line in lines))
+
+@app.get("/apps")
+def list_apps():
+    """レジストリに記録されたアプリの一覧（AWSには問い合わせない）"""
+    apps = deploy_registry.list_apps()
+    return {"apps": apps, "count": len(apps), "last_reconcile": deploy_registry.last_reconcile}
+
+@app.get("/apps/{app_name}")
+def get_app(app_name: str):
+    """アプリの現在のデプロイ状態（イメージ・タスク定義・ターゲットグループ・ルール等）"""
+    record = deploy_registry.get_app(app_name)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"App not found: {app_name}")
+    return record
+
+@app.get("/apps/{app_name}/history")
+def get_app_history(app_name: str, limit: int = 20):
+    """アプリのデプロイ履歴（新しい順）"""
+    return {"app_name": app_name, "deployments": deploy_registry.history(app_name, max(1, min(limit, 500)))}
+
+@app.get("/apps/{app_name}/logs")
+def get_app_logs(
+    app_name: str,
+    since: str = None,
+    filter_pattern: str = Query(None, alias="filter"),
+    follow: bool = False,
+    limit: int = 1000,
+    output: str = Query(None, alias="format"),
+    accept: str = Header(None),
+):
+    """アプリのCloudWatch Logsを流す（NDJSONまたはServer-Sent Events。follow=trueなら新着を流し続ける）"""
+    fmt = output or ("sse" if accept and "text/event-stream" in accept else "ndjson")
+    if fmt not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or sse")
+    stream = app_logs.stream(app_name, since=since, filter_pattern=filter_pattern, follow=follow, limit=limit, fmt=fmt)
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream" if fmt == "sse" else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/apps/{app_name}/plan")
+def get_app_plan(app_name: str, image: str = None, cpu: str = None, memory: str = None, architecture: str = None):
+    """現在のタスク定義と、次のデプロイで登録する定義の差分
+
+    未指定の項目はレジストリに記録された最後のデプロイ内容（なければ現在の定義）を使う。
+    """
+    recorded = deploy_registry.get_app(app_name) or {}
+    return plan_task_definition(
+        app_name,
+        service_name=recorded.get("service"),
+        image_uri=image or recorded.get("image_uri"),
+        cpu=cpu or recorded.get("cpu"),
+        memory=memory or recorded.get("memory"),
+        alb_path=recorded.get("alb_path"),
+        architecture=architecture,
+    )
+
+@app.post("/apps/{app_name}/promote", status_code=202)
+def promote_app(app_name: str, req: PromoteRequest, response: Response, wait: bool = False, timeout: float = None):
+    """ブルー/グリーンのカナリアの振り分けを変更する（percent=100で確定、0でロールバック）"""
+    if not 0 <= req.percent <= 100:
+        raise HTTPException(status_code=400, detail="percent must be between 0 and 100")
+    job = job_queue.submit(req, app_name=app_name, runner=run_promote)
+    return _job_response(job, response, wait, timeout)
+
+@app.post("/gc")
+def run_garbage_collection(dry_run: bool = False):
+    """古いイメージ・タスク定義リビジョン・孤立したターゲットグループ/ルール・クローンディレクトリを削除する（dry_run=trueなら対象を返すだけ）"""
+    return garbage_collector.run(dry_run=dry_run)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,11 +1,47 @@
 from pydantic import BaseModel
 
+class IdleSchedule(BaseModel):
+    stop_cron: str  # タスクを0にする時刻。例: "cron(0 22 * * ? *)"
+    start_cron: str  # 元のタスク数に戻す時刻。例: "cron(0 8 * * ? *)"
+    timezone: str = "Asia/Tokyo"
+
+class AutoscalingConfig(BaseModel):
+    enabled: bool = True  # falseならスケーリング設定を解除する
+    min_tasks: int = 1
+    max_tasks: int = 1
+    metric: str = "cpu"  # "cpu" | "memory" | "alb_requests"
+    target_value: float = 70.0  # 使用率（%）またはターゲットあたりのリクエスト数
+    scale_in_cooldown: int = 300
+    scale_out_cooldown: int = 60
+    idle_schedule: IdleSchedule | None = None  # アイドル時間帯のスケール・トゥ・ゼロ
+
+class CapacityConfig(BaseModel):
+    on_demand_weight: int = 1  # FARGATE（オンデマンド）へ配置する割合の重み
+    spot_weight: int = 0  # FARGATE_SPOTへ配置する割合の重み
+    on_demand_base: int = 0  # 重みより先にFARGATEで起動するタスク数
+
 class DeployRequest(BaseModel):
     app_name: str
     docker_context: str = "./"
     dockerfile: str = "Dockerfile"
     alb_path: str  # 例: "/image-filter/*"
     git_repo_url: str | None = None
+    git_ref: str | None = None  # ブランチ・タグ・コミットSHA（未指定ならデフォルトブランチ）
     cpu: str = "2048"
     memory: str = "4096"
-    force_recreate: bool = False
\ No newline at end of file
+    force_recreate: bool = False
+    force_rebuild: bool = False  # ECRに同じ内容のイメージがあっても再ビルドする
+    build_backend: str | None = None  # "docker" | "buildx"（未指定ならBUILD_BACKEND）
+    architecture: str = "amd64"  # "amd64" | "arm64"（Graviton） | "both"（マルチアーキテクチャイメージをARM64で起動。buildxが必要）
+    deploy_strategy: str = "rolling"  # "rolling" | "blue_green"
+    canary_percent: int | None = None  # blue_greenで新しい側へ振り分ける割合（1-99、未指定なら一括切り替え）
+    desired_count: int | None = None  # タスク数（未指定なら作成時はautoscaling.min_tasksまたは1、更新時は現状維持）
+    autoscaling: AutoscalingConfig | None = None  # 未指定なら既存のスケーリング設定を変更しない
+    capacity: CapacityConfig | None = None  # 未指定なら作成時はlaunchType=FARGATE、更新時は現在の配分のまま
+
+class BatchDeployRequest(BaseModel):
+    deploys: list[DeployRequest]
+    build_concurrency: int | None = None  # 同時ビルド数（未指定ならDEPLOY_BATCH_BUILD_CONCURRENCY）
+
+class PromoteRequest(BaseModel):
+    percent: int = 100  # 新しい側へ振り分ける割合（100で確定、0でロールバック）
\ No newline at end of file
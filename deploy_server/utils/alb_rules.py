@@ -0,0 +1,276 @@
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from loguru import logger
+
+from utils.clients import get_client
+
+# 新規ルールに割り当てる優先度の下限（これ以上で空いている最小の値を使う）
+ALB_RULE_PRIORITY_START = int(os.getenv("ALB_RULE_PRIORITY_START", "100"))
+ALB_RULE_PRIORITY_MAX = 50000
+# この秒数を過ぎたらdescribe_rulesで全件を取り直す（外部での変更を取り込むため）
+ALB_RULE_INDEX_TTL_SECONDS = int(os.getenv("ALB_RULE_INDEX_TTL_SECONDS", "300"))
+
+
+def _path_patterns(rule) -> list:
+    paths = []
+    for cond in rule.get("Conditions", []):
+        if cond.get("Field") != "path-pattern":
+            continue
+        paths.extend(cond.get("Values") or cond.get("PathPatternConfig", {}).get("Values", []))
+    return paths
+
+
+def _target_group_arns(actions) -> set:
+    arns = set()
+    for action in actions:
+        if action.get("TargetGroupArn"):
+            arns.add(action["TargetGroupArn"])
+        for tg in action.get("ForwardConfig", {}).get("TargetGroups", []):
+            arns.add(tg["TargetGroupArn"])
+    return arns
+
+
+def forward_weights(actions) -> dict:
+    """forwardアクションの転送先ターゲットグループと重みを返す（単純なforwardは重み1）"""
+    weights = {}
+    for action in actions:
+        if action.get("Type") != "forward":
+            continue
+        forward = action.get("ForwardConfig", {})
+        for tg in forward.get("TargetGroups", []):
+            weights[tg["TargetGroupArn"]] = tg.get("Weight", 1)
+        if not forward.get("TargetGroups") and action.get("TargetGroupArn"):
+            weights[action["TargetGroupArn"]] = 1
+    return weights
+
+
+def _actions_key(actions) -> tuple:
+    # describe_rulesは単純なforwardにもForwardConfigを付けて返すため、比較用に正規化する
+    key = []
+    for action in actions:
+        forward = action.get("ForwardConfig", {})
+        weights = forward_weights([action])
+        stickiness = forward.get("TargetGroupStickinessConfig", {})
+        key.append((
+            action.get("Type"),
+            tuple(sorted(weights.items())),
+            stickiness.get("Enabled", False),
+            stickiness.get("DurationSeconds") if stickiness.get("Enabled") else None,
+        ))
+    return tuple(key)
+
+
+class _ListenerState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded_at = 0.0
+        self.rules = {}        # RuleArn -> {"priority", "paths", "actions"}
+        self.by_path = {}      # path-pattern -> RuleArn
+        self.by_target = {}    # TargetGroupArn -> {RuleArn}
+        self.priorities = {}   # priority -> RuleArn
+
+    def clear(self):
+        self.rules.clear()
+        self.by_path.clear()
+        self.by_target.clear()
+        self.priorities.clear()
+
+    def add(self, rule_arn: str, priority: int, paths, actions):
+        self.remove(rule_arn)
+        self.rules[rule_arn] = {"priority": priority, "paths": list(paths), "actions": actions}
+        self.priorities[priority] = rule_arn
+        for path in paths:
+            self.by_path[path] = rule_arn
+        for tg_arn in _target_group_arns(actions):
+            self.by_target.setdefault(tg_arn, set()).add(rule_arn)
+
+    def remove(self, rule_arn: str):
+        rule = self.rules.pop(rule_arn, None)
+        if rule is None:
+            return
+        self.priorities.pop(rule["priority"], None)
+        for path in rule["paths"]:
+            if self.by_path.get(path) == rule_arn:
+                del self.by_path[path]
+        for tg_arn in _target_group_arns(rule["actions"]):
+            arns = self.by_target.get(tg_arn)
+            if arns:
+                arns.discard(rule_arn)
+                if not arns:
+                    del self.by_target[tg_arn]
+
+    def free_priority(self) -> int:
+        # 削除されたルールの隙間を再利用するため、下限から順に空きを探す
+        priority = ALB_RULE_PRIORITY_START
+        while priority in self.priorities:
+            priority += 1
+        if priority > ALB_RULE_PRIORITY_MAX:
+            raise RuntimeError("No free ALB listener rule priority left")
+        return priority
+
+
+class ListenerRuleIndex:
+    """ALBリスナールールのプロセス内インデックス
+
+    パスパターン・ターゲットグループからルールをO(1)で引き、作成・変更・削除は
+    リスナーごとのロック内で行ってインデックスへ即時反映する。
+    新規ルールの優先度は空いている最小の値を割り当てるため、同時デプロイでも衝突しない。
+    """
+
+    def __init__(self, ttl_seconds: int = ALB_RULE_INDEX_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._listeners = {}
+        self.refreshes = 0
+
+    def _state(self, listener_arn: str) -> _ListenerState:
+        with self._lock:
+            return self._listeners.setdefault(listener_arn, _ListenerState())
+
+    def _load(self, listener_arn: str, state: _ListenerState):
+        # ロック取得済みの状態で呼ぶこと。describe_rulesをページングして全件取り直す
+        elbv2 = get_client("elbv2")
+        rules = []
+        kwargs = {"ListenerArn": listener_arn, "PageSize": 400}
+        while True:
+            page = elbv2.describe_rules(**kwargs)
+            rules.extend(page["Rules"])
+            if not page.get("NextMarker"):
+                break
+            kwargs["Marker"] = page["NextMarker"]
+        state.clear()
+        for rule in rules:
+            if rule.get("IsDefault") or rule.get("Priority") == "default":
+                continue
+            state.add(rule["RuleArn"], int(rule["Priority"]), _path_patterns(rule), rule.get("Actions", []))
+        state.loaded_at = time.time()
+        self.refreshes += 1
+        logger.debug(f"Loaded {len(state.rules)} listener rules: {listener_arn}")
+
+    def _ensure_loaded(self, listener_arn: str, state: _ListenerState):
+        if time.time() - state.loaded_at > self.ttl_seconds:
+            self._load(listener_arn, state)
+
+    def invalidate(self, listener_arn: str = None):
+        """次回参照時にdescribe_rulesで取り直させる"""
+        with self._lock:
+            if listener_arn:
+                states = [self._listeners[listener_arn]] if listener_arn in self._listeners else []
+            else:
+                states = list(self._listeners.values())
+        for state in states:
+            state.loaded_at = 0.0
+
+    def find_by_path(self, listener_arn: str, alb_path: str):
+        """パスパターンに一致するルール（{"rule_arn", "priority", "actions"}）を返す"""
+        state = self._state(listener_arn)
+        with state.lock:
+            self._ensure_loaded(listener_arn, state)
+            rule_arn = state.by_path.get(alb_path)
+            if rule_arn is None:
+                return None
+            rule = state.rules[rule_arn]
+            return {"rule_arn": rule_arn, "priority": rule["priority"], "actions": rule["actions"]}
+
+    def find_by_target_group(self, listener_arn: str, tg_arn: str):
+        """ターゲットグループへ転送しているルール（{"rule_arn", "priority", "paths", "actions"}）を返す"""
+        state = self._state(listener_arn)
+        with state.lock:
+            self._ensure_loaded(listener_arn, state)
+            for rule_arn in sorted(state.by_target.get(tg_arn, ())):
+                rule = state.rules[rule_arn]
+                return {"rule_arn": rule_arn, "priority": rule["priority"], "paths": list(rule["paths"]), "actions": rule["actions"]}
+            return None
+
+    def list_rules(self, listener_arn: str) -> list:
+        """全ルール（{"rule_arn", "priority", "paths", "target_groups"}）を優先度順に返す"""
+        state = self._state(listener_arn)
+        with state.lock:
+            self._ensure_loaded(listener_arn, state)
+            return [
+                {
+                    "rule_arn": rule_arn,
+                    "priority": rule["priority"],
+                    "paths": list(rule["paths"]),
+                    "target_groups": sorted(_target_group_arns(rule["actions"])),
+                }
+                for rule_arn, rule in sorted(state.rules.items(), key=lambda item: item[1]["priority"])
+            ]
+
+    def rules_for_target_group(self, listener_arn: str, tg_arn: str) -> list:
+        """ターゲットグループへ転送しているルールARNの一覧"""
+        state = self._state(listener_arn)
+        with state.lock:
+            self._ensure_loaded(listener_arn, state)
+            return sorted(state.by_target.get(tg_arn, ()))
+
+    def ensure_rule(self, listener_arn: str, alb_path: str, actions: list) -> dict:
+        """パスパターンのルールを指定アクションに揃える（なければ作成）
+
+        戻り値: {"rule_arn", "priority", "action": "unchanged" | "modified" | "created"}
+        """
+        elbv2 = get_client("elbv2")
+        state = self._state(listener_arn)
+        with state.lock:
+            self._ensure_loaded(listener_arn, state)
+            for attempt in range(2):
+                rule_arn = state.by_path.get(alb_path)
+                try:
+                    if rule_arn:
+                        rule = state.rules[rule_arn]
+                        if _actions_key(rule["actions"]) == _actions_key(actions):
+                            return {"rule_arn": rule_arn, "priority": rule["priority"], "action": "unchanged"}
+                        elbv2.modify_rule(RuleArn=rule_arn, Actions=actions)
+                        state.add(rule_arn, rule["priority"], rule["paths"], actions)
+                        logger.info(f"Modified ALB rule for {alb_path} (priority {rule['priority']})")
+                        return {"rule_arn": rule_arn, "priority": rule["priority"], "action": "modified"}
+
+                    priority = state.free_priority()
+                    created = elbv2.create_rule(
+                        ListenerArn=listener_arn,
+                        Priority=priority,
+                        Conditions=[{"Field": "path-pattern", "Values": [alb_path]}],
+                        Actions=actions,
+                    )["Rules"][0]
+                    state.add(created["RuleArn"], priority, [alb_path], actions)
+                    logger.info(f"Created ALB rule for {alb_path} with priority {priority}")
+                    return {"rule_arn": created["RuleArn"], "priority": priority, "action": "created"}
+                except ClientError as e:
+                    code = e.response.get("Error", {}).get("Code")
+                    if attempt or code not in ("PriorityInUse", "RuleNotFound"):
+                        raise
+                    # 他プロセスやコンソールでの変更とずれていたので取り直して再試行
+                    logger.warning(f"Listener rule index out of date ({code}), reloading")
+                    self._load(listener_arn, state)
+
+    def ensure_forward_rule(self, listener_arn: str, alb_path: str, tg_arn: str) -> dict:
+        """パスパターンをターゲットグループへ転送するルールを用意する"""
+        return self.ensure_rule(listener_arn, alb_path, [{"Type": "forward", "TargetGroupArn": tg_arn}])
+
+    def delete_rule(self, listener_arn: str, rule_arn: str):
+        """ルールを削除し、その優先度を再利用可能にする"""
+        elbv2 = get_client("elbv2")
+        state = self._state(listener_arn)
+        with state.lock:
+            try:
+                elbv2.delete_rule(RuleArn=rule_arn)
+            except elbv2.exceptions.RuleNotFoundException:
+                pass
+            state.remove(rule_arn)
+            logger.info(f"Deleted ALB rule: {rule_arn}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            states = dict(self._listeners)
+        return {
+            "listeners": len(states),
+            "rules": sum(len(s.rules) for s in states.values()),
+            "refreshes": self.refreshes,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+listener_rules = ListenerRuleIndex()
@@ -0,0 +1,266 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.clients import get_client
+
+# follow中に1つのロググループを問い合わせる間隔（秒）。同じロググループを見ているクライアントで共有する
+APP_LOG_POLL_SECONDS = float(os.getenv("APP_LOG_POLL_SECONDS", "2"))
+# 購読者がいなくなったポーラーを止めるまでの秒数
+APP_LOG_IDLE_SECONDS = float(os.getenv("APP_LOG_IDLE_SECONDS", "60"))
+# ポーラーごとにメモリに保持する直近のイベント数（読み出しの遅いクライアントはこれより古いものを読み飛ばす）
+APP_LOG_BUFFER_EVENTS = int(os.getenv("APP_LOG_BUFFER_EVENTS", "5000"))
+# 取り込みの遅れで後から届くイベントを拾うため、毎回この秒数だけ遡って問い合わせる
+APP_LOG_INGESTION_LAG_SECONDS = float(os.getenv("APP_LOG_INGESTION_LAG_SECONDS", "10"))
+# sinceを省略したときに遡る範囲
+APP_LOG_DEFAULT_SINCE = os.getenv("APP_LOG_DEFAULT_SINCE", "10m")
+
+# filter_log_eventsで1回に返せるイベント数の上限
+_FILTER_LOG_EVENTS_MAX = 10000
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def log_group_name(app_name: str) -> str:
+    return f"/ecs/{app_name}"
+
+
+def parse_since(value) -> int:
+    """sinceをエポックミリ秒に変換する（"30s"・"15m"・"2h"・"1d"、エポック秒/ミリ秒、ISO 8601）"""
+    value = (value or APP_LOG_DEFAULT_SINCE).strip()
+    now = time.time()
+    match = re.fullmatch(r"(\d+)([smhd])", value)
+    if match:
+        return int((now - int(match.group(1)) * _UNITS[match.group(2)]) * 1000)
+    if value.isdigit():
+        number = int(value)
+        # 13桁以上はミリ秒（next_sinceをそのまま渡せるように）
+        return number if number >= 10**12 else number * 1000
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid since: {value} (use e.g. 15m, 2h, epoch seconds or ISO 8601)")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def _record(event: dict) -> dict:
+    return {
+        "id": event["eventId"],
+        "timestamp": event["timestamp"],
+        "time": datetime.fromtimestamp(event["timestamp"] / 1000, tz=timezone.utc).isoformat(),
+        "stream": event.get("logStreamName"),
+        "message": event.get("message", "").rstrip("\n"),
+    }
+
+
+def _format(record: dict, fmt: str) -> str:
+    data = json.dumps(record, ensure_ascii=False)
+    if fmt != "sse":
+        return data + "\n"
+    if "id" in record:
+        return f"id: {record['id']}\nevent: log\ndata: {data}\n\n"
+    return f"event: notice\ndata: {data}\n\n"
+
+
+class _Tailer:
+    """1つのロググループ（とフィルターパターン）の新着イベントを購読者へ配る"""
+
+    def __init__(self, log_group: str, filter_pattern, start_ms: int, buffer_events: int):
+        self.log_group = log_group
+        self.filter_pattern = filter_pattern
+        self.start_ms = start_ms
+        self.cursor = start_ms
+        self.seq = 0
+        self.subscribers = 0
+        self.idle_since = time.time()
+        self.polls = 0
+        self.error = None
+        self._buffer = deque(maxlen=buffer_events)
+        self._recent = {}  # eventId -> timestamp（遡って問い合わせる範囲の重複除去用）
+        self._cond = threading.Condition()
+
+    def publish(self, events: list, lag_ms: int):
+        with self._cond:
+            for event in sorted(events, key=lambda e: e["timestamp"]):
+                if event["eventId"] in self._recent:
+                    continue
+                self._recent[event["eventId"]] = event["timestamp"]
+                self._buffer.append((self.seq, _record(event)))
+                self.seq += 1
+                self.cursor = max(self.cursor, event["timestamp"])
+            horizon = self.cursor - lag_ms
+            self._recent = {k: ts for k, ts in self._recent.items() if ts >= horizon}
+            self._cond.notify_all()
+
+    def events_after(self, seq: int, timeout: float):
+        """seq番目以降のイベントを返す（なければtimeout秒まで待機）。戻り値: (次のseq, 読み飛ばした数, レコード)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > seq, timeout=timeout)
+            records = [(i, record) for i, record in self._buffer if i >= seq]
+            skipped = records[0][0] - seq if records else max(0, self.seq - seq)
+            return self.seq, skipped, [record for _, record in records]
+
+
+class AppLogHub:
+    """アプリのCloudWatch Logs（/ecs/{app_name}）を読み出す
+
+    過去分はクライアントごとにfilter_log_eventsをページングしながらそのまま流す。
+    follow=trueの新着は、ロググループとフィルターごとに1つのバックグラウンドスレッドだけが
+    APP_LOG_POLL_SECONDS間隔で問い合わせ、同じものを見ている全クライアントへ配る。
+    """
+
+    def __init__(
+        self,
+        poll_seconds: float = APP_LOG_POLL_SECONDS,
+        idle_seconds: float = APP_LOG_IDLE_SECONDS,
+        buffer_events: int = APP_LOG_BUFFER_EVENTS,
+        ingestion_lag_seconds: float = APP_LOG_INGESTION_LAG_SECONDS,
+    ):
+        self.poll_seconds = poll_seconds
+        self.idle_seconds = idle_seconds
+        self.buffer_events = buffer_events
+        self.lag_ms = int(ingestion_lag_seconds * 1000)
+        self._lock = threading.Lock()
+        self._tailers = {}
+        self.api_calls = 0
+
+    def _pages(self, log_group: str, filter_pattern, start_ms: int, end_ms: int = None):
+        """filter_log_eventsを継続トークンでページングし、ページごとのイベントを返すジェネレータ"""
+        logs = get_client("logs")
+        kwargs = {"logGroupName": log_group, "startTime": start_ms, "limit": _FILTER_LOG_EVENTS_MAX}
+        if end_ms is not None:
+            kwargs["endTime"] = end_ms
+        if filter_pattern:
+            kwargs["filterPattern"] = filter_pattern
+        while True:
+            with self._lock:
+                self.api_calls += 1
+            page = logs.filter_log_events(**kwargs)
+            yield page.get("events", [])
+            token = page.get("nextToken")
+            if not token or token == kwargs.get("nextToken"):
+                return
+            kwargs["nextToken"] = token
+
+    def _subscribe(self, log_group: str, filter_pattern):
+        """ポーラーに購読者として加わる。戻り値: (ポーラー, 受け取りを始めるseq, 過去分として読む終端のエポックミリ秒)"""
+        key = (log_group, filter_pattern or "")
+        now_ms = int(time.time() * 1000)
+        with self._lock:
+            tailer = self._tailers.get(key)
+            if tailer is None:
+                tailer = _Tailer(log_group, filter_pattern, now_ms, self.buffer_events)
+                self._tailers[key] = tailer
+                threading.Thread(target=self._run, args=(key, tailer), name=f"log-tail{log_group}", daemon=True).start()
+            tailer.subscribers += 1
+            return tailer, tailer.seq, now_ms
+
+    def _unsubscribe(self, tailer: _Tailer):
+        with self._lock:
+            tailer.subscribers -= 1
+            if tailer.subscribers == 0:
+                tailer.idle_since = time.time()
+
+    def _run(self, key, tailer: _Tailer):
+        logger.info(f"Started tailing log group {tailer.log_group}")
+        while True:
+            with self._lock:
+                if tailer.subscribers == 0 and time.time() - tailer.idle_since >= self.idle_seconds:
+                    del self._tailers[key]
+                    break
+            try:
+                events = []
+                for page in self._pages(tailer.log_group, tailer.filter_pattern, tailer.cursor - self.lag_ms):
+                    events.extend(page)
+                tailer.publish(events, self.lag_ms)
+                tailer.error = None
+            except Exception as e:
+                if tailer.error != str(e):
+                    logger.warning(f"Failed to tail log group {tailer.log_group}: {e}")
+                tailer.error = str(e)
+            tailer.polls += 1
+            time.sleep(self.poll_seconds)
+        logger.info(f"Stopped tailing log group {tailer.log_group}")
+
+    def stream(self, app_name: str, since: str = None, filter_pattern: str = None, follow: bool = False,
+               limit: int = 1000, fmt: str = "ndjson"):
+        """ログイベントを1件ずつ整形して返すジェネレータを作る
+
+        最初のページだけはここで取得し、ロググループが無ければ404を送出する（ストリーム開始前に返せるように）。
+        過去分がlimit件を超えた場合は {"truncated": true, "next_since": ...} を出して打ち切る。
+        """
+        log_group = log_group_name(app_name)
+        start_ms = parse_since(since)
+        tailer, seq, end_ms = self._subscribe(log_group, filter_pattern) if follow else (None, 0, None)
+        logs = get_client("logs")
+        try:
+            # followなら過去分は購読した時点までを読み、以降はポーラーから受け取る
+            pages = self._pages(log_group, filter_pattern, start_ms, end_ms)
+            first = next(pages)
+        except Exception as e:
+            if tailer:
+                self._unsubscribe(tailer)
+            if isinstance(e, logs.exceptions.ResourceNotFoundException):
+                raise HTTPException(status_code=404, detail=f"Log group not found: {log_group}")
+            raise
+        return self._generate(first, pages, tailer, seq, end_ms, limit, fmt)
+
+    def _generate(self, page: list, pages, tailer, seq: int, end_ms, limit: int, fmt: str):
+        sent = 0
+        # 過去分の末尾とポーラーが遡って読む範囲は重なるため、そこに含まれたイベントは二重に出さない
+        seen = set()
+        try:
+            while page is not None:
+                for event in page:
+                    if sent >= limit:
+                        yield _format({"truncated": True, "next_since": event["timestamp"]}, fmt)
+                        page = None
+                        break
+                    if tailer and event["timestamp"] >= end_ms - self.lag_ms:
+                        seen.add(event["eventId"])
+                    sent += 1
+                    yield _format(_record(event), fmt)
+                else:
+                    page = next(pages, None)
+            if tailer is None:
+                return
+            while True:
+                seq, skipped, records = tailer.events_after(seq, timeout=15)
+                if skipped:
+                    yield _format({"skipped": skipped, "message": f"... {skipped} events skipped ..."}, fmt)
+                for record in records:
+                    if record["id"] not in seen:
+                        yield _format(record, fmt)
+                if not records and fmt == "sse":
+                    # 切断されたクライアントを検知できるように定期的にコメント行を送る
+                    yield ": keepalive\n\n"
+        finally:
+            if tailer:
+                self._unsubscribe(tailer)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tailers": [
+                    {
+                        "log_group": t.log_group,
+                        "filter": t.filter_pattern,
+                        "subscribers": t.subscribers,
+                        "polls": t.polls,
+                        "error": t.error,
+                    }
+                    for t in self._tailers.values()
+                ],
+                "api_calls": self.api_calls,
+            }
+
+
+app_logs = AppLogHub()
@@ -0,0 +1,196 @@
+from botocore.exceptions import ClientError
+from loguru import logger
+
+from utils.clients import get_client
+from utils.common import CLUSTER_NAME
+
+SCALABLE_DIMENSION = "ecs:service:DesiredCount"
+
+# autoscaling.metric と Application Auto Scaling の定義済みメトリクスの対応
+SCALING_METRICS = {
+    "cpu": "ECSServiceAverageCPUUtilization",
+    "memory": "ECSServiceAverageMemoryUtilization",
+    "alb_requests": "ALBRequestCountPerTarget",
+}
+
+
+def _resource_id(service_name: str) -> str:
+    return f"service/{CLUSTER_NAME}/{service_name}"
+
+
+def _alb_resource_label(alb_arn: str, tg_arn: str) -> str:
+    # app/<lb名>/<id>/targetgroup/<tg名>/<id>
+    lb_part = alb_arn.split(":loadbalancer/", 1)[1]
+    tg_part = tg_arn.split(":", 5)[5]
+    return f"{lb_part}/{tg_part}"
+
+
+def initial_desired_count(req) -> int:
+    """サービス作成時のタスク数（desired_count > autoscaling.min_tasks > 1）"""
+    if req.desired_count is not None:
+        return req.desired_count
+    if req.autoscaling and req.autoscaling.enabled:
+        return req.autoscaling.min_tasks
+    return 1
+
+
+def apply_autoscaling(service_name: str, autoscaling, tg_arn: str = None, alb_arn: str = None) -> dict:
+    """スケーリング対象・ターゲット追跡ポリシー・アイドル時間のスケジュールを登録する
+
+    このサーバーが作ったポリシー・スケジュール（名前が{service_name}-で始まるもの）のうち
+    今回の設定に含まれないものは削除する。
+    """
+    client = get_client("application-autoscaling")
+    resource_id = _resource_id(service_name)
+    target = {"ServiceNamespace": "ecs", "ResourceId": resource_id, "ScalableDimension": SCALABLE_DIMENSION}
+
+    if not autoscaling.enabled:
+        remove_autoscaling(service_name)
+        return {"enabled": False}
+
+    client.register_scalable_target(**target, MinCapacity=autoscaling.min_tasks, MaxCapacity=autoscaling.max_tasks)
+
+    policy_name = f"{service_name}-{autoscaling.metric}-target-tracking"
+    metric = {"PredefinedMetricType": SCALING_METRICS[autoscaling.metric]}
+    if autoscaling.metric == "alb_requests":
+        if not alb_arn:
+            raise ValueError("alb_requests autoscaling requires alb_arn")
+        metric["ResourceLabel"] = _alb_resource_label(alb_arn, tg_arn)
+    client.put_scaling_policy(
+        PolicyName=policy_name,
+        PolicyType="TargetTrackingScaling",
+        TargetTrackingScalingPolicyConfiguration={
+            "TargetValue": autoscaling.target_value,
+            "PredefinedMetricSpecification": metric,
+            "ScaleInCooldown": autoscaling.scale_in_cooldown,
+            "ScaleOutCooldown": autoscaling.scale_out_cooldown,
+        },
+        **target,
+    )
+    for policy in client.describe_scaling_policies(ServiceNamespace="ecs", ResourceId=resource_id)["ScalingPolicies"]:
+        name = policy["PolicyName"]
+        if policy["ResourceId"] == resource_id and name.startswith(f"{service_name}-") and name != policy_name:
+            client.delete_scaling_policy(PolicyName=name, **target)
+            logger.info(f"Deleted stale scaling policy: {name}")
+
+    # アイドル時間帯はmin/maxを0にしてタスクを止め、再開時に元の範囲へ戻す
+    schedule = autoscaling.idle_schedule
+    actions = {}
+    if schedule:
+        actions = {
+            f"{service_name}-idle-stop": (schedule.stop_cron, 0, 0),
+            f"{service_name}-idle-start": (schedule.start_cron, autoscaling.min_tasks, autoscaling.max_tasks),
+        }
+        for name, (cron, min_tasks, max_tasks) in actions.items():
+            client.put_scheduled_action(
+                ScheduledActionName=name,
+                Schedule=cron,
+                Timezone=schedule.timezone,
+                ScalableTargetAction={"MinCapacity": min_tasks, "MaxCapacity": max_tasks},
+                **target,
+            )
+    for action in client.describe_scheduled_actions(ServiceNamespace="ecs", ResourceId=resource_id)["ScheduledActions"]:
+        name = action["ScheduledActionName"]
+        if action["ResourceId"] == resource_id and name.startswith(f"{service_name}-") and name not in actions:
+            client.delete_scheduled_action(ScheduledActionName=name, **target)
+
+    logger.info(
+        f"Autoscaling for {service_name}: {autoscaling.min_tasks}-{autoscaling.max_tasks} tasks, "
+        f"{autoscaling.metric} target {autoscaling.target_value}"
+    )
+    return {
+        "enabled": True,
+        "min_tasks": autoscaling.min_tasks,
+        "max_tasks": autoscaling.max_tasks,
+        "policy": policy_name,
+        "scheduled_actions": sorted(actions),
+    }
+
+
+def remove_autoscaling(service_name: str):
+    """スケーリング対象を解除する（ポリシーとスケジュールも一緒に削除される）"""
+    client = get_client("application-autoscaling")
+    try:
+        client.deregister_scalable_target(
+            ServiceNamespace="ecs", ResourceId=_resource_id(service_name), ScalableDimension=SCALABLE_DIMENSION
+        )
+        logger.info(f"Removed autoscaling for {service_name}")
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("ObjectNotFoundException", "ValidationException"):
+            raise
+
+
+def _renamed(name: str, from_service: str, to_service: str) -> str:
+    # このサーバーの命名（{service_name}-...）ならコピー先のサービス名に付け替える
+    return f"{to_service}-{name[len(from_service) + 1:]}" if name.startswith(f"{from_service}-") else name
+
+
+def copy_autoscaling(from_service: str, to_service: str, tg_arn: str = None, alb_arn: str = None,
+                     overwrite: bool = True):
+    """from_serviceのスケーリング対象・ポリシー・スケジュールをto_serviceへ同じ内容で登録する
+
+    ブルー/グリーンでautoscaling未指定のデプロイ・promoteが、旧側を解除する前に設定を引き継ぐために使う。
+    alb_requestsのポリシーはto_serviceのターゲットグループ（tg_arn）を指すように付け替える。
+    コピー元にスケーリング対象が無ければ何もせずNone、overwrite=Falseでコピー先に既にあれば何もせずNoneを返す。
+    """
+    client = get_client("application-autoscaling")
+    source_id, dest_id = _resource_id(from_service), _resource_id(to_service)
+    targets = client.describe_scalable_targets(
+        ServiceNamespace="ecs", ResourceIds=[source_id], ScalableDimension=SCALABLE_DIMENSION
+    )["ScalableTargets"]
+    if not targets:
+        return None
+    if not overwrite and client.describe_scalable_targets(
+        ServiceNamespace="ecs", ResourceIds=[dest_id], ScalableDimension=SCALABLE_DIMENSION
+    )["ScalableTargets"]:
+        return None
+    target = {"ServiceNamespace": "ecs", "ResourceId": dest_id, "ScalableDimension": SCALABLE_DIMENSION}
+    client.register_scalable_target(**target, MinCapacity=targets[0]["MinCapacity"], MaxCapacity=targets[0]["MaxCapacity"])
+
+    policies = []
+    for policy in client.describe_scaling_policies(ServiceNamespace="ecs", ResourceId=source_id)["ScalingPolicies"]:
+        if policy["ResourceId"] != source_id:
+            continue
+        name = _renamed(policy["PolicyName"], from_service, to_service)
+        config = {}
+        for key in ("TargetTrackingScalingPolicyConfiguration", "StepScalingPolicyConfiguration"):
+            if key in policy:
+                config[key] = dict(policy[key])
+        tracking = config.get("TargetTrackingScalingPolicyConfiguration")
+        predefined = (tracking or {}).get("PredefinedMetricSpecification")
+        if predefined and predefined["PredefinedMetricType"] == SCALING_METRICS["alb_requests"]:
+            if not (alb_arn and tg_arn):
+                raise ValueError("alb_requests autoscaling requires alb_arn")
+            tracking["PredefinedMetricSpecification"] = {**predefined, "ResourceLabel": _alb_resource_label(alb_arn, tg_arn)}
+        client.put_scaling_policy(PolicyName=name, PolicyType=policy["PolicyType"], **config, **target)
+        policies.append(name)
+
+    actions = []
+    for action in client.describe_scheduled_actions(ServiceNamespace="ecs", ResourceId=source_id)["ScheduledActions"]:
+        if action["ResourceId"] != source_id:
+            continue
+        name = _renamed(action["ScheduledActionName"], from_service, to_service)
+        extra = {key: action[key] for key in ("Timezone", "StartTime", "EndTime") if action.get(key)}
+        client.put_scheduled_action(
+            ScheduledActionName=name, Schedule=action["Schedule"],
+            ScalableTargetAction=action["ScalableTargetAction"], **extra, **target,
+        )
+        actions.append(name)
+
+    # コピー先に残っている、コピー元に無いポリシー・スケジュールは削除する
+    for policy in client.describe_scaling_policies(ServiceNamespace="ecs", ResourceId=dest_id)["ScalingPolicies"]:
+        if policy["ResourceId"] == dest_id and policy["PolicyName"] not in policies:
+            client.delete_scaling_policy(PolicyName=policy["PolicyName"], **target)
+    for action in client.describe_scheduled_actions(ServiceNamespace="ecs", ResourceId=dest_id)["ScheduledActions"]:
+        if action["ResourceId"] == dest_id and action["ScheduledActionName"] not in actions:
+            client.delete_scheduled_action(ScheduledActionName=action["ScheduledActionName"], **target)
+
+    logger.info(f"Copied autoscaling from {from_service} to {to_service}: {len(policies)} policies, {len(actions)} scheduled actions")
+    return {
+        "enabled": True,
+        "copied_from": from_service,
+        "min_tasks": targets[0]["MinCapacity"],
+        "max_tasks": targets[0]["MaxCapacity"],
+        "policies": policies,
+        "scheduled_actions": actions,
+    }
@@ -1,27 +1,29 @@
 from utils.common import (
     AWS_REGION,
     CLUSTER_NAME,
-    get_config_value,
-    load_terraform_outputs,
+    get_resolved_config,
 )
+from utils.waiters import DESCRIBE_SERVICES_BATCH
 from fastapi import HTTPException
 from loguru import logger
 import boto3
 
-def register_task_definition(ecs, app_name, req, ecr_url, gradio_root_path, log_group_name, execution_role_arn, task_role_arn):
-    logger.info(f"Registering task definition with CPU: {req.cpu}, Memory: {req.memory}")
-    ecs.register_task_definition(
-        family=app_name,
-        networkMode="awsvpc",
-        requiresCompatibilities=["FARGATE"],
-        cpu=req.cpu,
-        memory=req.memory,
-        executionRoleArn=execution_role_arn,
-        taskRoleArn=task_role_arn,
-        containerDefinitions=[
+def build_task_definition(app_name, cpu, memory, image_uri, gradio_root_path, log_group_name, execution_role_arn, task_role_arn,
+                          cpu_architecture="X86_64"):
+    """register_task_definitionに渡すタスク定義（差分の比較にも使う）"""
+    return {
+        "family": app_name,
+        "networkMode": "awsvpc",
+        "requiresCompatibilities": ["FARGATE"],
+        "runtimePlatform": {"cpuArchitecture": cpu_architecture, "operatingSystemFamily": "LINUX"},
+        "cpu": cpu,
+        "memory": memory,
+        "executionRoleArn": execution_role_arn,
+        "taskRoleArn": task_role_arn,
+        "containerDefinitions": [
             {
                 "name": app_name,
-                "image": f"{ecr_url}:latest",
+                "image": image_uri,
                 "portMappings": [
                     {
                         "containerPort": 7860,
@@ -44,19 +46,38 @@ def register_task_definition(ecs, app_name, req, ecr_url, gradio_root_path, log_
                 }
             }
         ]
+    }
+
+def register_task_definition(ecs, definition):
+    container = definition["containerDefinitions"][0]
+    logger.info(
+        f"Registering task definition with CPU: {definition['cpu']}, Memory: {definition['memory']}, "
+        f"Architecture: {definition['runtimePlatform']['cpuArchitecture']}, Image: {container['image']}"
     )
+    response = ecs.register_task_definition(**definition)
+    return response["taskDefinition"]["taskDefinitionArn"]
 
-def update_ecs_service(ecs, app_name, task_definition_family):
-    logger.info(f"Updating existing ECS service: {app_name}")
+def update_ecs_service(ecs, app_name, task_definition, service_name=None, desired_count=None, force_new_deployment=True,
+                       capacity_provider_strategy=None):
+    service_name = service_name or app_name
+    logger.info(f"Updating existing ECS service: {service_name}")
+    kwargs = {}
+    if desired_count is not None:
+        kwargs["desiredCount"] = desired_count
+    if capacity_provider_strategy:
+        # launchTypeで作成したサービスもこれでキャパシティプロバイダーに切り替わる（新しいデプロイが必要）
+        kwargs["capacityProviderStrategy"] = capacity_provider_strategy
+        force_new_deployment = True
     try:
         ecs.update_service(
             cluster=CLUSTER_NAME,
-            service=app_name,
-            taskDefinition=task_definition_family,
+            service=service_name,
+            taskDefinition=task_definition,
             enableExecuteCommand=True, 
-            forceNewDeployment=True
+            forceNewDeployment=force_new_deployment,
+            **kwargs
         )
-        logger.info(f"Successfully updated service: {app_name}")
+        logger.info(f"Successfully updated service: {service_name}")
         return "update"
     except Exception as update_e:
         logger.error(f"Failed to update service: {update_e}")
@@ -72,12 +93,21 @@ def delete_ecs_service(ecs, app_name):
         logger.warning(f"Failed to delete service: {del_e}")
         return False
 
-def create_ecs_service(ecs, app_name, task_definition_family, tg_arn, subnets, security_groups):
-    logger.info(f"Creating new ECS service: {app_name}")
+def scale_ecs_service(ecs, service_name, desired_count):
+    logger.info(f"Scaling ECS service {service_name} to {desired_count} tasks")
+    ecs.update_service(cluster=CLUSTER_NAME, service=service_name, desiredCount=desired_count)
+
+def create_ecs_service(ecs, app_name, task_definition, tg_arn, subnets, security_groups, service_name=None, desired_count=1,
+                       capacity_provider_strategy=None):
+    service_name = service_name or app_name
+    logger.info(f"Creating new ECS service: {service_name}")
+    if capacity_provider_strategy:
+        placement = {"capacityProviderStrategy": capacity_provider_strategy}
+    else:
+        placement = {"launchType": "FARGATE"}
     
     # プライベートサブネットを使用しているかチェック
-    tf_outputs = load_terraform_outputs()
-    private_subnet_ids = tf_outputs.get("private_subnet_ids", [])
+    private_subnet_ids = list(get_resolved_config().private_subnet_ids)
     
     # サブネットがプライベートサブネットの場合は assignPublicIp を DISABLED に
     is_using_private_subnets = any(subnet in private_subnet_ids for subnet in subnets)
@@ -91,16 +121,16 @@ def create_ecs_service(ecs, app_name, task_definition_family, tg_arn, subnets, s
     try:
         ecs.create_service(
             cluster=CLUSTER_NAME,
-            serviceName=app_name,
-            taskDefinition=task_definition_family,
+            serviceName=service_name,
+            taskDefinition=task_definition,
             enableExecuteCommand=True,
             loadBalancers=[{
                 "targetGroupArn": tg_arn,
                 "containerName": app_name,
                 "containerPort": 7860
             }],
-            desiredCount=1,
-            launchType="FARGATE",
+            desiredCount=desired_count,
+            **placement,
             networkConfiguration={
                 "awsvpcConfiguration": {
                     "subnets": subnets,
@@ -110,8 +140,19 @@ def create_ecs_service(ecs, app_name, task_definition_family, tg_arn, subnets, s
             },
             healthCheckGracePeriodSeconds=300
         )
-        logger.info(f"Successfully created service: {app_name}")
+        logger.info(f"Successfully created service: {service_name}")
         return "create"
     except Exception as create_e:
         logger.error(f"Failed to create service: {create_e}")
-        raise HTTPException(status_code=500, detail=f"Service creation failed: {create_e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Service creation failed: {create_e}")
+
+def list_cluster_services(ecs) -> dict:
+    """クラスターの全サービスを {サービス名: describe_servicesの結果} で返す（describeは最大10件ずつ）"""
+    names = []
+    for page in ecs.get_paginator("list_services").paginate(cluster=CLUSTER_NAME):
+        names.extend(arn.rsplit("/", 1)[1] for arn in page["serviceArns"])
+    services = {}
+    for i in range(0, len(names), DESCRIBE_SERVICES_BATCH):
+        for service in ecs.describe_services(cluster=CLUSTER_NAME, services=names[i:i + DESCRIBE_SERVICES_BATCH])["services"]:
+            services[service["serviceName"]] = service
+    return services
@@ -0,0 +1,129 @@
+import os
+
+from utils.alb_rules import listener_rules, forward_weights
+from utils.clients import get_client
+from utils.common import CLUSTER_NAME
+
+# カナリア中にクライアントを同じ側へ固定する秒数（Gradioのwebsocketセッションを切らないため）
+BLUE_GREEN_STICKINESS_SECONDS = int(os.getenv("BLUE_GREEN_STICKINESS_SECONDS", "3600"))
+
+SLOTS = ("blue", "green")
+
+
+def slot_names(app_name: str, slot: str):
+    """スロットの (ECSサービス名, ターゲットグループ名) を返す
+
+    blueは従来のローリングデプロイと同じ名前を使うため、既存アプリもそのまま移行できる。
+    """
+    if slot == "blue":
+        return app_name, f"{app_name}-tg"
+    return f"{app_name}-{slot}", f"{app_name}-{slot}-tg"
+
+
+def other_slot(slot: str) -> str:
+    return "green" if slot == "blue" else "blue"
+
+
+def forward_actions(new_tg_arn: str, new_weight: int = 100, old_tg_arn: str = None) -> list:
+    """新旧ターゲットグループへの転送アクション。中間の重みならスティッキーな重み付きforwardにする"""
+    if old_tg_arn is None or new_weight >= 100:
+        return [{"Type": "forward", "TargetGroupArn": new_tg_arn}]
+    if new_weight <= 0:
+        return [{"Type": "forward", "TargetGroupArn": old_tg_arn}]
+    return [{
+        "Type": "forward",
+        "ForwardConfig": {
+            "TargetGroups": [
+                {"TargetGroupArn": new_tg_arn, "Weight": new_weight},
+                {"TargetGroupArn": old_tg_arn, "Weight": 100 - new_weight},
+            ],
+            "TargetGroupStickinessConfig": {"Enabled": True, "DurationSeconds": BLUE_GREEN_STICKINESS_SECONDS},
+        },
+    }]
+
+
+def _target_group_arn(elbv2, name: str):
+    try:
+        return elbv2.describe_target_groups(Names=[name])["TargetGroups"][0]["TargetGroupArn"]
+    except elbv2.exceptions.TargetGroupNotFoundException:
+        return None
+
+
+def _deployed_at(service):
+    primary = next((d for d in service.get("deployments", []) if d["status"] == "PRIMARY"), None)
+    return primary["createdAt"] if primary else service.get("createdAt")
+
+
+def resolve_slots(listener_arn: str, app_name: str, alb_path: str = None) -> dict:
+    """リスナールールの重みから各スロットの状態を調べる
+
+    戻り値: {"rule": ルール or None, "slots": {slot: {"service", "tg_name", "tg_arn", "weight", "deployed_at"}}}
+    ACTIVEなサービスのスロットには"desired_count"・"task_definition"・"capacity_provider_strategy"も入る。
+    """
+    elbv2 = get_client("elbv2")
+    ecs = get_client("ecs")
+    slots = {}
+    for slot in SLOTS:
+        service_name, tg_name = slot_names(app_name, slot)
+        slots[slot] = {
+            "service": service_name,
+            "tg_name": tg_name,
+            "tg_arn": _target_group_arn(elbv2, tg_name),
+            "weight": 0,
+            "deployed_at": None,
+        }
+
+    rule = listener_rules.find_by_path(listener_arn, alb_path) if alb_path else None
+    if rule is None:
+        for slot in SLOTS:
+            if slots[slot]["tg_arn"]:
+                rule = listener_rules.find_by_target_group(listener_arn, slots[slot]["tg_arn"])
+                if rule:
+                    break
+    weights = forward_weights(rule["actions"]) if rule else {}
+    for info in slots.values():
+        info["weight"] = weights.get(info["tg_arn"], 0) if info["tg_arn"] else 0
+
+    services = ecs.describe_services(cluster=CLUSTER_NAME, services=[info["service"] for info in slots.values()])["services"]
+    for service in services:
+        for info in slots.values():
+            if service["serviceName"] == info["service"] and service["status"] == "ACTIVE":
+                info["deployed_at"] = _deployed_at(service)
+                info["desired_count"] = service["desiredCount"]
+                info["task_definition"] = service["taskDefinition"]
+                info["capacity_provider_strategy"] = service.get("capacityProviderStrategy") or None
+    return {"rule": rule, "slots": slots}
+
+
+def green_weight(listener_arn: str, app_name: str, alb_path: str = None) -> int:
+    """greenスロットへの振り分けの重み（greenのターゲットグループが無ければ0）。サービスは問い合わせない"""
+    tg_arn = _target_group_arn(get_client("elbv2"), slot_names(app_name, "green")[1])
+    if not tg_arn:
+        return 0
+    rule = (listener_rules.find_by_path(listener_arn, alb_path) if alb_path else None) \
+        or listener_rules.find_by_target_group(listener_arn, tg_arn)
+    return forward_weights(rule["actions"]).get(tg_arn, 0) if rule else 0
+
+
+def serving_slots(slots: dict) -> list:
+    """トラフィックを受けているスロット（重み>0）"""
+    return [slot for slot in SLOTS if slots[slot]["weight"] > 0]
+
+
+def candidate_slot(slots: dict):
+    """カナリア中（両方に重みがある）なら、後からデプロイされた側を返す"""
+    serving = serving_slots(slots)
+    if len(serving) < 2:
+        return None
+    return max(serving, key=lambda slot: slots[slot]["deployed_at"] or 0)
+
+
+def choose_slots(slots: dict):
+    """(デプロイ先のスロット, 現在トラフィックを受けている旧スロット or None) を返す
+
+    カナリア中なら候補側を置き換え、そうでなければトラフィックを受けていない側へデプロイする。
+    """
+    serving = serving_slots(slots)
+    new_slot = candidate_slot(slots) or (other_slot(serving[0]) if serving else "blue")
+    old_slot = other_slot(new_slot) if serving and serving != [new_slot] else None
+    return new_slot, old_slot
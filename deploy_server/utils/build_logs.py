@@ -0,0 +1,106 @@
+import os
+import subprocess
+import threading
+from collections import deque
+
+from loguru import logger
+
+# デプロイごとのビルド・プッシュログの保存先
+DEPLOY_LOG_DIR = os.path.abspath(os.getenv("DEPLOY_LOG_DIR", "deploy_logs"))
+# メモリに保持する直近の行数
+DEPLOY_LOG_BUFFER_LINES = int(os.getenv("DEPLOY_LOG_BUFFER_LINES", "2000"))
+# 失敗時のエラー詳細に含める末尾の行数
+DEPLOY_LOG_ERROR_TAIL_LINES = int(os.getenv("DEPLOY_LOG_ERROR_TAIL_LINES", "50"))
+
+
+class DeployLog:
+    """1デプロイ分のログ。ファイルへ追記しつつ直近の行をリングバッファに保持する"""
+
+    def __init__(self, job_id: str, log_dir: str = DEPLOY_LOG_DIR, buffer_lines: int = DEPLOY_LOG_BUFFER_LINES):
+        self.path = os.path.join(log_dir, f"{job_id}.log")
+        self.line_count = 0
+        self.closed = False
+        self._buffer = deque(maxlen=buffer_lines)
+        self._file = None
+        self._cond = threading.Condition()
+
+    def write(self, line: str):
+        with self._cond:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, "a", buffering=1, encoding="utf-8")
+            self._file.write(line + "\n")
+            self._buffer.append((self.line_count, line))
+            self.line_count += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.closed = True
+            self._cond.notify_all()
+
+    def tail(self, n: int = DEPLOY_LOG_ERROR_TAIL_LINES):
+        """末尾n行を返す（バッファに収まらなければファイルから読む）"""
+        with self._cond:
+            if n <= len(self._buffer) or self.line_count <= len(self._buffer):
+                return [line for _, line in list(self._buffer)[-n:]] if n > 0 else []
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8", errors="replace") as f:
+            return [line.rstrip("\n") for line in deque(f, maxlen=n)]
+
+    def lines_after(self, seq: int, timeout: float):
+        """seq番目以降の行を返す（なければtimeout秒まで待機）。戻り値: (次のseq, 行リスト)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.line_count > seq or self.closed, timeout=timeout)
+            lines = [(i, line) for i, line in self._buffer if i >= seq]
+            if lines and lines[0][0] > seq:
+                # 読み出しが遅くバッファから押し出された行がある
+                lines.insert(0, (seq, f"... {lines[0][0] - seq} lines skipped ..."))
+            return self.line_count, [line for _, line in lines]
+
+    def follow(self, tail: int = 100, poll_seconds: float = 15):
+        """末尾tail行を出したあと、ログが閉じられるまで新しい行を流し続けるジェネレータ"""
+        for line in self.tail(tail):
+            yield line + "\n"
+        seq = self.line_count
+        while True:
+            seq, lines = self.lines_after(seq, poll_seconds)
+            for line in lines:
+                yield line + "\n"
+            if self.closed and seq >= self.line_count:
+                return
+
+    def delete(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def run_logged(cmd, log: DeployLog, cwd: str = None, on_line=None, env=None) -> int:
+    """コマンドを実行し、stdout/stderrを1行ずつログへ流す。終了コードを返す"""
+    log.write(f"$ {' '.join(cmd)}")
+    proc = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+    )
+    for line in proc.stdout:
+        line = line.rstrip("\n")
+        log.write(line)
+        if on_line is not None:
+            on_line(line)
+    returncode = proc.wait()
+    if returncode != 0:
+        logger.warning(f"Command failed (exit code {returncode}): {' '.join(cmd[:3])} ...")
+    return returncode
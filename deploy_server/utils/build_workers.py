@@ -0,0 +1,332 @@
+import base64
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.ecr_login import get_registry_credentials
+
+# リモートのビルドワーカー（build_worker.py）のURL。カンマ区切り
+BUILD_WORKERS = [url.strip().rstrip("/") for url in os.getenv("BUILD_WORKERS", "").split(",") if url.strip()]
+# このサーバー自身のDockerで同時に実行するビルド数（0ならリモートのみ）
+BUILD_LOCAL_CAPACITY = int(os.getenv("BUILD_LOCAL_CAPACITY", "2"))
+# ワーカーとの共有トークン（Authorization: Bearer）
+BUILD_WORKER_TOKEN = os.getenv("BUILD_WORKER_TOKEN")
+# ワーカーの状態（容量・稼働状況）を取り直す間隔と、応答しないワーカーを再確認するまでの秒数
+BUILD_WORKER_STATUS_TTL_SECONDS = int(os.getenv("BUILD_WORKER_STATUS_TTL_SECONDS", "30"))
+# 空いているワーカーを待つ上限（秒）
+BUILD_SLOT_TIMEOUT_SECONDS = int(os.getenv("BUILD_SLOT_TIMEOUT_SECONDS", "1800"))
+
+# ビルドコンテキストをワーカーへ送る際に含めないディレクトリ
+_CONTEXT_EXCLUDES = (".git",)
+
+
+def worker_headers() -> dict:
+    return {"Authorization": f"Bearer {BUILD_WORKER_TOKEN}"} if BUILD_WORKER_TOKEN else {}
+
+
+def encode_spec(spec: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(spec).encode()).decode()
+
+
+def decode_spec(value: str) -> dict:
+    return json.loads(base64.urlsafe_b64decode(value.encode()))
+
+
+class WorkerUnavailable(Exception):
+    """ワーカーに接続できない・満杯のためビルドを開始できなかった"""
+
+    def __init__(self, message: str, busy: bool = False):
+        super().__init__(message)
+        self.busy = busy
+
+
+class LocalExecutor:
+    """このサーバーのDockerでビルドする"""
+
+    is_local = True
+
+    def __init__(self, capacity: int):
+        self.name = "local"
+        self.capacity = capacity
+        self.running = 0
+        self.available = capacity > 0
+
+    def refresh(self):
+        pass
+
+    def build_and_push(self, builder, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo=None) -> dict:
+        return builder.build_and_push(job, context_dir, dockerfile, platform, image_repo, tags, cache_repo)
+
+    def stats(self) -> dict:
+        return {"name": self.name, "capacity": self.capacity, "running": self.running, "available": self.available}
+
+
+class RemoteExecutor:
+    """build_worker.pyのエージェントへビルドコンテキストを送り、ビルド・プッシュさせる
+
+    ビルドログとステージはNDJSONで逐次受け取り、ジョブのログ・イベントへ流す。
+    ECRの認証情報はワーカーのURLがhttpsのときだけこのサーバーで取得して渡す（ワーカーにAWS権限は不要）。
+    httpのワーカーには渡さず、ワーカー自身のAWS権限でログインさせる。
+    """
+
+    is_local = False
+
+    def __init__(self, url: str):
+        self.name = url
+        self.url = url
+        self.capacity = 0
+        self.running = 0
+        self.available = False
+        self.checked_at = 0.0
+        self.remote_running = 0
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """容量と稼働状況を取り直す（TTL内なら何もしない。同時に呼ばれたら先行の確認を待つ）"""
+        with self._refresh_lock:
+            if time.time() - self.checked_at < BUILD_WORKER_STATUS_TTL_SECONDS:
+                return
+            self._fetch_status()
+            self.checked_at = time.time()
+
+    def _fetch_status(self):
+        try:
+            response = requests.get(f"{self.url}/status", headers=worker_headers(), timeout=5)
+            response.raise_for_status()
+            status = response.json()
+            self.capacity = int(status["capacity"])
+            self.remote_running = int(status.get("running", 0))
+            if not self.available:
+                logger.info(f"Build worker available: {self.url} (capacity {self.capacity})")
+            self.available = True
+        except Exception as e:
+            if self.available:
+                logger.warning(f"Build worker unavailable: {self.url}: {e}")
+            self.available = False
+
+    def mark_unavailable(self):
+        self.available = False
+        self.checked_at = time.time()
+
+    def _check_free(self):
+        """コンテキストを送る前に、ワーカーが応答し空きがあるかを確かめる"""
+        with self._refresh_lock:
+            self._fetch_status()
+            self.checked_at = time.time()
+        if not self.available:
+            raise WorkerUnavailable(f"{self.url} did not respond to /status")
+        if self.remote_running >= self.capacity:
+            raise WorkerUnavailable(f"{self.url} is at capacity", busy=True)
+        # 取り直した稼働数にはこれから送るビルドが含まれない
+        self.remote_running += 1
+
+    def build_and_push(self, builder, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo=None) -> dict:
+        spec = {
+            "job_id": job.job_id,
+            "app_name": job.app_name,
+            "backend": builder.name,
+            "dockerfile": dockerfile,
+            "platform": platform,
+            "image_repo": image_repo,
+            "tags": tags,
+            "cache_repo": cache_repo,
+        }
+        self._check_free()
+        if self.url.startswith("https://"):
+            creds = get_registry_credentials()
+            spec["registry"] = {"server": creds["registry"], "username": creds["username"], "password": creds["password"]}
+        with tempfile.TemporaryFile() as archive:
+            _pack_context(context_dir, archive)
+            archive.seek(0)
+            try:
+                response = requests.post(
+                    f"{self.url}/builds",
+                    data=archive,
+                    headers={**worker_headers(), "Content-Type": "application/gzip", "X-Build-Spec": encode_spec(spec)},
+                    stream=True,
+                    timeout=(10, None),
+                )
+            except requests.ConnectionError as e:
+                raise WorkerUnavailable(f"{self.url}: {e}")
+        if response.status_code == 429:
+            raise WorkerUnavailable(f"{self.url} is at capacity", busy=True)
+        if response.status_code != 200:
+            raise HTTPException(status_code=502, detail=f"Build worker {self.url} returned {response.status_code}: {response.text[:500]}")
+
+        stages = {}
+        with response:
+            for raw in response.iter_lines(decode_unicode=True):
+                if not raw:
+                    continue
+                message = json.loads(raw)
+                kind = message["type"]
+                if kind == "log":
+                    job.log.write(message["line"])
+                elif kind == "stage":
+                    _forward_stage(job, message, stages)
+                elif kind == "error":
+                    raise HTTPException(status_code=message.get("status_code", 500), detail=message["detail"])
+                elif kind == "result":
+                    return {**message["result"], "executor": self.url}
+        raise HTTPException(status_code=502, detail=f"Build worker {self.url} closed the stream without a result")
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "capacity": self.capacity,
+            "running": self.running,
+            "remote_running": self.remote_running,
+            "available": self.available,
+        }
+
+
+def _pack_context(context_dir: str, fileobj):
+    def exclude(info):
+        parts = info.name.split("/")
+        return None if any(part in _CONTEXT_EXCLUDES for part in parts) else info
+
+    with tarfile.open(fileobj=fileobj, mode="w:gz") as tar:
+        tar.add(context_dir, arcname=".", filter=exclude)
+
+
+def _forward_stage(job, message: dict, stages: dict):
+    """ワーカーのステージ開始・完了をジョブのイベントと所要時間に反映する"""
+    name, status = message["stage"], message["status"]
+    if status == "started":
+        stages[name] = time.perf_counter()
+        job.enter_stage(name)
+        job.emit(name, "started", worker=message.get("worker"))
+        return
+    duration = message.get("duration_seconds")
+    if duration is None and name in stages:
+        duration = round(time.perf_counter() - stages[name], 3)
+    if status in ("completed", "failed"):
+        job.leave_stage(name)
+        if duration is not None:
+            job.record_timing(name, duration, status)
+    job.emit(name, status, message.get("message"), duration_seconds=duration)
+
+
+def _load(executor) -> int:
+    # リモートは他のサーバーからのビルドも含めた稼働数で比べる
+    return max(executor.running, getattr(executor, "remote_running", 0))
+
+
+class BuildPool:
+    """ローカルとリモートのビルド実行先をまとめ、最も空いている実行先へビルドを割り当てる
+
+    負荷は実行中のビルド数/容量で比べ、全実行先が満杯なら空きが出るまで待つ。
+    リモートの稼働数は他のサーバーからのビルドも含み、/statusで取り直すまではこのサーバーの増減で見積もる。
+    """
+
+    def __init__(self, local_capacity: int = BUILD_LOCAL_CAPACITY, worker_urls=BUILD_WORKERS):
+        self.local = LocalExecutor(local_capacity) if local_capacity > 0 else None
+        self.executors = ([self.local] if self.local else []) + [RemoteExecutor(url) for url in worker_urls]
+        self._cond = threading.Condition()
+        self.counters = {"local_builds": 0, "remote_builds": 0, "waits": 0, "worker_failures": 0}
+
+    def _pick(self, exclude):
+        # ロック取得済みの状態で呼ぶこと
+        candidates = [
+            e for e in self.executors
+            if e.available and e not in exclude and _load(e) < e.capacity
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: (_load(e) / e.capacity, not e.is_local))
+
+    @contextmanager
+    def slot(self, job, exclude=(), timeout: float = BUILD_SLOT_TIMEOUT_SECONDS):
+        """空いている実行先を1つ確保する（待ち時間はbuild_queueステージとして記録）"""
+        with job.stage("build_queue"):
+            executor = self._acquire(job, exclude, timeout)
+            job.emit("build_queue", "info", f"Building on {executor.name}")
+        try:
+            yield executor
+        finally:
+            with self._cond:
+                executor.running -= 1
+                if not executor.is_local:
+                    executor.remote_running = max(executor.remote_running - 1, 0)
+                self._cond.notify_all()
+
+    def _acquire(self, job, exclude, timeout):
+        for executor in self.executors:
+            executor.refresh()
+        deadline = time.time() + timeout
+        waited = False
+        with self._cond:
+            while True:
+                executor = self._pick(exclude)
+                if executor is not None:
+                    executor.running += 1
+                    if not executor.is_local:
+                        executor.remote_running += 1
+                    return executor
+                if not any(e.available for e in self.executors if e not in exclude):
+                    raise HTTPException(status_code=503, detail="No build executor available")
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise HTTPException(status_code=503, detail="Timed out waiting for a free build executor")
+                if not waited:
+                    waited = True
+                    self.counters["waits"] += 1
+                    job.emit("build_queue", "info", "All build executors are busy; waiting for a free slot")
+                self._cond.wait(min(remaining, BUILD_WORKER_STATUS_TTL_SECONDS))
+                # 停止していたワーカーの復帰を拾うため、ロックを外して状態を取り直す
+                self._cond.release()
+                try:
+                    for e in self.executors:
+                        e.refresh()
+                finally:
+                    self._cond.acquire()
+
+    def build_and_push(self, builder, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo=None,
+                       before_local=None) -> dict:
+        """空いている実行先でビルド・プッシュし、{"backend", "digest", "cache", "executor"} を返す
+
+        接続できないリモートワーカーは除外して別の実行先で再試行する。
+        満杯（429）のワーカーは次に状態を取り直すまで満杯として扱い、空きが出るまで待つ。
+        before_localはローカルで実行する直前に呼ぶ（docker loginなど）。
+        """
+        failed = []
+        while True:
+            busy = None
+            with self.slot(job, exclude=failed) as executor:
+                try:
+                    if executor.is_local:
+                        if before_local:
+                            before_local()
+                        self.counters["local_builds"] += 1
+                        build = executor.build_and_push(builder, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo)
+                        return {**build, "executor": executor.name}
+                    self.counters["remote_builds"] += 1
+                    return executor.build_and_push(builder, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo)
+                except WorkerUnavailable as e:
+                    self.counters["worker_failures"] += 1
+                    logger.warning(f"Build worker could not start the build: {e}")
+                    job.emit("build_queue", "info", f"Retrying on another executor: {e}")
+                    if e.busy:
+                        busy = executor
+                    else:
+                        executor.mark_unavailable()
+                        failed.append(executor)
+            if busy is not None:
+                # 他のサーバーのビルドで埋まっている。除外はせず、次のrefreshまで満杯として空きを待つ
+                with self._cond:
+                    busy.remote_running = busy.capacity
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"executors": [e.stats() for e in self.executors], **self.counters}
+
+
+build_pool = BuildPool()
@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import subprocess
+import tempfile
+
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.build_logs import run_logged, DEPLOY_LOG_ERROR_TAIL_LINES
+from utils.ecr_login import invalidate_registry_login
+
+# デフォルトのビルドバックエンド（docker | buildx）
+BUILD_BACKEND = os.getenv("BUILD_BACKEND", "docker")
+# buildxで使うビルダー名（レジストリへのキャッシュ出力にはdocker-containerドライバが必要）
+BUILDX_BUILDER = os.getenv("BUILDX_BUILDER")
+# レイヤーキャッシュ用ECRリポジトリ名のサフィックス（{app_name}{suffix}）
+BUILD_CACHE_REPO_SUFFIX = os.getenv("BUILD_CACHE_REPO_SUFFIX", "-buildcache")
+BUILD_CACHE_TAG = "buildcache"
+
+# BuildKitのステップ行（"#5 [2/6] RUN ..."）とキャッシュ行（"#5 CACHED"）
+_BUILDKIT_STEP_RE = re.compile(r"^#(\d+) \[[^\]]+\] ")
+_BUILDKIT_CACHED_RE = re.compile(r"^#(\d+) CACHED")
+# 従来ビルダーのステップ行とキャッシュ行
+_LEGACY_STEP_RE = re.compile(r"^Step \d+/\d+ : ")
+_LEGACY_CACHED_RE = re.compile(r"^ ---> Using cache")
+# docker pushの最終行（"latest: digest: sha256:... size: 1234"）
+_PUSH_DIGEST_RE = re.compile(r"digest: (sha256:[0-9a-f]{64})")
+
+
+class CacheStatsParser:
+    """ビルド出力を1行ずつ受け取り、ステップ数とキャッシュヒット数を集計"""
+
+    def __init__(self):
+        self.steps, self.cached = set(), set()
+        self.legacy_steps = self.legacy_cached = 0
+
+    def feed(self, line: str):
+        m = _BUILDKIT_STEP_RE.match(line)
+        if m:
+            self.steps.add(m.group(1))
+            return
+        m = _BUILDKIT_CACHED_RE.match(line)
+        if m:
+            self.cached.add(m.group(1))
+            return
+        if _LEGACY_STEP_RE.match(line):
+            self.legacy_steps += 1
+        elif _LEGACY_CACHED_RE.match(line):
+            self.legacy_cached += 1
+
+    def result(self) -> dict:
+        total = len(self.steps) + self.legacy_steps
+        hits = len(self.cached & self.steps) + self.legacy_cached
+        return {
+            "steps": total,
+            "cached_steps": hits,
+            "hit_ratio": round(hits / total, 3) if total else None,
+        }
+
+
+def _command_failed(job, what: str, returncode: int) -> HTTPException:
+    # ログ全体ではなく末尾の数行だけをエラー詳細に含める
+    tail = "\n".join(job.log.tail(DEPLOY_LOG_ERROR_TAIL_LINES))
+    return HTTPException(
+        status_code=500,
+        detail=(
+            f"{what} failed (exit code {returncode})\n"
+            f"last {DEPLOY_LOG_ERROR_TAIL_LINES} log lines (full log: /deploy/{job.job_id}/logs):\n{tail}"
+        ),
+    )
+
+
+class DockerBuilder:
+    """従来どおり docker build → docker tag → docker push を行うバックエンド"""
+
+    name = "docker"
+    uses_registry_cache = False
+
+    def build_and_push(self, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo=None) -> dict:
+        local_ref = f"{job.app_name}:{tags[0]}"
+        parser = CacheStatsParser()
+        with job.stage("build"):
+            returncode = run_logged(
+                ["docker", "build", "--platform", platform, "-t", local_ref, "-f", dockerfile, "."],
+                job.log,
+                cwd=context_dir,
+                on_line=parser.feed,
+            )
+            if returncode != 0:
+                raise _command_failed(job, f"{self.name} build", returncode)
+            cache = parser.result()
+
+        digests = []
+
+        def find_digest(line):
+            m = _PUSH_DIGEST_RE.search(line)
+            if m:
+                digests.append(m.group(1))
+
+        with job.stage("push"):
+            for tag in tags:
+                subprocess.check_call(["docker", "tag", local_ref, f"{image_repo}:{tag}"])
+                returncode = run_logged(["docker", "push", f"{image_repo}:{tag}"], job.log, on_line=find_digest)
+                if returncode != 0:
+                    # 認証切れの可能性があるため次回は再ログインさせる
+                    invalidate_registry_login()
+                    raise _command_failed(job, "docker push", returncode)
+
+        return {"backend": self.name, "digest": digests[0] if digests else None, "cache": cache}
+
+
+class BuildxBuilder:
+    """docker buildx build --push でビルドとプッシュを1回で行い、ECRにレイヤーキャッシュを保存するバックエンド"""
+
+    name = "buildx"
+    uses_registry_cache = True
+
+    def build_and_push(self, job, context_dir, dockerfile, platform, image_repo, tags, cache_repo=None) -> dict:
+        with tempfile.TemporaryDirectory(prefix="buildx-meta-") as meta_dir:
+            metadata_file = os.path.join(meta_dir, "metadata.json")
+            cmd = ["docker", "buildx", "build"]
+            if BUILDX_BUILDER:
+                cmd += ["--builder", BUILDX_BUILDER]
+            cmd += ["--platform", platform, "-f", dockerfile, "--progress=plain"]
+            for tag in tags:
+                cmd += ["-t", f"{image_repo}:{tag}"]
+            if cache_repo:
+                cache_ref = f"{cache_repo}:{BUILD_CACHE_TAG}"
+                cmd += [
+                    "--cache-from", f"type=registry,ref={cache_ref}",
+                    # ECRはimage-manifest形式のキャッシュのみ受け付ける
+                    "--cache-to", f"type=registry,ref={cache_ref},mode=max,image-manifest=true,oci-mediatypes=true",
+                ]
+            cmd += ["--push", "--metadata-file", metadata_file, "."]
+
+            parser = CacheStatsParser()
+            with job.stage("build"):
+                returncode = run_logged(cmd, job.log, cwd=context_dir, on_line=parser.feed)
+                if returncode != 0:
+                    invalidate_registry_login()
+                    raise _command_failed(job, f"{self.name} build", returncode)
+                cache = parser.result()
+
+            digest = None
+            try:
+                with open(metadata_file) as f:
+                    digest = json.load(f).get("containerimage.digest")
+            except Exception as e:
+                logger.warning(f"Could not read buildx metadata: {e}")
+
+        return {"backend": self.name, "digest": digest, "cache": cache}
+
+
+BUILDERS = {
+    DockerBuilder.name: DockerBuilder,
+    BuildxBuilder.name: BuildxBuilder,
+}
+
+
+def get_builder(name: str = None):
+    """名前（未指定ならBUILD_BACKEND）からビルドバックエンドを返す"""
+    name = name or BUILD_BACKEND
+    builder_cls = BUILDERS.get(name)
+    if builder_cls is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown build backend: {name} (available: {', '.join(BUILDERS)})",
+        )
+    return builder_cls()
@@ -0,0 +1,241 @@
+import os
+import threading
+import time
+
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.clients import get_client
+from utils.common import CLUSTER_NAME
+from utils.waiters import DESCRIBE_SERVICES_BATCH
+
+# Spotの中断を確認する間隔（秒）。0なら監視しない（Fargate Spotを使う場合に設定する）
+SPOT_MONITOR_INTERVAL_SECONDS = int(os.getenv("SPOT_MONITOR_INTERVAL_SECONDS", "0"))
+# 中断でタスク数が足りなくなったサービスをオンデマンドで動かし続ける秒数（その間に中断があれば延長）
+SPOT_FALLBACK_SECONDS = int(os.getenv("SPOT_FALLBACK_SECONDS", "1800"))
+
+ON_DEMAND, SPOT = "FARGATE", "FARGATE_SPOT"
+# describe_tasksで1回に指定できるタスク数
+_DESCRIBE_TASKS_BATCH = 100
+# 中断したタスクのstopCode
+_SPOT_INTERRUPTION = "SpotInterruption"
+
+
+def capacity_strategy(capacity) -> list:
+    """DeployRequest.capacityをECSのcapacityProviderStrategyに変換する"""
+    strategy = []
+    if capacity.on_demand_weight or capacity.on_demand_base:
+        strategy.append({"capacityProvider": ON_DEMAND, "weight": capacity.on_demand_weight, "base": capacity.on_demand_base})
+    if capacity.spot_weight:
+        strategy.append({"capacityProvider": SPOT, "weight": capacity.spot_weight, "base": 0})
+    return strategy
+
+
+def validate_capacity(capacity, architecture: str):
+    """配分の誤りを400で返す（Fargate SpotはARM64で使えない）"""
+    if not 0 <= capacity.on_demand_weight <= 1000 or not 0 <= capacity.spot_weight <= 1000:
+        raise HTTPException(status_code=400, detail="capacity weights must be between 0 and 1000")
+    if not 0 <= capacity.on_demand_base <= 100000:
+        raise HTTPException(status_code=400, detail="capacity.on_demand_base must be between 0 and 100000")
+    if capacity.on_demand_weight + capacity.spot_weight == 0:
+        raise HTTPException(status_code=400, detail="capacity requires on_demand_weight or spot_weight greater than 0")
+    if capacity.spot_weight and architecture != "amd64":
+        raise HTTPException(status_code=400, detail="Fargate Spot does not support ARM64; use architecture=amd64")
+
+
+def _normalized(strategy) -> list:
+    return sorted((s["capacityProvider"], s.get("weight", 0), s.get("base", 0)) for s in strategy or [])
+
+
+def strategy_differs(service: dict, strategy: list) -> bool:
+    """サービスの現在の配分（launchTypeで動いていれば未設定扱い）とstrategyが異なるか"""
+    return _normalized(service.get("capacityProviderStrategy")) != _normalized(strategy)
+
+
+def describe_capacity(service_name: str) -> dict:
+    """サービスが何で動いているか（配分と、実行中のタスクのキャパシティプロバイダーごとの数）"""
+    ecs = get_client("ecs")
+    services = ecs.describe_services(cluster=CLUSTER_NAME, services=[service_name])["services"]
+    if not services:
+        return {}
+    service = services[0]
+    arns = ecs.list_tasks(cluster=CLUSTER_NAME, serviceName=service_name, desiredStatus="RUNNING")["taskArns"]
+    running = {}
+    for i in range(0, len(arns), _DESCRIBE_TASKS_BATCH):
+        for task in ecs.describe_tasks(cluster=CLUSTER_NAME, tasks=arns[i:i + _DESCRIBE_TASKS_BATCH])["tasks"]:
+            provider = task.get("capacityProviderName") or task.get("launchType") or ON_DEMAND
+            running[provider] = running.get(provider, 0) + 1
+    return {
+        "launch_type": service.get("launchType"),
+        "capacity_provider_strategy": service.get("capacityProviderStrategy") or None,
+        "running_tasks": running,
+        "spot_fallback": spot_monitor.fallback_for(service_name),
+    }
+
+
+class SpotInterruptionMonitor:
+    """Fargate Spotのタスクの中断を検知し、タスク数が足りなくなったサービスをオンデマンドへ寄せる
+
+    中断されたタスクはECSが自動で置き換えるが、Spotの容量が無いと置き換え先が決まらずタスク数が減ったままになる。
+    中断の後でrunningCountがdesiredCountを下回っていれば、配分を一時的にFARGATEだけにして
+    SPOT_FALLBACK_SECONDSの間中断が起きなければ元の配分へ戻す。
+    元の配分はstore（デプロイレジストリ）に保存し、サーバーを再起動しても戻せるようにする。
+    """
+
+    def __init__(self, interval: float = SPOT_MONITOR_INTERVAL_SECONDS, fallback_seconds: float = SPOT_FALLBACK_SECONDS):
+        self.interval = interval
+        self.fallback_seconds = fallback_seconds
+        # デプロイ中のアプリ名を返す関数（main.pyでジョブキューを渡す）
+        self.busy_apps = set
+        # 元の配分を保存する先（main.pyでデプロイレジストリを渡す）
+        self.store = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._seen = {}        # 確認済みの停止タスクARN -> stoppedAt
+        self._fallbacks = {}   # サービス名 -> {"strategy": 元の配分, "until": 戻す時刻}
+        self.interruptions = {}
+        self.last_check = None
+
+    def start(self, busy_apps=None, store=None):
+        """保存済みのオンデマンドへの切り替えを読み込み、一定間隔でcheck()を実行するデーモンスレッドを起動する"""
+        if busy_apps is not None:
+            self.busy_apps = busy_apps
+        if store is not None:
+            self.store = store
+            fallbacks = store.spot_fallbacks()
+            with self._lock:
+                self._fallbacks.update(fallbacks)
+            if fallbacks:
+                logger.info(f"Restored Fargate Spot fallbacks: {', '.join(sorted(fallbacks))}")
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.check()
+                except Exception as e:
+                    logger.warning(f"Spot interruption check failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="spot-monitor", daemon=True)
+        self._thread.start()
+
+    def fallback_for(self, service_name: str):
+        with self._lock:
+            fallback = self._fallbacks.get(service_name)
+            return {"original_strategy": fallback["strategy"], "until": fallback["until"]} if fallback else None
+
+    def original_strategy(self, service_name: str, strategy: list) -> list:
+        """オンデマンドへ寄せている間はその前の配分を、そうでなければstrategyを返す"""
+        fallback = self.fallback_for(service_name)
+        return fallback["original_strategy"] if fallback else strategy
+
+    def forget(self, service_name: str):
+        """デプロイで配分を指定し直したサービスは元の配分へ戻さない"""
+        with self._lock:
+            removed = self._fallbacks.pop(service_name, None)
+        if removed and self.store:
+            self.store.delete_spot_fallback(service_name)
+
+    def _remember(self, service_name: str, strategy: list, until: float):
+        with self._lock:
+            self._fallbacks[service_name] = {"strategy": strategy, "until": until}
+        if self.store:
+            self.store.save_spot_fallback(service_name, strategy, until)
+
+    def _interrupted_tasks(self, ecs) -> list:
+        # ECSは停止したタスクを1時間ほど返すため、確認済みのものは除いてdescribeする
+        arns = []
+        for page in ecs.get_paginator("list_tasks").paginate(cluster=CLUSTER_NAME, desiredStatus="STOPPED"):
+            arns.extend(arn for arn in page["taskArns"] if arn not in self._seen)
+        interrupted = []
+        now = time.time()
+        for i in range(0, len(arns), _DESCRIBE_TASKS_BATCH):
+            for task in ecs.describe_tasks(cluster=CLUSTER_NAME, tasks=arns[i:i + _DESCRIBE_TASKS_BATCH])["tasks"]:
+                self._seen[task["taskArn"]] = now
+                if task.get("stopCode") == _SPOT_INTERRUPTION:
+                    interrupted.append(task)
+        self._seen = {arn: at for arn, at in self._seen.items() if now - at < 7200}
+        return interrupted
+
+    def check(self) -> dict:
+        """中断を集計し、必要ならオンデマンドへの切り替え・元の配分への復帰を行う"""
+        ecs = get_client("ecs")
+        now = time.time()
+        interrupted = {}
+        for task in self._interrupted_tasks(ecs):
+            group = task.get("group", "")
+            if group.startswith("service:"):
+                name = group.split(":", 1)[1]
+                interrupted[name] = interrupted.get(name, 0) + 1
+        for name, count in interrupted.items():
+            self.interruptions[name] = self.interruptions.get(name, 0) + count
+            logger.warning(f"{count} Fargate Spot task(s) of {name} were interrupted")
+
+        busy = set(self.busy_apps())
+        with self._lock:
+            fallbacks = dict(self._fallbacks)
+        names = sorted(set(interrupted) | set(fallbacks))
+        services = {}
+        for i in range(0, len(names), DESCRIBE_SERVICES_BATCH):
+            for service in ecs.describe_services(cluster=CLUSTER_NAME, services=names[i:i + DESCRIBE_SERVICES_BATCH])["services"]:
+                if service["status"] == "ACTIVE":
+                    services[service["serviceName"]] = service
+        for name in fallbacks:
+            if name not in services:
+                # 削除されたサービスの切り替えは保存したままにしない
+                self.forget(name)
+
+        moved, restored = [], []
+        for name, service in services.items():
+            # blue/greenのgreenスロットも含め、デプロイ中のアプリには触らない
+            if name in busy or name.removesuffix("-green") in busy:
+                continue
+            strategy = service.get("capacityProviderStrategy") or []
+            if name in fallbacks:
+                if name in interrupted:
+                    self._remember(name, fallbacks[name]["strategy"], now + self.fallback_seconds)
+                elif now >= fallbacks[name]["until"]:
+                    self._update(ecs, name, fallbacks[name]["strategy"])
+                    self.forget(name)
+                    restored.append(name)
+                continue
+            uses_spot = any(s["capacityProvider"] == SPOT and s.get("weight") for s in strategy)
+            if name in interrupted and uses_spot and service["runningCount"] < service["desiredCount"]:
+                base = max((s.get("base", 0) for s in strategy), default=0)
+                self._update(ecs, name, [{"capacityProvider": ON_DEMAND, "weight": 1, "base": base}])
+                self._remember(name, strategy, now + self.fallback_seconds)
+                moved.append(name)
+
+        if moved:
+            logger.warning(f"Moved to on-demand Fargate after Spot interruptions: {', '.join(moved)}")
+        if restored:
+            logger.info(f"Restored Fargate Spot capacity strategy: {', '.join(restored)}")
+        self.last_check = {
+            "at": now,
+            "interrupted": interrupted,
+            "moved_to_on_demand": moved,
+            "restored": restored,
+        }
+        return self.last_check
+
+    @staticmethod
+    def _update(ecs, service_name: str, strategy: list):
+        # 配分の変更はタスクを置き換えないと反映されない
+        ecs.update_service(
+            cluster=CLUSTER_NAME, service=service_name, capacityProviderStrategy=strategy, forceNewDeployment=True,
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            fallbacks = {name: {"until": f["until"]} for name, f in self._fallbacks.items()}
+        return {
+            "interval_seconds": self.interval,
+            "interruptions": dict(self.interruptions),
+            "fallbacks": fallbacks,
+            "last_check": self.last_check,
+        }
+
+
+spot_monitor = SpotInterruptionMonitor()
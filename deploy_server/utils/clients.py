@@ -0,0 +1,54 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from loguru import logger
+
+from utils.common import AWS_REGION
+
+# 1クライアントあたりのHTTP接続プールサイズ（同時デプロイ数に合わせて調整）
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+# adaptiveリトライモードの最大試行回数
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "10"))
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+
+
+def _client_config() -> Config:
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        retries={"mode": "adaptive", "max_attempts": AWS_MAX_ATTEMPTS},
+    )
+
+
+def get_session() -> boto3.session.Session:
+    """共有クライアントの生成元のSession（イベントハンドラーを登録すると以降に作るクライアントへ反映される）"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_client(service: str, region: str = None):
+    """サービス・リージョンごとに1つだけ作成した共有boto3クライアントを返す
+
+    boto3のクライアントはスレッドセーフだが、Sessionからの生成はそうではないため
+    生成時のみロックを取る。
+    """
+    key = (service, region or AWS_REGION)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    session = get_session()
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = session.client(service, region_name=key[1], config=_client_config())
+            _clients[key] = client
+            logger.debug(f"Created shared boto3 client: {service} ({key[1]})")
+    return client
+
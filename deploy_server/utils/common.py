@@ -1,8 +1,10 @@
 import os
 import json
+import threading
+from dataclasses import dataclass, asdict
 from pathlib import Path
+from typing import Optional, Tuple
 from loguru import logger
-import boto3
 from dotenv import load_dotenv
 from botocore.exceptions import ClientError
 
@@ -40,40 +42,76 @@ TERRAFORM_STATE_PATH = os.getenv(
     "terraform/environments/base-infrastructure/terraform.tfstate"
 )
 
-def load_terraform_outputs():
-    """Terraform状態ファイルからoutputを読み込み"""
+# Terraform outputのキャッシュ（状態ファイルのmtime・サイズが変わった時だけ再読込）
+_tf_cache_lock = threading.Lock()
+_tf_cache = {"signature": None, "outputs": {}}
+_tf_cache_stats = {"hits": 0, "misses": 0}
+
+def get_terraform_state_file_path() -> Path:
+    """Terraform状態ファイルの絶対パスを返す"""
+    # 絶対パスと相対パスの両方に対応
+    if os.path.isabs(TERRAFORM_STATE_PATH):
+        # .envで絶対パスが指定されていればそのまま使う
+        return Path(TERRAFORM_STATE_PATH).resolve()
+    # 相対パスの場合、main.pyの親（プロジェクトルート）からの相対パス
+    project_root = Path(__file__).resolve().parent.parent
+    return (project_root / TERRAFORM_STATE_PATH).resolve()
+
+def _terraform_state_signature(state_file_path: Path):
     try:
-        # 絶対パスと相対パスの両方に対応
-        if os.path.isabs(TERRAFORM_STATE_PATH):
-            # .envで絶対パスが指定されていればそのまま使う
-            state_file_path = Path(TERRAFORM_STATE_PATH).resolve()
-            logger.debug(f"Using absolute path for terraform state: {state_file_path}")
-        else:
-            # 相対パスの場合、main.pyの親（プロジェクトルート）からの相対パス
-            project_root = Path(__file__).resolve().parent.parent
-            state_file_path = (project_root / TERRAFORM_STATE_PATH).resolve()
-            logger.debug(f"Using relative path for terraform state: {state_file_path}")
-        
-        if not state_file_path.exists():
-            logger.warning(f"Terraform state file not found at {state_file_path}")
-            return {}
-        
+        stat = state_file_path.stat()
+    except FileNotFoundError:
+        return None
+    return (str(state_file_path), stat.st_mtime_ns, stat.st_size)
+
+def _load_terraform_outputs_cached():
+    """(状態ファイルのシグネチャ, outputs) を返す。変更がなければ再パースしない"""
+    state_file_path = get_terraform_state_file_path()
+    signature = _terraform_state_signature(state_file_path)
+
+    if signature is None:
+        logger.warning(f"Terraform state file not found at {state_file_path}")
+        return None, {}
+
+    with _tf_cache_lock:
+        if _tf_cache["signature"] == signature:
+            _tf_cache_stats["hits"] += 1
+            return signature, _tf_cache["outputs"]
+
+        _tf_cache_stats["misses"] += 1
         with open(state_file_path, 'r') as f:
             state_data = json.load(f)
-        
+
         outputs = {}
         if 'outputs' in state_data:
             for key, output in state_data['outputs'].items():
                 outputs[key] = output['value']
-        
-        logger.info(f"Loaded Terraform outputs from {state_file_path}")
-        logger.debug(f"Available outputs: {list(outputs.keys())}")
-        return outputs
-        
+
+        _tf_cache["signature"] = signature
+        _tf_cache["outputs"] = outputs
+
+    logger.info(f"Loaded Terraform outputs from {state_file_path}")
+    logger.debug(f"Available outputs: {list(outputs.keys())}")
+    return signature, outputs
+
+def load_terraform_outputs():
+    """Terraform状態ファイルからoutputを読み込み（変更がなければキャッシュを返す）"""
+    try:
+        _, outputs = _load_terraform_outputs_cached()
+        return dict(outputs)
     except Exception as e:
         logger.error(f"Error loading Terraform outputs: {e}")
         return {}
 
+def get_terraform_cache_stats():
+    """Terraform outputキャッシュのヒット・ミス回数"""
+    with _tf_cache_lock:
+        return {
+            "hits": _tf_cache_stats["hits"],
+            "misses": _tf_cache_stats["misses"],
+            "state_file_signature": _tf_cache["signature"],
+        }
+
 def get_config_value(env_key: str, tf_output_key: str = None, default: str = None):
     """環境変数 > Terraform output > デフォルト値 の優先順位で設定値を取得"""
     env_value = os.getenv(env_key)
@@ -91,22 +129,104 @@ def get_config_value(env_key: str, tf_output_key: str = None, default: str = Non
     
     raise ValueError(f"Configuration value not found: env_key={env_key}, tf_output_key={tf_output_key}")
 
+def _split_ids(value) -> Tuple[str, ...]:
+    if not value:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(str(v).strip() for v in value if str(v).strip())
+    return tuple(s.strip() for s in str(value).split(",") if s.strip())
+
+@dataclass(frozen=True)
+class ResolvedConfig:
+    """環境変数とTerraform outputを解決済みの設定スナップショット"""
+    aws_region: str
+    cluster_name: str
+    alb_arn: Optional[str]
+    alb_dns_name: Optional[str]
+    alb_listener_arn: Optional[str]
+    vpc_id: Optional[str]
+    ecs_cluster_name: str
+    ecs_task_execution_role_arn: Optional[str]
+    ecs_task_role_arn: Optional[str]
+    ecs_security_group_id: Optional[str]
+    alb_security_group_id: Optional[str]
+    private_subnet_ids: Tuple[str, ...]
+    subnets: Tuple[str, ...]
+    security_groups: Tuple[str, ...]
+
+    def require(self, field: str):
+        """必須の設定値を取得（未設定ならValueError）"""
+        value = getattr(self, field)
+        if not value:
+            raise ValueError(f"Configuration value not found: {field}")
+        return value
+
+    def to_dict(self):
+        return asdict(self)
+
+# 解決済みスナップショットのキャッシュ（状態ファイルと関連環境変数が同じなら再利用）
+_CONFIG_ENV_KEYS = (
+    "ALB_ARN", "ALB_DNS_NAME", "ALB_LISTENER_ARN", "VPC_ID", "ECS_CLUSTER_NAME",
+    "ECS_TASK_EXECUTION_ROLE_ARN", "ECS_TASK_ROLE_ARN", "ECS_SECURITY_GROUP_ID",
+    "ALB_SECURITY_GROUP_ID", "SUBNETS", "SECURITY_GROUPS",
+)
+_resolved_lock = threading.Lock()
+_resolved_cache = {"key": None, "config": None}
+
+def _build_resolved_config(tf_outputs: dict) -> ResolvedConfig:
+    def value(env_key, tf_output_key, default=None):
+        return os.getenv(env_key) or tf_outputs.get(tf_output_key) or default
+
+    private_subnet_ids = _split_ids(tf_outputs.get("private_subnet_ids", []))
+    # SUBNETSが設定されていればそれを使用、なければprivate_subnet_idsから取得
+    subnets = _split_ids(os.getenv("SUBNETS")) or private_subnet_ids
+    # セキュリティグループも同様に取得
+    ecs_sg_id = value("ECS_SECURITY_GROUP_ID", "ecs_security_group_id")
+    security_groups = _split_ids(value("SECURITY_GROUPS", "ecs_security_group_id") or ecs_sg_id)
+
+    return ResolvedConfig(
+        aws_region=AWS_REGION,
+        cluster_name=CLUSTER_NAME,
+        alb_arn=value("ALB_ARN", "alb_arn"),
+        alb_dns_name=value("ALB_DNS_NAME", "alb_dns_name"),
+        alb_listener_arn=value("ALB_LISTENER_ARN", "alb_listener_arn"),
+        vpc_id=value("VPC_ID", "vpc_id"),
+        ecs_cluster_name=value("ECS_CLUSTER_NAME", "ecs_cluster_name", CLUSTER_NAME),
+        ecs_task_execution_role_arn=value("ECS_TASK_EXECUTION_ROLE_ARN", "ecs_task_execution_role_arn"),
+        ecs_task_role_arn=value("ECS_TASK_ROLE_ARN", "ecs_task_role_arn"),
+        ecs_security_group_id=ecs_sg_id,
+        alb_security_group_id=value("ALB_SECURITY_GROUP_ID", "alb_security_group_id"),
+        private_subnet_ids=private_subnet_ids,
+        subnets=subnets,
+        security_groups=security_groups,
+    )
+
+def get_resolved_config() -> ResolvedConfig:
+    """プロセス全体で共有する解決済み設定を返す（Terraform状態が変わった時だけ再構築）"""
+    try:
+        signature, tf_outputs = _load_terraform_outputs_cached()
+    except Exception as e:
+        logger.error(f"Error loading Terraform outputs: {e}")
+        signature, tf_outputs = None, {}
+    key = (signature, tuple(os.getenv(k) for k in _CONFIG_ENV_KEYS))
+    with _resolved_lock:
+        if _resolved_cache["key"] == key and _resolved_cache["config"] is not None:
+            return _resolved_cache["config"]
+        config = _build_resolved_config(tf_outputs)
+        _resolved_cache["key"] = key
+        _resolved_cache["config"] = config
+        return config
+
 def ensure_security_group_rules():
     """ECSセキュリティグループに必要なルールを追加"""
+    from utils.clients import get_client
     try:
-        ec2 = boto3.client("ec2", region_name=AWS_REGION)
+        ec2 = get_client("ec2")
         
         # セキュリティグループIDを取得
-        ecs_sg_id = get_config_value("ECS_SECURITY_GROUP_ID", "ecs_security_group_id", None)
-        alb_sg_id = get_config_value("ALB_SECURITY_GROUP_ID", "alb_security_group_id", None)
-        
-        if not ecs_sg_id:
-            logger.warning("ECS Security Group ID not found - checking Terraform outputs for ecs_tasks security group")
-            tf_outputs = load_terraform_outputs()
-            # aws_security_group.ecs_tasksのIDを探す
-            if 'resources' in load_terraform_outputs():
-                # この場合は別の方法でSGを見つける必要がある
-                pass
+        config = get_resolved_config()
+        ecs_sg_id = config.ecs_security_group_id
+        alb_sg_id = config.alb_security_group_id
         
         if not ecs_sg_id or not alb_sg_id:
             logger.warning("Security Group IDs not configured - skipping rule setup")
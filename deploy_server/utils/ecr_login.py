@@ -0,0 +1,83 @@
+import base64
+import datetime
+import os
+import subprocess
+import threading
+
+from loguru import logger
+
+from utils.common import AWS_REGION
+from utils.clients import get_client
+
+# トークン有効期限のこの秒数前になったら再取得する（ECRトークンの有効期間は12時間）
+ECR_LOGIN_REFRESH_MARGIN_SECONDS = int(os.getenv("ECR_LOGIN_REFRESH_MARGIN_SECONDS", "1800"))
+
+_lock = threading.Lock()
+_logins = {}
+
+
+def _is_fresh(login) -> bool:
+    if not login:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    margin = datetime.timedelta(seconds=ECR_LOGIN_REFRESH_MARGIN_SECONDS)
+    return login["expires_at"] - margin > now
+
+
+def get_registry_credentials(region: str = None) -> dict:
+    """ECR認証トークンをboto3で取得し、期限が近づくまでキャッシュして返す
+
+    戻り値: {"registry", "username", "password", "expires_at", "refreshed"}
+    """
+    region = region or AWS_REGION
+    with _lock:
+        login = _logins.get(region)
+        if _is_fresh(login):
+            return dict(login, refreshed=False)
+
+        auth = get_client("ecr", region).get_authorization_token()["authorizationData"][0]
+        username, password = base64.b64decode(auth["authorizationToken"]).decode().split(":", 1)
+        registry = auth["proxyEndpoint"].replace("https://", "").replace("http://", "")
+        login = {
+            "registry": registry,
+            "username": username,
+            "password": password,
+            "expires_at": auth["expiresAt"],
+            "docker_logged_in": False,
+        }
+        _logins[region] = login
+        logger.info(f"Fetched ECR authorization token for {registry} (expires at {login['expires_at']})")
+        return dict(login, refreshed=True)
+
+
+def ensure_docker_login(region: str = None) -> dict:
+    """ローカルDockerをECRにログインさせる（トークン更新時のみdocker loginを実行）"""
+    region = region or AWS_REGION
+    creds = get_registry_credentials(region)
+    with _lock:
+        login = _logins.get(region)
+        if login is not None and login["docker_logged_in"] and login["password"] == creds["password"]:
+            return {"registry": creds["registry"], "expires_at": creds["expires_at"], "refreshed": False}
+
+        docker_login(creds["registry"], creds["username"], creds["password"])
+        if login is not None:
+            login["docker_logged_in"] = True
+        logger.info(f"Docker logged in to {creds['registry']}")
+        return {"registry": creds["registry"], "expires_at": creds["expires_at"], "refreshed": True}
+
+
+def docker_login(registry: str, username: str, password: str):
+    """docker loginを実行する（パスワードは標準入力で渡す）"""
+    proc = subprocess.Popen(
+        ["docker", "login", "--username", username, "--password-stdin", registry],
+        stdin=subprocess.PIPE,
+    )
+    proc.communicate(input=password.encode())
+    if proc.returncode != 0:
+        raise Exception("Docker login failed")
+
+
+def invalidate_registry_login(region: str = None):
+    """キャッシュ済みのトークンを破棄し、次回デプロイで再ログインさせる"""
+    with _lock:
+        _logins.pop(region or AWS_REGION, None)
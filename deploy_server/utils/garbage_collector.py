@@ -0,0 +1,482 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.alb_rules import forward_weights, listener_rules
+from utils.aws import list_cluster_services
+from utils.blue_green import SLOTS, slot_names
+from utils.builders import BUILD_CACHE_REPO_SUFFIX
+from utils.clients import get_client
+from utils.common import get_resolved_config
+from utils.git_cache import CLONE_BASE_DIR, dir_size, mirror_cache
+from utils.registry import deploy_registry
+from utils.task_definitions import task_definitions
+
+# 定期実行の間隔（秒）。0（デフォルト）なら/gcから呼んだときだけ実行する
+GC_INTERVAL_SECONDS = int(os.getenv("GC_INTERVAL_SECONDS", "0"))
+# アプリごとに残すイメージ数とタスク定義リビジョン数（使用中のものはこれとは別に残す）
+GC_KEEP_IMAGES = int(os.getenv("GC_KEEP_IMAGES", "10"))
+GC_KEEP_TASK_DEFINITIONS = int(os.getenv("GC_KEEP_TASK_DEFINITIONS", "10"))
+# CLONE_BASE_DIR（ミラーを含む）の上限と、残っている作業ディレクトリを削除するまでの秒数
+GC_CLONE_DIR_MAX_MB = int(os.getenv("GC_CLONE_DIR_MAX_MB", "10240"))
+GC_CLONE_DIR_MIN_AGE_SECONDS = int(os.getenv("GC_CLONE_DIR_MIN_AGE_SECONDS", "3600"))
+# リポジトリ・タスク定義の問い合わせと削除を並列に行う数
+GC_CONCURRENCY = int(os.getenv("GC_CONCURRENCY", "8"))
+
+# batch_delete_imageとdelete_task_definitionsで1回に指定できる件数
+_ECR_BATCH_DELETE_MAX = 100
+_ECS_DELETE_TASK_DEFINITIONS_MAX = 10
+_TARGET_GROUP = 1
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _app_for(name: str, kind: int):
+    """ECSサービス名（kind=0）・ターゲットグループ名（kind=1）からアプリ名を返す（このサーバーの命名でなければNone）"""
+    for slot in reversed(SLOTS):
+        suffix = slot_names("", slot)[kind]
+        if not suffix:
+            return name
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def _family(task_definition_arn: str) -> str:
+    # arn:aws:ecs:...:task-definition/{family}:{revision}
+    return task_definition_arn.rsplit("/", 1)[-1].rsplit(":", 1)[0]
+
+
+def _revision(task_definition_arn: str) -> int:
+    return int(task_definition_arn.rsplit(":", 1)[1])
+
+
+def _image_ref(image_uri: str):
+    """イメージURIを (リポジトリ名, ダイジェスト, タグ) に分ける"""
+    path = image_uri.split("/", 1)[-1]
+    if "@" in path:
+        repository, digest = path.split("@", 1)
+        return repository, digest, None
+    repository, _, tag = path.rpartition(":")
+    return (repository, None, tag) if repository else (path, None, "latest")
+
+
+def _client_error(e: Exception) -> str:
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Message") or str(e)
+    return str(e)
+
+
+class GarbageCollector:
+    """デプロイの繰り返しで溜まるリソースを保持ポリシーに従って削除する
+
+    - ECRイメージ: アプリごとに新しい順にGC_KEEP_IMAGES件と、残すタスク定義・レジストリが参照するイメージを残す
+      （ビルドキャッシュのリポジトリはタグの付いていないものを削除）
+    - タスク定義: ファミリーごとに新しい順にGC_KEEP_TASK_DEFINITIONS件とサービスが使っているリビジョンを残す
+    - ターゲットグループ・リスナールール: どのサービスからも使われていないアプリのものを削除
+    - CLONE_BASE_DIR: 古い作業ディレクトリを削除し、上限を超えていればミラーも古い順に削除
+
+    対象はデプロイレジストリに記録されたアプリだけで、クラスターにある他のサービスのリソースには触らない。
+    デプロイ中（待機中・実行中のジョブがある）のアプリも対象にしない。
+    """
+
+    def __init__(
+        self,
+        keep_images: int = GC_KEEP_IMAGES,
+        keep_task_definitions: int = GC_KEEP_TASK_DEFINITIONS,
+        clone_dir_max_bytes: int = GC_CLONE_DIR_MAX_MB * 1024 * 1024,
+        clone_dir_min_age: float = GC_CLONE_DIR_MIN_AGE_SECONDS,
+        concurrency: int = GC_CONCURRENCY,
+    ):
+        self.keep_images = keep_images
+        self.keep_task_definitions = keep_task_definitions
+        self.clone_dir_max_bytes = clone_dir_max_bytes
+        self.clone_dir_min_age = clone_dir_min_age
+        self.concurrency = concurrency
+        # デプロイ中のアプリ名を返す関数（main.pyでジョブキューを渡す）
+        self.busy_apps = set
+        self.interval = 0
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self.runs = 0
+        self.last_run = None
+
+    def start(self, busy_apps=None, interval: float = GC_INTERVAL_SECONDS):
+        """一定間隔でrun()を実行するデーモンスレッドを起動する（初回は間隔が経ってから）"""
+        if busy_apps is not None:
+            self.busy_apps = busy_apps
+        self.interval = interval
+        if interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.run()
+                except HTTPException as e:
+                    logger.warning(f"Scheduled garbage collection skipped: {e.detail}")
+                except Exception as e:
+                    logger.warning(f"Garbage collection failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="garbage-collector", daemon=True)
+        self._thread.start()
+
+    def run(self, dry_run: bool = False) -> dict:
+        """1回分の回収を行い、削除した（dry_runなら削除する）リソースを返す。実行中なら409"""
+        if not self._run_lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="Garbage collection is already running")
+        try:
+            report = self._sweep(dry_run)
+        finally:
+            self._run_lock.release()
+        self.runs += 1
+        self.last_run = {k: report[k] for k in ("dry_run", "started_at", "duration_seconds", "summary")}
+        logger.info(
+            f"Garbage collection{' (dry run)' if dry_run else ''} finished in {report['duration_seconds']}s: "
+            + ", ".join(f"{k}={v}" for k, v in report["summary"].items())
+        )
+        return report
+
+    def _sweep(self, dry_run: bool) -> dict:
+        started = time.time()
+        busy = set(self.busy_apps())
+        services = {
+            name: service
+            for name, service in list_cluster_services(get_client("ecs")).items()
+            if service["status"] != "INACTIVE"
+        }
+        registered = deploy_registry.list_apps()
+        # このサーバーがデプロイしたアプリ（レジストリに記録されたもの）だけを対象にする
+        known = {row["app_name"] for row in registered}
+        apps = known - busy
+        protected_images = {}
+        for row in registered:
+            if row["app_name"] in apps and row.get("image_uri"):
+                self._protect(protected_images, row["image_uri"])
+                if row.get("image_digest"):
+                    repository = _image_ref(row["image_uri"])[0]
+                    self._protect(protected_images, f"{repository}@{row['image_digest']}")
+
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="gc") as pool:
+            target_groups = pool.submit(self._guard, "target_groups", self._sweep_target_groups, known, busy, services, dry_run)
+            clone_dirs = pool.submit(self._guard, "clone_dirs", self._sweep_clone_dirs, apps, dry_run)
+            revisions = self._guard("task_definitions", self._sweep_task_definitions, apps, services, protected_images, dry_run)
+            if "error" in revisions:
+                # どのイメージが使われているか分からないため、イメージは削除しない
+                images = {"error": "skipped because the task definition sweep failed"}
+            else:
+                images = self._guard("images", self._sweep_images, apps, protected_images, dry_run)
+            target_groups, clone_dirs = target_groups.result(), clone_dirs.result()
+
+        report = {
+            "dry_run": dry_run,
+            "started_at": started,
+            "duration_seconds": round(time.time() - started, 3),
+            "skipped_apps": sorted(busy & known),
+            "images": images,
+            "task_definitions": revisions,
+            "target_groups": target_groups,
+            "clone_dirs": clone_dirs,
+        }
+        report["summary"] = {
+            "images": len(images.get("deleted", [])),
+            "task_definitions": len(revisions.get("deregistered", [])),
+            "target_groups": len(target_groups.get("deleted", [])),
+            "rules": len(target_groups.get("rules", [])),
+            "clone_dirs": len(clone_dirs.get("deleted", [])) + len(clone_dirs.get("evicted_mirrors", [])),
+            "clone_bytes": clone_dirs.get("total_bytes", 0) - clone_dirs.get("total_bytes_after", 0),
+            "errors": sum(1 for part in (images, revisions, target_groups, clone_dirs) if "error" in part),
+        }
+        return report
+
+    @staticmethod
+    def _guard(name: str, fn, *args) -> dict:
+        # 1種類の失敗で他のリソースの回収を止めない
+        try:
+            return fn(*args)
+        except Exception as e:
+            logger.warning(f"Garbage collection of {name} failed: {e}")
+            return {"error": _client_error(e)}
+
+    @staticmethod
+    def _protect(protected: dict, image_uri: str):
+        repository, digest, tag = _image_ref(image_uri)
+        refs = protected.setdefault(repository, {"digests": set(), "tags": set()})
+        if digest:
+            refs["digests"].add(digest)
+        if tag:
+            refs["tags"].add(tag)
+
+    def _sweep_task_definitions(self, apps: set, services: dict, protected_images: dict, dry_run: bool) -> dict:
+        ecs = get_client("ecs")
+        in_use = set()
+        for service in services.values():
+            in_use.add(service["taskDefinition"])
+            in_use.update(d["taskDefinition"] for d in service.get("deployments", []))
+
+        # ファミリーごとに問い合わせず、全リビジョンを1回のページングで取得してアプリのものだけ使う
+        families, inactive = {}, []
+        for status, found in (("ACTIVE", None), ("INACTIVE", inactive)):
+            for page in ecs.get_paginator("list_task_definitions").paginate(status=status):
+                for arn in page["taskDefinitionArns"]:
+                    if _family(arn) not in apps:
+                        continue
+                    if found is None:
+                        families.setdefault(_family(arn), []).append(arn)
+                    else:
+                        found.append(arn)
+
+        keep, drop = [], []
+        for arns in families.values():
+            arns.sort(key=_revision, reverse=True)
+            for index, arn in enumerate(arns):
+                (keep if index < self.keep_task_definitions or arn in in_use else drop).append(arn)
+
+        # 残すリビジョンが参照するイメージはロールバック先として残す（内容はARNごとにキャッシュ済み）
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gc-taskdef") as pool:
+            for definition in pool.map(task_definitions.get, keep):
+                for container in (definition or {}).get("containerDefinitions", []):
+                    self._protect(protected_images, container["image"])
+
+        failures = []
+        if not dry_run and drop:
+            def deregister(arn):
+                try:
+                    ecs.deregister_task_definition(taskDefinition=arn)
+                except Exception as e:
+                    failures.append({"arn": arn, "reason": _client_error(e)})
+
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gc-taskdef") as pool:
+                list(pool.map(deregister, drop))
+        # 登録解除したリビジョン（と以前から残っているINACTIVEのリビジョン）は完全に削除する
+        deleted = [arn for arn in drop if arn not in {f["arn"] for f in failures}] + inactive
+        if not dry_run:
+            for chunk in _chunks(deleted, _ECS_DELETE_TASK_DEFINITIONS_MAX):
+                try:
+                    response = ecs.delete_task_definitions(taskDefinitions=chunk)
+                    failures.extend({"arn": f.get("arn"), "reason": f.get("reason")} for f in response.get("failures", []))
+                except Exception as e:
+                    failures.extend({"arn": arn, "reason": _client_error(e)} for arn in chunk)
+        if drop and not dry_run:
+            logger.info(f"Deregistered {len(drop) - len(failures)} task definition revisions")
+        return {
+            "families": len(families),
+            "kept": len(keep),
+            "deregistered": drop,
+            "deleted": len(deleted),
+            "failures": failures,
+        }
+
+    def _sweep_images(self, apps: set, protected_images: dict, dry_run: bool) -> dict:
+        repositories = [(app, False) for app in sorted(apps)] + [(f"{app}{BUILD_CACHE_REPO_SUFFIX}", True) for app in sorted(apps)]
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gc-ecr") as pool:
+            results = list(pool.map(
+                lambda item: self._sweep_repository(item[0], item[1], protected_images.get(item[0]), dry_run),
+                repositories,
+            ))
+        results = [r for r in results if r is not None]
+        deleted = [image for r in results for image in r["deleted"]]
+        return {
+            "repositories": len(results),
+            "images": sum(r["images"] for r in results),
+            "kept": sum(r["images"] for r in results) - len(deleted),
+            "deleted": deleted,
+            "failures": [failure for r in results for failure in r["failures"]],
+        }
+
+    def _sweep_repository(self, repository: str, cache_repository: bool, protected, dry_run: bool):
+        ecr = get_client("ecr")
+        images = []
+        try:
+            for page in ecr.get_paginator("describe_images").paginate(repositoryName=repository):
+                images.extend(page["imageDetails"])
+        except ecr.exceptions.RepositoryNotFoundException:
+            return None
+        protected = protected or {"digests": set(), "tags": set()}
+        images.sort(key=lambda image: image["imagePushedAt"], reverse=True)
+
+        delete = []
+        for index, image in enumerate(images):
+            tags = set(image.get("imageTags", []))
+            if cache_repository:
+                # ビルドキャッシュは最新のタグの付いたマニフェストだけが参照される
+                keep = bool(tags)
+            else:
+                keep = (
+                    index < self.keep_images
+                    or image["imageDigest"] in protected["digests"]
+                    or bool(tags & (protected["tags"] | {"latest"}))
+                )
+            if not keep:
+                delete.append(image)
+
+        failures = []
+        if not dry_run:
+            for chunk in _chunks(delete, _ECR_BATCH_DELETE_MAX):
+                response = ecr.batch_delete_image(
+                    repositoryName=repository, imageIds=[{"imageDigest": image["imageDigest"]} for image in chunk]
+                )
+                failures.extend(
+                    {"repository": repository, "digest": f.get("imageId", {}).get("imageDigest"), "reason": f.get("failureReason")}
+                    for f in response.get("failures", [])
+                )
+            if delete:
+                logger.info(f"Deleted {len(delete)} images from {repository}")
+        return {
+            "images": len(images),
+            "deleted": [
+                {
+                    "repository": repository,
+                    "digest": image["imageDigest"],
+                    "tags": image.get("imageTags", []),
+                    "pushed_at": image["imagePushedAt"].isoformat(),
+                }
+                for image in delete
+            ],
+            "failures": failures,
+        }
+
+    def _sweep_target_groups(self, known: set, busy: set, services: dict, dry_run: bool) -> dict:
+        elbv2 = get_client("elbv2")
+        listener_arn = get_resolved_config().alb_listener_arn
+        in_use = {
+            lb["targetGroupArn"]
+            for service in services.values()
+            for lb in service.get("loadBalancers", [])
+            if lb.get("targetGroupArn")
+        }
+        rules = []
+        if listener_arn:
+            for listener in elbv2.describe_listeners(ListenerArns=[listener_arn])["Listeners"]:
+                in_use.update(forward_weights(listener.get("DefaultActions", [])))
+            # コンソール等での変更も含めて判断するため、ルールを取り直す
+            listener_rules.invalidate(listener_arn)
+            rules = listener_rules.list_rules(listener_arn)
+        rules_by_target = {}
+        for rule in rules:
+            for tg_arn in rule["target_groups"]:
+                rules_by_target.setdefault(tg_arn, []).append(rule)
+
+        orphans = {}
+        for page in elbv2.get_paginator("describe_target_groups").paginate(PageSize=400):
+            for tg in page["TargetGroups"]:
+                arn, name = tg["TargetGroupArn"], tg["TargetGroupName"]
+                app_name = _app_for(name, _TARGET_GROUP)
+                # レジストリに無いアプリのターゲットグループはこのサーバーの管理外とみなす
+                if app_name not in known or arn in in_use or app_name in busy:
+                    continue
+                orphans[arn] = {"name": name, "arn": arn, "app_name": app_name}
+
+        # 転送先がすべて孤立したターゲットグループのルールだけを削除し、
+        # 使用中のターゲットグループと共有しているルールに残るものは削除できないため残す
+        orphan_rules = [r for r in rules if r["target_groups"] and set(r["target_groups"]) <= set(orphans)]
+        removable_rules = {r["rule_arn"] for r in orphan_rules}
+        skipped = []
+        for arn in list(orphans):
+            if any(r["rule_arn"] not in removable_rules for r in rules_by_target.get(arn, [])):
+                skipped.append({**orphans.pop(arn), "reason": "still referenced by a rule forwarding to a service in use"})
+
+        failures = []
+        if not dry_run and (orphans or orphan_rules):
+            # 判定中に始まったデプロイのリソースは残す
+            busy_now = set(self.busy_apps())
+            orphans = {arn: tg for arn, tg in orphans.items() if tg["app_name"] not in busy_now}
+            orphan_rules = [r for r in orphan_rules if set(r["target_groups"]) <= set(orphans)]
+            for rule in orphan_rules:
+                try:
+                    listener_rules.delete_rule(listener_arn, rule["rule_arn"])
+                except Exception as e:
+                    failures.append({"arn": rule["rule_arn"], "reason": _client_error(e)})
+
+            def delete_target_group(arn):
+                try:
+                    elbv2.delete_target_group(TargetGroupArn=arn)
+                    logger.info(f"Deleted orphan target group: {orphans[arn]['name']}")
+                except Exception as e:
+                    failures.append({"arn": arn, "reason": _client_error(e)})
+
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gc-elb") as pool:
+                list(pool.map(delete_target_group, list(orphans)))
+        return {
+            "deleted": sorted(orphans.values(), key=lambda tg: tg["name"]),
+            "rules": [{"rule_arn": r["rule_arn"], "priority": r["priority"], "paths": r["paths"]} for r in orphan_rules],
+            "skipped": skipped,
+            "failures": failures,
+        }
+
+    def _sweep_clone_dirs(self, apps: set, dry_run: bool) -> dict:
+        base_dir = CLONE_BASE_DIR
+        if not os.path.isdir(base_dir):
+            return {"path": base_dir, "max_bytes": self.clone_dir_max_bytes, "total_bytes": 0, "total_bytes_after": 0, "deleted": []}
+        mirror_dir = os.path.abspath(mirror_cache.base_dir)
+        mirrors_inside = os.path.dirname(mirror_dir) == base_dir
+        now = time.time()
+        workdirs = []
+        for name in os.listdir(base_dir):
+            path = os.path.join(base_dir, name)
+            if not os.path.isdir(path) or path == mirror_dir:
+                continue
+            # 作業ディレクトリ名は {app_name}_{時刻}_{ジョブID先頭8文字}
+            workdirs.append({
+                "path": path,
+                "app_name": name.rsplit("_", 2)[0],
+                "bytes": dir_size(path),
+                "age_seconds": round(now - os.path.getmtime(path)),
+            })
+        mirror_bytes = dir_size(mirror_dir) if mirrors_inside and os.path.isdir(mirror_dir) else 0
+        total = sum(w["bytes"] for w in workdirs) + mirror_bytes
+
+        removable = sorted((w for w in workdirs if w["app_name"] in apps), key=lambda w: -w["age_seconds"])
+        delete = [w for w in removable if w["age_seconds"] >= self.clone_dir_min_age]
+        remaining = total - sum(w["bytes"] for w in delete)
+        # 上限を超えていれば新しい作業ディレクトリも古い順に削除
+        for workdir in removable:
+            if remaining <= self.clone_dir_max_bytes:
+                break
+            if workdir not in delete:
+                delete.append(workdir)
+                remaining -= workdir["bytes"]
+        evicted = []
+        if remaining > self.clone_dir_max_bytes and mirrors_inside:
+            # ミラーに残せる容量 = 上限 - 残る作業ディレクトリ
+            budget = max(0, self.clone_dir_max_bytes - (remaining - mirror_bytes))
+            evicted = mirror_cache.evict(max_bytes=budget, dry_run=dry_run)
+            remaining -= sum(m["bytes"] for m in evicted)
+
+        if not dry_run:
+            for workdir in delete:
+                shutil.rmtree(workdir["path"], ignore_errors=True)
+            if delete:
+                logger.info(f"Deleted {len(delete)} stale clone directories under {base_dir}")
+        return {
+            "path": base_dir,
+            "max_bytes": self.clone_dir_max_bytes,
+            "total_bytes": total,
+            "total_bytes_after": remaining,
+            "deleted": [{k: w[k] for k in ("path", "bytes", "age_seconds")} for w in delete],
+            "evicted_mirrors": evicted,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "keep_images": self.keep_images,
+            "keep_task_definitions": self.keep_task_definitions,
+            "clone_dir_max_bytes": self.clone_dir_max_bytes,
+            "running": self._run_lock.locked(),
+            "runs": self.runs,
+            "last_run": self.last_run,
+        }
+
+
+garbage_collector = GarbageCollector()
@@ -0,0 +1,233 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from loguru import logger
+
+CLONE_BASE_DIR = os.path.abspath(os.getenv("CLONE_BASE_DIR", "/home/cc-company/gradio-fargate-factory/tmp"))
+# ベアミラーの保存先と合計サイズの上限（超えたら最終利用が古いものから削除）
+GIT_MIRROR_DIR = os.path.abspath(os.getenv("GIT_MIRROR_DIR", os.path.join(CLONE_BASE_DIR, "mirrors")))
+GIT_MIRROR_CACHE_MAX_MB = int(os.getenv("GIT_MIRROR_CACHE_MAX_MB", "5120"))
+# ls-remoteで解決したコミットSHAを再利用する秒数（同じrefへの連続したリクエストで問い合わせを共有する）
+GIT_REMOTE_CACHE_SECONDS = float(os.getenv("GIT_REMOTE_CACHE_SECONDS", "5"))
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _git(*args, cwd=None):
+    return subprocess.check_output(["git", *args], cwd=cwd, stderr=subprocess.STDOUT).decode().strip()
+
+
+class _MirrorState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_fetch_started = 0.0
+        self.in_use = 0
+
+
+class GitMirrorCache:
+    """リポジトリURLごとのベアミラーを保持し、深さ1のワークツリーを高速に作るキャッシュ
+
+    同じリポジトリへの同時デプロイは1回のfetchを共有し、
+    ミラーの合計サイズが上限を超えたら最終利用の古い順に削除する。
+    """
+
+    def __init__(self, base_dir: str = GIT_MIRROR_DIR, max_bytes: int = GIT_MIRROR_CACHE_MAX_MB * 1024 * 1024):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._states = {}
+        self._sizes = {}
+        # (url, ref) -> (コミットSHA, 解決した時刻)
+        self._remote = {}
+        self._remote_locks = {}
+
+    def mirror_path(self, url: str) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", url.rstrip("/").rsplit("/", 1)[-1])[:40]
+        digest = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return os.path.join(self.base_dir, f"{digest}-{name}")
+
+    def _state(self, path: str) -> _MirrorState:
+        with self._lock:
+            return self._states.setdefault(path, _MirrorState())
+
+    def fetch(self, url: str) -> str:
+        """ミラーを最新化してパスを返す（実行中のfetchがあればその結果を共有）"""
+        path = self.mirror_path(url)
+        state = self._state(path)
+        requested_at = time.time()
+        with state.lock:
+            if state.last_fetch_started >= requested_at:
+                # 待っている間に他のデプロイがfetchを済ませた
+                return path
+            state.last_fetch_started = time.time()
+            os.makedirs(self.base_dir, exist_ok=True)
+            if os.path.isdir(path):
+                logger.info(f"Fetching git mirror: {url}")
+                _git("--git-dir", path, "fetch", "--prune", "--quiet", "origin")
+            else:
+                logger.info(f"Creating git mirror: {url}")
+                tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                _git("clone", "--mirror", "--quiet", url, tmp_path)
+                os.replace(tmp_path, path)
+            self._sizes[path] = dir_size(path)
+            return path
+
+    def checkout(self, url: str, ref: str, dest: str) -> str:
+        """refを深さ1でdestに展開し、コミットSHAを返す"""
+        if url.startswith("-") or (ref and ref.startswith("-")):
+            raise ValueError(f"Invalid git url or ref: {url} {ref}")
+        path = self.mirror_path(url)
+        state = self._state(path)
+        with self._lock:
+            state.in_use += 1
+        try:
+            self.fetch(url)
+            commit_sha = _git("--git-dir", path, "rev-parse", "--verify", f"{ref or 'HEAD'}^{{commit}}")
+            os.makedirs(dest, exist_ok=True)
+            _git("init", "--quiet", cwd=dest)
+            _git("fetch", "--quiet", "--depth", "1", "--no-tags", f"file://{path}", commit_sha, cwd=dest)
+            _git("checkout", "--quiet", "--detach", "FETCH_HEAD", cwd=dest)
+            self._pull_lfs(url, dest)
+            os.utime(path)
+        finally:
+            with self._lock:
+                state.in_use -= 1
+        self.evict()
+        return commit_sha
+
+    def resolve_remote(self, url: str, ref: str = None, fresh: bool = False):
+        """リモートのrefが現在指しているコミットSHAを返す（見つからなければNone）
+
+        ls-remoteで`ref`と`ref^{}`を問い合わせ、注釈付きタグはタグオブジェクトではなくコミットを返す。
+        短縮SHAはls-remoteで引けないため、ミラーでrev-parseする（ミラーに無ければfetchする）。
+        結果はGIT_REMOTE_CACHE_SECONDSの間再利用し、同じrefの同時の問い合わせは1回にまとめる。
+        fresh=Trueならキャッシュを使わず必ずリモートに問い合わせる（結果はキャッシュに入れる）。
+        """
+        if url.startswith("-") or (ref and ref.startswith("-")):
+            raise ValueError(f"Invalid git url or ref: {url} {ref}")
+        if ref and re.fullmatch(r"[0-9a-f]{40}", ref):
+            return ref
+        key = (url, ref or "HEAD")
+        with self._lock:
+            lock = self._remote_locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = None if fresh else self._remote.get(key)
+            if cached and time.time() - cached[1] < GIT_REMOTE_CACHE_SECONDS:
+                return cached[0]
+            sha = self._ls_remote(url, ref or "HEAD")
+            if sha is None and re.fullmatch(r"[0-9a-f]{4,39}", ref or ""):
+                sha = self._rev_parse_mirror(url, ref)
+            with self._lock:
+                self._remote = {k: v for k, v in self._remote.items() if time.time() - v[1] < GIT_REMOTE_CACHE_SECONDS}
+                if sha:
+                    self._remote[key] = (sha, time.time())
+                # キャッシュから外れたrefのロックは、使用中でなければ捨てる
+                self._remote_locks = {
+                    k: v for k, v in self._remote_locks.items() if k in self._remote or v.locked()
+                }
+        with self._lock:
+            if key not in self._remote and self._remote_locks.get(key) is lock and not lock.locked():
+                del self._remote_locks[key]
+        return sha
+
+    @staticmethod
+    def _ls_remote(url: str, ref: str):
+        refs = {}
+        for line in _git("ls-remote", url, ref, f"{ref}^{{}}").splitlines():
+            sha, _, name = line.partition("\t")
+            refs[name] = sha
+        if not refs:
+            return None
+        # rev-parse（checkout）と同じ優先順位で選び、注釈付きタグは^{}の行（コミット）を使う
+        names = [ref, f"refs/tags/{ref}", f"refs/heads/{ref}"]
+        names += sorted(name for name in refs if not name.endswith("^{}") and name not in names)
+        for name in names:
+            if name in refs:
+                return refs.get(f"{name}^{{}}", refs[name])
+        return next(iter(refs.values()))
+
+    def _rev_parse_mirror(self, url: str, ref: str):
+        path = self.mirror_path(url)
+        for attempt in range(2):
+            if os.path.isdir(path):
+                try:
+                    return _git("--git-dir", path, "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}")
+                except subprocess.CalledProcessError:
+                    pass
+            if attempt == 0:
+                # ミラーに無い（まだ作っていない・新しいコミット）ならfetchしてもう一度
+                self.fetch(url)
+        return None
+
+    def _pull_lfs(self, url: str, dest: str):
+        attributes = os.path.join(dest, ".gitattributes")
+        if not os.path.exists(attributes):
+            return
+        with open(attributes, errors="ignore") as f:
+            if "filter=lfs" not in f.read():
+                return
+        # LFSオブジェクトはミラーに含まれないため元のURLから取得
+        logger.info(f"Pulling git LFS objects from {url}")
+        _git("-c", f"lfs.url={url.rstrip('/')}/info/lfs", "lfs", "pull", cwd=dest)
+
+    def evict(self, max_bytes: int = None, dry_run: bool = False) -> list:
+        """合計サイズが上限（未指定ならmax_bytes）を超えていれば、使用中でないミラーを最終利用の古い順に削除
+
+        削除した（dry_runなら削除する）ミラーを [{"path", "bytes"}] で返す。
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if not os.path.isdir(self.base_dir):
+            return []
+        mirrors = []
+        for name in os.listdir(self.base_dir):
+            path = os.path.join(self.base_dir, name)
+            if not os.path.isdir(path) or ".tmp-" in name:
+                continue
+            if path not in self._sizes:
+                self._sizes[path] = dir_size(path)
+            mirrors.append((os.path.getmtime(path), path))
+        total = sum(self._sizes[p] for _, p in mirrors)
+        evicted = []
+        for _, path in sorted(mirrors):
+            if total <= max_bytes:
+                break
+            state = self._state(path)
+            if state.in_use or not state.lock.acquire(blocking=False):
+                continue
+            try:
+                size = self._sizes[path]
+                if not dry_run:
+                    shutil.rmtree(path, ignore_errors=True)
+                    self._sizes.pop(path, None)
+                    logger.info(f"Evicted git mirror: {path}")
+                total -= size
+                evicted.append({"path": path, "bytes": size})
+            finally:
+                state.lock.release()
+        return evicted
+
+    def stats(self) -> dict:
+        return {
+            "mirror_dir": self.base_dir,
+            "mirrors": len(self._sizes),
+            "total_bytes": sum(self._sizes.values()),
+            "max_bytes": self.max_bytes,
+        }
+
+
+mirror_cache = GitMirrorCache()
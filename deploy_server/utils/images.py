@@ -0,0 +1,110 @@
+import hashlib
+import os
+import subprocess
+
+from loguru import logger
+
+# ビルドコンテキストのハッシュ計算で除外するディレクトリ
+_HASH_EXCLUDED_DIRS = {".git", "__pycache__", ".venv", "node_modules"}
+
+
+def get_git_commit_sha(path: str):
+    """pathがgitのワークツリーで、path以下に未コミットの変更・未追跡や.gitignoreされたファイルがなければHEADのSHAを返す
+
+    docker buildは.gitignoreされたファイルもコンテキストとして送るため、それらがあればコミットだけでは内容が決まらない。
+    """
+    try:
+        sha = subprocess.check_output(
+            ["git", "-C", path, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.check_output(
+            ["git", "-C", path, "status", "--porcelain", "--untracked-files=all", "--ignored", "--", "."],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return None
+    if dirty:
+        return None
+    return sha
+
+
+def git_context_prefix(path: str) -> str:
+    """pathのリポジトリルートからの相対パス（ルートなら空文字列）"""
+    try:
+        return subprocess.check_output(
+            ["git", "-C", path, "rev-parse", "--show-prefix"], stderr=subprocess.DEVNULL
+        ).decode().strip().rstrip("/")
+    except Exception:
+        return ""
+
+
+def git_source(commit_sha: str, prefix: str = "") -> str:
+    """内容キーのソース。リポジトリのサブディレクトリをコンテキストにする場合はそのパスも含める"""
+    return f"git:{commit_sha}:{prefix}" if prefix else f"git:{commit_sha}"
+
+
+def hash_build_context(context_dir: str) -> str:
+    """ビルドコンテキスト内の全ファイル（パス・実行権限・内容）のSHA-256"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(context_dir):
+        dirs[:] = sorted(d for d in dirs if d not in _HASH_EXCLUDED_DIRS)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, context_dir).replace(os.sep, "/")
+            digest.update(rel_path.encode())
+            if os.path.islink(path):
+                digest.update(b"link:" + os.readlink(path).encode())
+                continue
+            digest.update(b"x" if os.access(path, os.X_OK) else b"-")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_tag(source: str, dockerfile: str, platform: str) -> str:
+    """ソース（git:{sha} または tree:{hash}）・Dockerfile・プラットフォームからイメージタグを決める"""
+    key = hashlib.sha256(f"{source}\n{dockerfile}\n{platform}".encode()).hexdigest()
+    return f"src-{key[:16]}"
+
+
+def compute_content_key(context_dir: str, dockerfile: str, platform: str) -> dict:
+    """デプロイするイメージの内容キーを計算する
+
+    gitのコミットSHA（とリポジトリ内のコンテキストのパス）が取れればそれを、取れなければ
+    ビルドコンテキストのハッシュを元に、Dockerfileのパスとプラットフォームを加えてイメージタグを決める。
+    """
+    commit_sha = get_git_commit_sha(context_dir)
+    if commit_sha:
+        source = git_source(commit_sha, git_context_prefix(context_dir))
+    else:
+        source = f"tree:{hash_build_context(context_dir)}"
+    return {
+        "tag": content_tag(source, dockerfile, platform),
+        "source": source,
+        "commit_sha": commit_sha,
+    }
+
+
+def ensure_repository(ecr, repository_name: str) -> str:
+    """ECRリポジトリのURIを返す（なければ作成）"""
+    try:
+        return ecr.describe_repositories(repositoryNames=[repository_name])["repositories"][0]["repositoryUri"]
+    except ecr.exceptions.RepositoryNotFoundException:
+        repo = ecr.create_repository(repositoryName=repository_name)
+        logger.info(f"Created ECR repository: {repository_name}")
+        return repo["repository"]["repositoryUri"]
+
+
+def find_image_digest(ecr, repository_name: str, tag: str):
+    """ECRに指定タグのイメージがあればダイジェストを返す（なければNone）"""
+    try:
+        images = ecr.describe_images(
+            repositoryName=repository_name, imageIds=[{"imageTag": tag}]
+        )["imageDetails"]
+    except ecr.exceptions.ImageNotFoundException:
+        return None
+    if not images:
+        return None
+    logger.debug(f"Found image {repository_name}:{tag} ({images[0]['imageDigest']})")
+    return images[0]["imageDigest"]
@@ -0,0 +1,549 @@
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.build_logs import DeployLog
+from utils.git_cache import mirror_cache
+from utils.metrics import STAGE_DURATION, JOB_DURATION, JOBS_TOTAL, JOBS_IN_FLIGHT
+
+# 同時に実行するデプロイジョブ数（ワーカースレッド数）
+DEPLOY_WORKERS = int(os.getenv("DEPLOY_WORKERS", "4"))
+# メモリに保持する完了済みジョブ数
+DEPLOY_JOB_HISTORY_LIMIT = int(os.getenv("DEPLOY_JOB_HISTORY_LIMIT", "200"))
+# バッチデプロイで同時に実行するビルド数のデフォルト
+DEPLOY_BATCH_BUILD_CONCURRENCY = int(os.getenv("DEPLOY_BATCH_BUILD_CONCURRENCY", "4"))
+# Idempotency-Keyを覚えておく秒数
+DEPLOY_IDEMPOTENCY_TTL_SECONDS = int(os.getenv("DEPLOY_IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+FINISHED_STATUSES = ("succeeded", "failed", "completed", "superseded")
+
+
+def request_fingerprint(req) -> str:
+    """同一リクエストの判定に使う、リクエスト内容の正規化文字列"""
+    return json.dumps(req.model_dump(), sort_keys=True)
+
+
+class _ProgressTracker:
+    """進捗イベントの記録と待機を提供する基底クラス"""
+
+    # メトリクスのscopeラベル
+    metrics_scope = "job"
+
+    def _init_progress(self):
+        self.status = "queued"
+        # 実行中のステージ（開始順）。StepGraphで並列に実行されるステージは同時に複数入る
+        self.active_stages = []
+        self.events = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # ステージごとの所要時間（秒）。同じステージが複数回あれば合計する
+        self.timings = {}
+        self._cond = threading.Condition()
+
+    def emit(self, stage: str, status: str, message: str = None, **extra):
+        """進捗イベントを追加し、待機中のクライアントへ通知（seqは並列のステージからでも追加順に振る）"""
+        with self._cond:
+            event = {
+                "seq": len(self.events),
+                "timestamp": time.time(),
+                "stage": stage,
+                "status": status,
+            }
+            if message:
+                event["message"] = message
+            event.update(extra)
+            self.events.append(event)
+            self._cond.notify_all()
+        return event
+
+    @property
+    def current_stage(self):
+        """最後に開始した実行中のステージ（並列のステージをすべて見るにはactive_stages）"""
+        with self._cond:
+            return self.active_stages[-1] if self.active_stages else None
+
+    def enter_stage(self, name: str):
+        with self._cond:
+            self.active_stages.append(name)
+
+    def leave_stage(self, name: str):
+        with self._cond:
+            if name in self.active_stages:
+                self.active_stages.remove(name)
+
+    def clear_stages(self):
+        with self._cond:
+            self.active_stages = []
+
+    def stages_snapshot(self) -> list:
+        with self._cond:
+            return list(self.active_stages)
+
+    @contextmanager
+    def stage(self, name: str):
+        """ステージの開始・完了・失敗をイベントとして記録するコンテキスト"""
+        self.enter_stage(name)
+        started = time.perf_counter()
+        self.emit(name, "started")
+        try:
+            yield
+        except Exception as e:
+            duration = round(time.perf_counter() - started, 3)
+            self.record_timing(name, duration, "failed")
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            self.emit(name, "failed", str(detail)[:500], duration_seconds=duration)
+            raise
+        finally:
+            self.leave_stage(name)
+        duration = round(time.perf_counter() - started, 3)
+        self.record_timing(name, duration, "completed")
+        self.emit(name, "completed", duration_seconds=duration)
+
+    def record_timing(self, name: str, duration: float, outcome: str = "completed"):
+        """ステージの所要時間を記録し、ヒストグラムに反映する"""
+        with self._cond:
+            self.timings[name] = round(self.timings.get(name, 0) + duration, 3)
+        STAGE_DURATION.observe(duration, scope=self.metrics_scope, stage=name, outcome=outcome)
+
+    def wait_for_events(self, since: int, timeout: float):
+        """since番目以降のイベントが届くか、終了するまで待機"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: len(self.events) > since or self.status in FINISHED_STATUSES,
+                timeout=timeout,
+            )
+            return self.events[since:]
+
+    def wait_finished(self, timeout: float) -> bool:
+        """終了するまで最大timeout秒待つ。終了していればTrue"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.status in FINISHED_STATUSES, timeout=timeout)
+
+    def _set_status(self, status: str):
+        with self._cond:
+            self.status = status
+            self._cond.notify_all()
+
+
+class DeployJob(_ProgressTracker):
+    """1回分のデプロイ要求と、その進捗イベントを保持するジョブ"""
+
+    def __init__(self, req, batch_id: str = None, wait_healthy: bool = False, app_name: str = None, runner=None,
+                 on_finish=None):
+        self._init_progress()
+        self.job_id = uuid.uuid4().hex
+        self.app_name = app_name or req.app_name
+        self.request = req
+        # デプロイ以外の操作（promote等）を同じキューで直列に実行するための実行関数
+        self.runner = runner
+        self.batch_id = batch_id
+        # Trueならサービスが正常になるまでジョブを完了させない
+        self.wait_healthy = wait_healthy
+        self.result = None
+        self.error = None
+        self.error_status_code = None
+        # デプロイ中に作成・更新したAWSリソース（タスク定義ARN・ターゲットグループ・ルール等）
+        self.resources = {}
+        # 完了時・結果の更新時に呼ぶ関数（デプロイ状態のレジストリへの記録）
+        self.on_finish = on_finish
+        # ソースを取得した時点でTrue（以降に届いた同一リクエストは新しいコミットを含まない可能性がある）
+        self.source_pinned = False
+        self.source_commit = None
+        # 後から届いたリクエストに置き換えられた場合の新しいジョブID
+        self.superseded_by = None
+        self.log = DeployLog(self.job_id)
+        JOBS_IN_FLIGHT.inc(status="queued")
+        self.emit("queued", "queued", f"Deploy job for {self.app_name} queued")
+
+    @property
+    def app_names(self):
+        return (self.app_name,)
+
+    def mark_running(self):
+        if self.status != "queued":
+            return
+        self.started_at = time.time()
+        JOBS_IN_FLIGHT.dec(status="queued")
+        JOBS_IN_FLIGHT.inc(status="running")
+        self._set_status("running")
+        self.emit("job", "started")
+
+    def succeed(self, result):
+        if isinstance(result, dict):
+            result["timings"] = dict(self.timings)
+        self.result = result
+        self.emit("job", "succeeded")
+        self._finish("succeeded")
+
+    def fail(self, e: Exception):
+        if isinstance(e, HTTPException):
+            self.error = e.detail
+            self.error_status_code = e.status_code
+        else:
+            self.error = str(e)
+            self.error_status_code = 500
+            traceback.print_exc()
+        logger.error(f"Deploy job {self.job_id} failed: {self.error}")
+        self.emit("job", "failed", str(self.error)[:500])
+        self._finish("failed")
+
+    def supersede(self, newer: "DeployJob"):
+        """待機中のジョブを新しいジョブで置き換えて終了させる"""
+        self.superseded_by = newer.job_id
+        self.emit("job", "superseded", f"Superseded by newer deploy job {newer.job_id}", superseded_by=newer.job_id)
+        self._finish("superseded")
+
+    def _finish(self, status: str):
+        self.finished_at = time.time()
+        self.clear_stages()
+        self.log.close()
+        JOBS_IN_FLIGHT.dec(status=self.status)
+        JOB_DURATION.observe(self.finished_at - (self.started_at or self.created_at), status=status)
+        JOBS_TOTAL.inc(app_name=self.app_name, status=status)
+        self._set_status(status)
+        self.notify()
+
+    def notify(self):
+        """on_finishへ現在の状態を通知する（完了後にヘルス結果が届いた時も呼ぶ）"""
+        if self.on_finish is None or self.status not in FINISHED_STATUSES:
+            return
+        try:
+            self.on_finish(self)
+        except Exception as e:
+            logger.warning(f"Failed to record deploy job {self.job_id}: {e}")
+
+    def to_dict(self, include_events: bool = False):
+        data = {
+            "job_id": self.job_id,
+            "app_name": self.app_name,
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "current_stage": self.current_stage,
+            "active_stages": self.stages_snapshot(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+            "superseded_by": self.superseded_by,
+            "timings": dict(self.timings),
+            "resources": dict(self.resources),
+            "log_lines": self.log.line_count,
+        }
+        if include_events:
+            data["events"] = list(self.events)
+        return data
+
+
+class DeployBatch(_ProgressTracker):
+    """複数アプリをまとめてデプロイするバッチ。アプリごとにDeployJobを持つ"""
+
+    metrics_scope = "batch"
+
+    def __init__(self, reqs, build_concurrency: int = DEPLOY_BATCH_BUILD_CONCURRENCY, on_finish=None):
+        self._init_progress()
+        self.batch_id = uuid.uuid4().hex
+        self.build_concurrency = max(1, build_concurrency)
+        self.jobs = [DeployJob(req, batch_id=self.batch_id, on_finish=on_finish) for req in reqs]
+        self.report = None
+        self.error = None
+        self.emit("queued", "queued", f"Batch of {len(self.jobs)} apps queued")
+
+    @property
+    def app_names(self):
+        return tuple(job.app_name for job in self.jobs)
+
+    def to_dict(self, include_events: bool = False):
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        data = {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "current_stage": self.current_stage,
+            "active_stages": self.stages_snapshot(),
+            "build_concurrency": self.build_concurrency,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "counts": counts,
+            "timings": dict(self.timings),
+            "apps": [
+                {
+                    "app_name": job.app_name,
+                    "job_id": job.job_id,
+                    "status": job.status,
+                    "deployed_url": (job.result or {}).get("deployed_url"),
+                    "error": job.error,
+                }
+                for job in self.jobs
+            ],
+            "error": self.error,
+        }
+        if include_events:
+            data["events"] = list(self.events)
+        return data
+
+
+class DeployJobQueue:
+    """上限付きワーカープールでデプロイを実行するキュー
+
+    同じアプリのジョブは到着順に1件ずつ実行し、異なるアプリは並列に実行する。
+    バッチは含まれる全アプリの順番が来た時点でまとめて実行する。
+    """
+
+    def __init__(self, runner, batch_runner=None, max_workers: int = DEPLOY_WORKERS, history_limit: int = DEPLOY_JOB_HISTORY_LIMIT,
+                 on_finish=None):
+        self._runner = runner
+        self._batch_runner = batch_runner
+        self._on_finish = on_finish
+        # Idempotency-Key -> (ジョブID, リクエストの指紋, 登録時刻)
+        self._idempotency = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="deploy")
+        self._history_limit = history_limit
+        self._jobs = OrderedDict()
+        self._batches = OrderedDict()
+        self._pending = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, req, wait_healthy: bool = False, app_name: str = None, runner=None) -> DeployJob:
+        job = DeployJob(req, wait_healthy=wait_healthy, app_name=app_name, runner=runner, on_finish=self._on_finish)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._enqueue(job)
+            self._prune()
+        logger.info(f"Queued deploy job {job.job_id} for {job.app_name}")
+        return job
+
+    def submit_deploy(self, req, wait_healthy: bool = False, idempotency_key: str = None):
+        """デプロイを登録する。同じアプリへの重複・連続したリクエストはまとめる
+
+        - Idempotency-Keyが登録済みなら、そのジョブを返す（内容が違えば409）
+        - 同一内容のジョブが待機中、またはソース取得前/同じコミットで実行中なら、そのジョブに合流する
+        - それ以外は新しいジョブを登録し、同じアプリの待機中の古いジョブを置き換える
+        戻り値: (ジョブ, 重複の理由 "idempotency_key" | "attached" | None)
+        """
+        fingerprint = request_fingerprint(req)
+        with self._lock:
+            job = self._find_by_key(idempotency_key, fingerprint)
+            if job:
+                return job, "idempotency_key"
+            queued, running = self._find_same_request(req.app_name, fingerprint)
+            if queued:
+                # 待機中のジョブは実行時に最新のソースを取得するので、そのまま合流できる
+                queued.wait_healthy = queued.wait_healthy or wait_healthy
+                self._remember_key(idempotency_key, queued, fingerprint)
+                return queued, "attached"
+
+        if running and (running.wait_healthy or not wait_healthy) and self._same_source(running):
+            with self._lock:
+                if running.status == "running":
+                    self._remember_key(idempotency_key, running, fingerprint)
+                    return running, "attached"
+
+        job = DeployJob(req, wait_healthy=wait_healthy, on_finish=self._on_finish)
+        with self._lock:
+            superseded = self._supersede_queued(job)
+            pending = self._pending.get(job.app_name)
+            if pending:
+                # 置き換えたジョブの後ろで待っていたバッチ等が先頭になった場合に備える
+                self._try_start(pending[0])
+            self._jobs[job.job_id] = job
+            self._remember_key(idempotency_key, job, fingerprint)
+            self._enqueue(job)
+            self._prune()
+        for old in superseded:
+            old.supersede(job)
+            logger.info(f"Deploy job {old.job_id} for {job.app_name} superseded by {job.job_id}")
+        logger.info(f"Queued deploy job {job.job_id} for {job.app_name}")
+        return job, None
+
+    def _find_by_key(self, idempotency_key: str, fingerprint: str):
+        # ロック取得済みの状態で呼ぶこと
+        if not idempotency_key:
+            return None
+        now = time.time()
+        while self._idempotency:
+            key, (_, _, created) = next(iter(self._idempotency.items()))
+            if now - created < DEPLOY_IDEMPOTENCY_TTL_SECONDS:
+                break
+            self._idempotency.pop(key)
+        entry = self._idempotency.get(idempotency_key)
+        if not entry or entry[0] not in self._jobs:
+            return None
+        if entry[1] != fingerprint:
+            raise HTTPException(status_code=409, detail="Idempotency-Key was already used for a different deploy request")
+        return self._jobs[entry[0]]
+
+    def _remember_key(self, idempotency_key: str, job: DeployJob, fingerprint: str):
+        # ロック取得済みの状態で呼ぶこと
+        if idempotency_key:
+            self._idempotency[idempotency_key] = (job.job_id, fingerprint, time.time())
+
+    def _find_same_request(self, app_name: str, fingerprint: str):
+        # ロック取得済みの状態で呼ぶこと。(同一内容の待機中ジョブ, 同一内容の実行中ジョブ) を返す
+        queued = next(
+            (unit for unit in self._pending.get(app_name, ())
+             if isinstance(unit, DeployJob) and unit.runner is None and request_fingerprint(unit.request) == fingerprint),
+            None,
+        )
+        running = self._running.get(app_name)
+        if not (isinstance(running, DeployJob) and running.runner is None and running.status == "running"
+                and request_fingerprint(running.request) == fingerprint):
+            running = None
+        return queued, running
+
+    @staticmethod
+    def _same_source(job: DeployJob) -> bool:
+        """実行中のジョブが、今届いたリクエストと同じソースをデプロイするか
+
+        合流するとこのリクエストはデプロイされないため、キャッシュを使わずリモートの現在のコミットと比べる。
+        """
+        if not job.source_pinned:
+            return True
+        req = job.request
+        if not req.git_repo_url or not job.source_commit:
+            # ローカルのビルドコンテキストは取得後に変わったか判定できない
+            return False
+        try:
+            return mirror_cache.resolve_remote(req.git_repo_url, req.git_ref, fresh=True) == job.source_commit
+        except Exception as e:
+            logger.warning(f"Failed to resolve {req.git_repo_url} {req.git_ref or 'HEAD'}: {e}")
+            return False
+
+    def _supersede_queued(self, job: DeployJob) -> list:
+        # ロック取得済みの状態で呼ぶこと。バッチやpromoteは置き換えない
+        pending = self._pending.get(job.app_name)
+        if not pending:
+            return []
+        superseded = [unit for unit in pending if isinstance(unit, DeployJob) and unit.runner is None]
+        for unit in superseded:
+            pending.remove(unit)
+        if not pending:
+            self._pending.pop(job.app_name, None)
+        return superseded
+
+    def submit_batch(self, reqs, build_concurrency: int = None) -> DeployBatch:
+        names = [req.app_name for req in reqs]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise HTTPException(status_code=400, detail=f"Duplicate app_name in batch: {', '.join(duplicates)}")
+        if not reqs:
+            raise HTTPException(status_code=400, detail="Batch has no deploys")
+        batch = DeployBatch(reqs, build_concurrency or DEPLOY_BATCH_BUILD_CONCURRENCY, self._on_finish)
+        with self._lock:
+            self._batches[batch.batch_id] = batch
+            for job in batch.jobs:
+                self._jobs[job.job_id] = job
+            self._enqueue(batch)
+            self._prune()
+        logger.info(f"Queued deploy batch {batch.batch_id} for {', '.join(names)}")
+        return batch
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_batch(self, batch_id: str):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def list(self, app_name: str = None):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if app_name:
+            jobs = [j for j in jobs if j.app_name == app_name]
+        return jobs
+
+    def busy_apps(self) -> set:
+        """待機中・実行中のジョブがあるアプリ名"""
+        with self._lock:
+            return set(self._pending) | set(self._running)
+
+    def _enqueue(self, unit):
+        # ロック取得済みの状態で呼ぶこと
+        for app_name in unit.app_names:
+            self._pending.setdefault(app_name, deque()).append(unit)
+        self._try_start(unit)
+
+    def _try_start(self, unit):
+        # ロック取得済みの状態で呼ぶこと。全アプリで先頭かつ実行中でなければ開始
+        for app_name in unit.app_names:
+            pending = self._pending.get(app_name)
+            if app_name in self._running or not pending or pending[0] is not unit:
+                return
+        for app_name in unit.app_names:
+            pending = self._pending[app_name]
+            pending.popleft()
+            if not pending:
+                self._pending.pop(app_name, None)
+            self._running[app_name] = unit
+        self._executor.submit(self._run, unit)
+
+    def _release(self, unit):
+        with self._lock:
+            for app_name in unit.app_names:
+                self._running.pop(app_name, None)
+            for app_name in unit.app_names:
+                pending = self._pending.get(app_name)
+                if pending:
+                    self._try_start(pending[0])
+
+    def _run(self, unit):
+        try:
+            if isinstance(unit, DeployBatch):
+                self._run_batch(unit)
+            else:
+                self._run_job(unit)
+        finally:
+            self._release(unit)
+
+    def _run_job(self, job: DeployJob):
+        job.mark_running()
+        try:
+            job.succeed((job.runner or self._runner)(job))
+        except Exception as e:
+            job.fail(e)
+
+    def _run_batch(self, batch: DeployBatch):
+        batch.started_at = time.time()
+        batch._set_status("running")
+        batch.emit("batch", "started")
+        try:
+            batch.report = self._batch_runner(batch)
+            batch.emit("batch", "completed", report=batch.report)
+        except Exception as e:
+            batch.error = e.detail if isinstance(e, HTTPException) else str(e)
+            batch.emit("batch", "failed", str(batch.error)[:500])
+            logger.error(f"Deploy batch {batch.batch_id} failed: {batch.error}")
+        finally:
+            # 結果が記録されていないジョブは失敗扱いにする
+            for job in batch.jobs:
+                if job.status not in FINISHED_STATUSES:
+                    job.fail(HTTPException(status_code=500, detail=batch.error or "Batch aborted"))
+            batch.finished_at = time.time()
+            batch.clear_stages()
+            batch._set_status("failed" if batch.error else "completed")
+
+    def _prune(self):
+        # 古い完了済みジョブから削除（実行中・待機中は残す）
+        finished = [j for j in self._jobs.values() if j.status in FINISHED_STATUSES]
+        excess = len(finished) - self._history_limit
+        for job in finished[:max(excess, 0)]:
+            self._jobs.pop(job.job_id, None)
+            job.log.delete()
+        finished = [b for b in self._batches.values() if b.status in FINISHED_STATUSES]
+        excess = len(finished) - self._history_limit
+        for batch in finished[:max(excess, 0)]:
+            self._batches.pop(batch.batch_id, None)
@@ -0,0 +1,1157 @@
+import os
+import json
+import shutil
+import subprocess
+import datetime
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.common import (
+    get_resolved_config,
+    ensure_security_group_rules,
+    CLUSTER_NAME,
+)
+from utils.clients import get_client
+from utils.alb_rules import listener_rules, forward_weights
+from utils.waiters import service_waiter
+from utils.git_cache import mirror_cache, CLONE_BASE_DIR
+from utils.images import (
+    compute_content_key, content_tag, get_git_commit_sha, git_context_prefix, git_source, ensure_repository, find_image_digest,
+)
+from utils.ecr_login import ensure_docker_login
+from utils.builders import get_builder, BUILD_CACHE_REPO_SUFFIX
+from utils.capacity import capacity_strategy, describe_capacity, spot_monitor, strategy_differs, validate_capacity
+from utils.build_workers import build_pool
+from utils.aws import build_task_definition, register_task_definition, update_ecs_service, delete_ecs_service, create_ecs_service, scale_ecs_service
+from utils.autoscaling import apply_autoscaling, copy_autoscaling, remove_autoscaling, initial_desired_count, SCALING_METRICS
+from utils.blue_green import resolve_slots, choose_slots, serving_slots, candidate_slot, other_slot, forward_actions, green_weight
+from utils.step_graph import StepGraph
+from utils.task_definitions import task_definitions, current_task_definition, diff_task_definition, log_diff
+from utils.validation import (
+    validate_request,
+    check_path_conflicts,
+    find_path_conflicts,
+    conflict_error,
+    parse_task_size,
+    target_group_name,
+    environment_validator,
+)
+
+HEALTH_CHECK_PATH = "/"
+# アーキテクチャごとのビルドプラットフォーム（内容キーにも含める）とFargateのcpuArchitecture
+# bothはamd64/arm64のマルチアーキテクチャイメージをビルドし、Graviton（ARM64）で起動する
+ARCHITECTURES = {
+    "amd64": {"platform": "linux/amd64", "cpu_architecture": "X86_64"},
+    "arm64": {"platform": "linux/arm64", "cpu_architecture": "ARM64"},
+    "both": {"platform": "linux/amd64,linux/arm64", "cpu_architecture": "ARM64"},
+}
+# 待機を成功とみなすサービスの状態（scaled_to_zeroはタスク数0で起動したサービス）
+HEALTHY_STATUSES = ("healthy", "scaled_to_zero")
+
+
+def _wrap_error(e: Exception) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    logger.error(f"Deployment failed: {e}")
+    traceback.print_exc()
+    return HTTPException(status_code=500, detail=str(e))
+
+
+DEPLOY_STRATEGIES = ("rolling", "blue_green")
+
+
+def check_deploy_request(req):
+    """キュー登録前にリクエストの明らかな誤りを400で返す"""
+    if req.deploy_strategy not in DEPLOY_STRATEGIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown deploy_strategy: {req.deploy_strategy} (available: {', '.join(DEPLOY_STRATEGIES)})",
+        )
+    validate_request(req)
+    if req.architecture not in ARCHITECTURES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown architecture: {req.architecture} (available: {', '.join(ARCHITECTURES)})",
+        )
+    if req.architecture == "both" and get_builder(req.build_backend).name != "buildx":
+        # docker buildは複数プラットフォームのマニフェストリストを1回で作れない
+        raise HTTPException(status_code=400, detail="architecture=both requires build_backend=buildx")
+    if req.capacity is not None:
+        validate_capacity(req.capacity, req.architecture)
+    if req.canary_percent is not None:
+        if req.deploy_strategy != "blue_green":
+            raise HTTPException(status_code=400, detail="canary_percent requires deploy_strategy=blue_green")
+        if not 1 <= req.canary_percent <= 99:
+            raise HTTPException(status_code=400, detail="canary_percent must be between 1 and 99")
+    if req.desired_count is not None and req.desired_count < 0:
+        raise HTTPException(status_code=400, detail="desired_count must be 0 or more")
+    scaling = req.autoscaling
+    if scaling and scaling.enabled:
+        if not 0 <= scaling.min_tasks <= scaling.max_tasks or scaling.max_tasks < 1:
+            raise HTTPException(status_code=400, detail="autoscaling requires 0 <= min_tasks <= max_tasks and max_tasks >= 1")
+        if scaling.metric not in SCALING_METRICS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown autoscaling metric: {scaling.metric} (available: {', '.join(SCALING_METRICS)})",
+            )
+        if scaling.target_value <= 0:
+            raise HTTPException(status_code=400, detail="autoscaling.target_value must be positive")
+        if scaling.metric == "alb_requests" and not get_resolved_config().alb_arn:
+            # サービスを更新した後で失敗しないよう、受け付け時に確認する
+            raise HTTPException(status_code=400, detail="autoscaling metric alb_requests requires alb_arn in the configuration")
+        if req.desired_count is not None and not scaling.min_tasks <= req.desired_count <= scaling.max_tasks:
+            raise HTTPException(status_code=400, detail="desired_count must be within autoscaling min_tasks..max_tasks")
+
+
+def check_rolling_slot(req, weight: int):
+    """greenスロットがトラフィックを受けている間のローリングデプロイは409
+
+    promote後はblue（{app}）のタスク数が0のため、ローリングデプロイでルールをblueへ戻すと応答するタスクが無くなる。
+    """
+    if req.deploy_strategy == "rolling" and weight > 0:
+        raise HTTPException(
+            status_code=409,
+            detail=f"{req.app_name}-green is serving traffic; deploy with deploy_strategy=blue_green "
+                   f"(a rolling deploy would route traffic to the scaled-down {req.app_name} service)",
+        )
+
+
+def validate_deploy(job, config):
+    """クローン・ビルドの前に、デプロイ先の環境と他アプリとのパスの重なりを確認する"""
+    req = job.request
+    with job.stage("validate"):
+        environment_validator.check(config)
+        if req.capacity:
+            environment_validator.check_capacity_providers(config, capacity_strategy(req.capacity))
+        check_path_conflicts(config.alb_listener_arn, req.app_name, req.alb_path)
+        if req.deploy_strategy == "rolling":
+            check_rolling_slot(req, green_weight(config.alb_listener_arn, req.app_name, req.alb_path))
+
+
+def resolve_protocol(config) -> str:
+    """ALBにHTTPSリスナーがあればhttps、なければhttp"""
+    protocol = "http"
+    try:
+        if config.alb_arn:
+            listeners = get_client("elbv2").describe_listeners(LoadBalancerArn=config.alb_arn)["Listeners"]
+            if any(listener["Port"] == 443 for listener in listeners):
+                protocol = "https"
+    except Exception:
+        protocol = "http"
+    return protocol
+
+
+def prepare_config():
+    """ALB設定 - Terraform outputsと環境変数から解決済みの設定を使用"""
+    config = get_resolved_config()
+    config.require("alb_listener_arn")
+    config.require("alb_dns_name")
+    config.require("vpc_id")
+    return config
+
+
+def apply_security_groups(job):
+    """セキュリティグループルールの確認・追加"""
+    with job.stage("security_groups"):
+        ensure_security_group_rules()
+
+
+def prepare_shared(job):
+    """全アプリ共通の事前処理（SGルール・設定解決・プロトコル判定）。SGルールとプロトコル判定は並列に行う"""
+    config = prepare_config()
+    graph = StepGraph("shared")
+    graph.add("security_groups", lambda: apply_security_groups(job))
+    graph.add("protocol", lambda: resolve_protocol(config))
+    return {"config": config, "protocol": graph.run()["protocol"]}
+
+
+def prepare_source(job):
+    """git_repo_urlが指定されていればミラーキャッシュから深さ1で展開する
+
+    戻り値: (ビルドコンテキスト, 後で削除する一時ディレクトリ, コミットSHA)
+    """
+    req = job.request
+    if not req.git_repo_url:
+        return req.docker_context, None, None
+
+    with job.stage("clone"):
+        job.source_pinned = True
+        os.makedirs(CLONE_BASE_DIR, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        temp_dir = os.path.join(CLONE_BASE_DIR, f"{req.app_name}_{timestamp}_{job.job_id[:8]}")
+        try:
+            commit_sha = mirror_cache.checkout(req.git_repo_url, req.git_ref, temp_dir)
+        except subprocess.CalledProcessError as e:
+            cleanup_source(temp_dir)
+            output = e.output.decode(errors="replace") if e.output else ""
+            raise HTTPException(status_code=400, detail=f"Git clone failed: {e}\n{output}")
+        except Exception as e:
+            cleanup_source(temp_dir)
+            raise HTTPException(status_code=400, detail=f"Git clone failed: {e}")
+        job.source_commit = commit_sha
+        job.emit("clone", "info", f"{req.git_ref or 'HEAD'} -> {commit_sha}")
+    return temp_dir, temp_dir, commit_sha
+
+
+def cleanup_source(temp_dir):
+    if temp_dir and os.path.exists(temp_dir):
+        try:
+            shutil.rmtree(temp_dir)
+            logger.info(f"Cleaned up: {temp_dir}")
+        except Exception as cleanup_e:
+            logger.warning(f"Cleanup failed: {cleanup_e}")
+
+
+def ensure_ecr_repository(job) -> str:
+    """ECRリポジトリURL取得（なければ作成）"""
+    with job.stage("ecr_repository"):
+        return ensure_repository(get_client("ecr"), job.request.app_name)
+
+
+def build_image(job, docker_context, docker_logged_in: bool = False, ecr_url: str = None) -> dict:
+    """内容キーを計算し、ECRに無ければビルド・プッシュしてイメージ情報を返す
+
+    ecr_urlを渡すとリポジトリの確認を省略する（クローンと並行して確認済みの場合）。
+    """
+    req = job.request
+    app_name = req.app_name
+    ecr = get_client("ecr")
+
+    # ビルドバックエンドの選択（リクエスト指定 > BUILD_BACKEND）
+    builder = get_builder(req.build_backend)
+
+    if ecr_url is None:
+        ecr_url = ensure_ecr_repository(job)
+
+    # ソースの内容キーを計算し、ECRに同じイメージがあればビルド・プッシュを省略
+    platform = ARCHITECTURES[req.architecture]["platform"]
+    with job.stage("content_key"):
+        job.source_pinned = True
+        content = compute_content_key(docker_context, req.dockerfile, platform)
+        image_tag = content["tag"]
+        image_digest = None if req.force_rebuild else find_image_digest(ecr, app_name, image_tag)
+        cache_hit = image_digest is not None
+        job.emit(
+            "content_key", "info",
+            f"{image_tag} ({content['source']}) {'found in ECR' if cache_hit else 'not built yet'}",
+        )
+
+    if not cache_hit:
+        def local_login():
+            # ローカルでビルドする場合のみDockerログイン（キャッシュ済みトークンが有効ならスキップ）
+            if docker_logged_in:
+                return
+            with job.stage("ecr_login"):
+                docker_login = ensure_docker_login()
+                job.emit("ecr_login", "info", "docker login refreshed" if docker_login["refreshed"] else "cached login reused")
+
+        # レイヤーキャッシュ用のECRリポジトリ（buildxのみ）
+        cache_repo = None
+        if builder.uses_registry_cache:
+            with job.stage("cache_repository"):
+                cache_repo = ensure_repository(ecr, f"{app_name}{BUILD_CACHE_REPO_SUFFIX}")
+
+        # Dockerビルド＆プッシュ（内容キーのタグとlatestの両方）。空いているローカル/リモートの実行先で行う
+        try:
+            build = build_pool.build_and_push(
+                builder, job, docker_context, req.dockerfile, platform, ecr_url, [image_tag, "latest"], cache_repo,
+                before_local=local_login,
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            err_msg = f"{builder.name} build exception: {e}\n{traceback.format_exc()}"
+            raise HTTPException(status_code=500, detail=err_msg)
+        image_digest = build["digest"] or find_image_digest(ecr, app_name, image_tag)
+    else:
+        build = {"backend": None, "digest": image_digest, "cache": None, "executor": None}
+
+    # タスク定義ではダイジェスト（取得できなければ不変タグ）でイメージを固定する
+    image_uri = f"{ecr_url}@{image_digest}" if image_digest else f"{ecr_url}:{image_tag}"
+    return {
+        "uri": image_uri,
+        "tag": image_tag,
+        "digest": image_digest,
+        "source": content["source"],
+        "cache_hit": cache_hit,
+        "build": {
+            "backend": build["backend"],
+            "layer_cache": build["cache"],
+            "executor": build["executor"],
+            "skipped": cache_hit,
+        },
+    }
+
+
+def ensure_target_group(job, vpc_id: str, tg_name: str = None) -> str:
+    """ターゲットグループの確認・作成・更新（VPC整合性チェック付き）"""
+    elbv2 = get_client("elbv2")
+    tg_name = tg_name or f"{job.app_name}-tg"
+
+    with job.stage("target_group"):
+        existing_tg = None
+        try:
+            existing_tg = elbv2.describe_target_groups(Names=[tg_name])["TargetGroups"][0]
+        except elbv2.exceptions.TargetGroupNotFoundException:
+            pass
+
+        # VPC IDの整合性をチェック
+        if existing_tg and existing_tg["VpcId"] != vpc_id:
+            logger.warning(f"Target group '{tg_name}' exists in different VPC ({existing_tg['VpcId']}) than ALB ({vpc_id}). Deleting and recreating...")
+            # 既存のターゲットグループを削除し、下記の作成処理に進む
+            elbv2.delete_target_group(TargetGroupArn=existing_tg["TargetGroupArn"])
+            logger.info(f"Deleted target group '{tg_name}' from incorrect VPC")
+            existing_tg = None
+
+        if existing_tg:
+            # VPCが一致している場合は既存のものを使用
+            tg_arn = existing_tg["TargetGroupArn"]
+            logger.info(f"Using existing target group: {tg_name} (VPC: {vpc_id})")
+
+            # ヘルスチェック設定を最適化
+            elbv2.modify_target_group(
+                TargetGroupArn=tg_arn,
+                HealthCheckPath=HEALTH_CHECK_PATH,
+                HealthCheckIntervalSeconds=30,
+                HealthCheckTimeoutSeconds=5,
+                HealthyThresholdCount=2,
+                UnhealthyThresholdCount=3,
+                Matcher={'HttpCode': '200'}
+            )
+            logger.info(f"Updated health check settings for target group '{tg_name}'")
+            job.resources["target_group_arn"] = tg_arn
+            return tg_arn
+
+        logger.info(f"Creating new target group: {tg_name} in VPC: {vpc_id}")
+        tg = elbv2.create_target_group(
+            Name=tg_name,
+            Protocol="HTTP",
+            Port=7860,
+            VpcId=vpc_id,
+            TargetType="ip",
+            HealthCheckPath=HEALTH_CHECK_PATH,
+            HealthCheckProtocol="HTTP",
+            HealthCheckIntervalSeconds=30,
+            HealthCheckTimeoutSeconds=5,
+            HealthyThresholdCount=2,
+            UnhealthyThresholdCount=3,
+            Matcher={'HttpCode': '200'}
+        )
+        logger.info(f"Created target group: {tg_name} in VPC: {vpc_id}")
+        job.resources["target_group_arn"] = tg["TargetGroups"][0]["TargetGroupArn"]
+        return job.resources["target_group_arn"]
+
+
+def apply_listener_rules(listener_arn: str, targets):
+    """複数アプリのALBルールを作成・修正する
+
+    targets: [(job, alb_path, tg_arn)]。ルールはプロセス内インデックスから引き、
+    新規ルールの優先度はインデックスのロック内で空いている値を割り当てる。
+    戻り値: 失敗したジョブIDごとのHTTPException
+    """
+    errors = {}
+    for job, alb_path, tg_arn in targets:
+        try:
+            with job.stage("listener_rule"):
+                rule = listener_rules.ensure_forward_rule(listener_arn, alb_path, tg_arn)
+                job.resources.update(rule_arn=rule["rule_arn"], rule_priority=rule["priority"])
+                job.emit("listener_rule", "info", f"{alb_path} priority {rule['priority']} ({rule['action']})")
+        except Exception as e:
+            errors[job.job_id] = _wrap_error(e)
+    return errors
+
+
+def ensure_log_group(job) -> str:
+    """CloudWatch Logsのロググループを確認・作成する"""
+    logs = get_client("logs")
+    log_group_name = f"/ecs/{job.app_name}"
+    with job.stage("log_group"):
+        try:
+            logs.create_log_group(logGroupName=log_group_name)
+            logger.info(f"Created log group: {log_group_name}")
+        except logs.exceptions.ResourceAlreadyExistsException:
+            logger.info(f"Log group already exists: {log_group_name}")
+    return log_group_name
+
+
+def desired_task_definition(app_name: str, cpu: str, memory: str, image_uri: str, config, gradio_root_path: str,
+                            architecture: str = "amd64") -> dict:
+    """登録しようとしているタスク定義（CPU/メモリはECSが返す表記に揃える）"""
+    cpu_units, memory_mib = parse_task_size(cpu, memory)
+    return build_task_definition(
+        app_name, str(cpu_units), str(memory_mib), image_uri, gradio_root_path, f"/ecs/{app_name}",
+        config.require("ecs_task_execution_role_arn"), config.require("ecs_task_role_arn"),
+        ARCHITECTURES[architecture]["cpu_architecture"],
+    )
+
+
+def register_task(job, image_uri: str, config, gradio_root_path: str, services: list = None) -> dict:
+    """タスク定義を用意する（ロール等はTerraform outputsから取得）
+
+    サービスが使っている定義（サービスがなければファミリーの最新リビジョン）と比べ、
+    revision等を除いて差分がなければ新しいリビジョンを登録せずにそのまま使う。
+    戻り値: {"arn", "changed", "diff"}
+    """
+    req = job.request
+    desired = desired_task_definition(req.app_name, req.cpu, req.memory, image_uri, config, gradio_root_path, req.architecture)
+    with job.stage("task_definition"):
+        current = current_task_definition(services, req.app_name)
+        diff = diff_task_definition(current, desired)
+        if diff:
+            log_diff(req.app_name, diff)
+            arn = register_task_definition(get_client("ecs"), desired)
+            job.emit("task_definition", "info", f"Registered {arn.rsplit('/', 1)[-1]} ({', '.join(c['field'] for c in diff[:5])})")
+        else:
+            arn = current["taskDefinitionArn"]
+            job.emit("task_definition", "info", f"Unchanged; reusing {arn.rsplit('/', 1)[-1]}")
+    job.resources["task_definition_arn"] = arn
+    return {"arn": arn, "changed": bool(diff), "diff": diff}
+
+
+def describe_service(service_name: str) -> list:
+    """サービスの現在の状態（describe_servicesの結果）"""
+    return get_client("ecs").describe_services(cluster=CLUSTER_NAME, services=[service_name])["services"]
+
+
+def _strategy_label(strategy) -> str:
+    if not strategy:
+        return "launchType FARGATE"
+    return ", ".join(f"{s['capacityProvider']} weight={s.get('weight', 0)} base={s.get('base', 0)}" for s in strategy)
+
+
+def ensure_service(job, tg_arn: str, config, service_name: str = None, desired_count: int = None,
+                   services: list = None, task_definition: dict = None, capacity_provider_strategy: list = None) -> str:
+    """ECSサービスを作成または更新し、オートスケーリングを登録する
+
+    servicesに事前に取得したdescribe_servicesの結果を渡すと問い合わせを省略する。
+    task_definitionはregister_taskの戻り値。サービスが既にその定義・配分で動いていれば
+    ロールアウトせず、タスク数の変更だけを反映する。
+    capacity_provider_strategyはreq.capacityが未指定のときに使う配分（ブルー/グリーンで旧側から引き継ぐ）。
+    """
+    req = job.request
+    app_name = req.app_name
+    service_name = service_name or app_name
+    if desired_count is None:
+        desired_count = req.desired_count
+    ecs = get_client("ecs")
+    # 未指定ならファミリーの最新リビジョン
+    task_definition_arn = task_definition["arn"] if task_definition else app_name
+    strategy = capacity_strategy(req.capacity) if req.capacity else capacity_provider_strategy
+
+    # サブネット・セキュリティグループ設定（SUBNETS未設定ならprivate_subnet_ids）
+    subnets = list(config.subnets)
+    security_groups = list(config.security_groups)
+
+    # ECSサービスの処理
+    job.resources["service"] = service_name
+    with job.stage("service"):
+        if services is None:
+            services = describe_service(service_name)
+        force_recreate = req.force_recreate and service_name == app_name
+
+        if services and services[0]["status"] == "ACTIVE" and not force_recreate:
+            service = services[0]
+            same_definition = service["taskDefinition"] == task_definition_arn
+            strategy_changed = bool(strategy) and strategy_differs(service, strategy)
+            if strategy_changed:
+                # 配分の変更（launchTypeからの切り替えを含む）は新しいデプロイで反映する
+                job.emit(
+                    "service", "info",
+                    f"Capacity: {_strategy_label(service.get('capacityProviderStrategy'))} -> {_strategy_label(strategy)}",
+                )
+                deployment_type = update_ecs_service(
+                    ecs, app_name, task_definition_arn, service_name, desired_count, capacity_provider_strategy=strategy,
+                )
+                spot_monitor.forget(service_name)
+            elif same_definition and desired_count in (None, service["desiredCount"]):
+                # タスク定義もタスク数も同じならロールアウトしない
+                logger.info(f"ECS service {service_name} already runs {task_definition_arn}; skipping update")
+                job.emit("service", "info", "Unchanged; no rollout")
+                deployment_type = "unchanged"
+            elif same_definition:
+                # タスク数だけを変える（新しいデプロイは行わない）
+                update_ecs_service(ecs, app_name, task_definition_arn, service_name, desired_count, force_new_deployment=False)
+                deployment_type = "scale"
+            else:
+                # 既存サービスを更新（desired_count未指定ならオートスケーリングで決まった数を維持）
+                logger.info(f"Updating existing ECS service: {service_name}")
+                deployment_type = update_ecs_service(ecs, app_name, task_definition_arn, service_name, desired_count)
+        else:
+            # 新しいサービスを作成
+            if services and force_recreate:
+                deleted = delete_ecs_service(ecs, app_name)
+                if deleted:
+                    # 同名サービスを作り直せるよう、削除（INACTIVE化）の完了を待つ
+                    outcome = service_waiter.watch_deleted(app_name).wait()
+                    if outcome["status"] == "deleted":
+                        logger.info(f"Service deletion completed after {outcome['elapsed_seconds']} seconds")
+                        job.emit("service", "info", f"Old service deleted in {outcome['elapsed_seconds']}s")
+                    else:
+                        logger.warning(f"Service deletion not confirmed: {outcome['message']}")
+
+            deployment_type = create_ecs_service(
+                ecs, app_name, task_definition_arn, tg_arn, subnets, security_groups,
+                service_name, initial_desired_count(req) if desired_count is None else desired_count,
+                capacity_provider_strategy=strategy,
+            )
+            spot_monitor.forget(service_name)
+
+    # Application Auto Scalingの登録（autoscaling未指定なら既存設定のまま）
+    if req.autoscaling:
+        with job.stage("autoscaling"):
+            scaling = apply_autoscaling(service_name, req.autoscaling, tg_arn, config.alb_arn)
+            job.emit("autoscaling", "info", json.dumps(scaling))
+    return deployment_type
+
+
+def deploy_service(job, image_uri: str, tg_arn: str, config, gradio_root_path: str,
+                   service_name: str = None, desired_count: int = None, capacity_provider_strategy: list = None) -> str:
+    """ロググループ・タスク定義・ECSサービスを作成または更新する
+
+    ロググループ・タスク定義の登録・既存サービスの確認は互いに依存しないため並列に行う。
+    service_nameを指定するとそのサービス（ブルー/グリーンのスロット）を対象にする。
+    """
+    service_name = service_name or job.app_name
+    graph = StepGraph("service")
+    graph.add("log_group", lambda: ensure_log_group(job))
+    graph.add("lookup", lambda: describe_service(service_name))
+    graph.add(
+        "task_definition",
+        lambda: register_task(job, image_uri, config, gradio_root_path, graph.results["lookup"]),
+        after=("lookup",),
+    )
+    graph.add(
+        "service",
+        lambda: ensure_service(
+            job, tg_arn, config, service_name, desired_count, graph.results["lookup"], graph.results["task_definition"],
+            capacity_provider_strategy,
+        ),
+        after=("log_group", "task_definition", "lookup"),
+    )
+    return graph.run()["service"]
+
+
+def deployed_url_for(shared, alb_path: str):
+    """(デプロイURL, GRADIO_ROOT_PATH) を返す"""
+    base_path = alb_path.rstrip("/*").rstrip("/")
+    return f"{shared['protocol']}://{shared['config'].alb_dns_name}{base_path}", base_path
+
+
+def _health_from(outcome) -> dict:
+    return {
+        "status": outcome["status"],
+        "time_to_healthy_seconds": outcome["elapsed_seconds"] if outcome["status"] == "healthy" else None,
+        "message": outcome["message"],
+        "running_count": outcome.get("running_count"),
+        "healthy_targets": outcome.get("healthy_targets"),
+    }
+
+
+def _unhealthy_error(health) -> HTTPException:
+    return HTTPException(
+        status_code=504 if health["status"] == "timeout" else 500,
+        detail=f"Service did not become healthy ({health['status']}): {health['message']}",
+    )
+
+
+def track_health(job, tg_arn: str, service_name: str = None) -> dict:
+    """ロールアウト完了とターゲットのヘルスチェック成功を監視する
+
+    job.wait_healthyならその場で待ち、そうでなければバックグラウンドで監視して
+    結果（実測のtime-to-healthy）を後から返り値のdictとイベントに反映する。
+    """
+    health = {"status": "pending", "time_to_healthy_seconds": None}
+    watch = service_waiter.watch_healthy(service_name or job.app_name, tg_arn)
+
+    def record(outcome):
+        health.update(_health_from(outcome))
+        job.emit("health", outcome["status"], outcome["message"], elapsed_seconds=outcome["elapsed_seconds"])
+
+    if not job.wait_healthy:
+        def record_in_background(outcome):
+            # ジョブ完了後に計測できた安定化までの時間もステージとして記録する
+            job.record_timing("stabilization", outcome["elapsed_seconds"],
+                              "completed" if outcome["status"] in HEALTHY_STATUSES else "failed")
+            if isinstance(job.result, dict):
+                job.result["timings"]["stabilization"] = job.timings["stabilization"]
+            record(outcome)
+            job.notify()
+
+        watch.add_done_callback(record_in_background)
+        return health
+
+    with job.stage("stabilization"):
+        record(watch.wait())
+        if health["status"] not in HEALTHY_STATUSES:
+            raise _unhealthy_error(health)
+    return health
+
+
+def _serving_unchanged(req, slots: dict, image_uri: str, config, gradio_root_path: str):
+    """1つのスロットだけがトラフィックを受けていて、そのタスク定義・タスク数が今回と同じならそのスロット名"""
+    serving = serving_slots(slots)
+    if len(serving) != 1 or req.force_recreate:
+        return None
+    current = slots[serving[0]]
+    if not current.get("task_definition") or req.desired_count not in (None, current["desired_count"]):
+        return None
+    desired = desired_task_definition(req.app_name, req.cpu, req.memory, image_uri, config, gradio_root_path, req.architecture)
+    if diff_task_definition(task_definitions.get(current["task_definition"]), desired):
+        return None
+    if req.capacity and strategy_differs(
+        {"capacityProviderStrategy": current.get("capacity_provider_strategy")}, capacity_strategy(req.capacity)
+    ):
+        return None
+    return serving[0]
+
+
+def deploy_blue_green(job, image_uri: str, shared, gradio_root_path: str):
+    """待機側スロットへデプロイし、正常になってからリスナールールを切り替える
+
+    canary_percentが指定されていれば新旧を重み付きで振り分けたまま残し、/apps/{app}/promoteで確定する。
+    戻り値: (deployment_type, health)
+    """
+    req = job.request
+    config = shared["config"]
+    listener_arn = config.alb_listener_arn
+    ecs = get_client("ecs")
+
+    with job.stage("blue_green"):
+        state = resolve_slots(listener_arn, req.app_name, req.alb_path)
+        slots = state["slots"]
+        unchanged = _serving_unchanged(req, slots, image_uri, config, gradio_root_path)
+        if unchanged:
+            job.emit("blue_green", "info", f"{unchanged} slot already serves this task definition; no rollout")
+        else:
+            new_slot, old_slot = choose_slots(slots)
+            job.emit("blue_green", "info", f"Deploying to {new_slot} slot" + (f" (serving: {old_slot})" if old_slot else ""))
+
+    if unchanged:
+        current = slots[unchanged]
+        job.resources.update(
+            service=current["service"], target_group_arn=current["tg_arn"], task_definition_arn=current["task_definition"],
+        )
+        if state["rule"]:
+            job.resources.update(rule_arn=state["rule"]["rule_arn"], rule_priority=state["rule"]["priority"])
+        if req.autoscaling:
+            with job.stage("autoscaling"):
+                scaling = apply_autoscaling(current["service"], req.autoscaling, current["tg_arn"], config.alb_arn)
+                job.emit("autoscaling", "info", json.dumps(scaling))
+        return f"unchanged:{unchanged}", track_health(job, current["tg_arn"], current["service"])
+
+    new = slots[new_slot]
+    old = slots[old_slot] if old_slot else None
+    tg_arn = ensure_target_group(job, config.vpc_id, new["tg_name"])
+    # 新しい側は旧側と同じタスク数で起動する（desired_count指定時はそれを優先）
+    desired_count = req.desired_count
+    if desired_count is None:
+        desired_count = (old or {}).get("desired_count") or initial_desired_count(req)
+    # capacity未指定なら旧側と同じ配分で起動する（中断でオンデマンドへ寄せている間はその前の配分）
+    deploy_service(
+        job, image_uri, tg_arn, config, gradio_root_path, new["service"], desired_count,
+        spot_monitor.original_strategy(old["service"], old.get("capacity_provider_strategy")) if old else None,
+    )
+
+    # 切り替え前に新しい側が正常になるのを待つ（失敗時は旧側がそのまま応答し続ける）
+    with job.stage("stabilization"):
+        health = _health_from(service_waiter.watch_healthy(new["service"], tg_arn).wait())
+        job.emit("health", health["status"], health["message"])
+        if health["status"] not in HEALTHY_STATUSES:
+            raise _unhealthy_error(health)
+
+    if old and not req.autoscaling:
+        # autoscaling未指定なら旧側のスケーリング設定を新しい側へ引き継ぐ（旧側はdrainで解除される）
+        with job.stage("autoscaling"):
+            scaling = copy_autoscaling(old["service"], new["service"], tg_arn, config.alb_arn)
+            if scaling:
+                job.emit("autoscaling", "info", json.dumps(scaling))
+
+    percent = req.canary_percent if old and req.canary_percent is not None else 100
+    with job.stage("switch"):
+        actions = forward_actions(tg_arn, percent, old["tg_arn"] if old else None)
+        rule = listener_rules.ensure_rule(listener_arn, req.alb_path, actions)
+        job.resources.update(rule_arn=rule["rule_arn"], rule_priority=rule["priority"])
+        job.emit("switch", "info", f"{new_slot} {percent}% / {old_slot or '-'} {100 - percent}% ({rule['action']})")
+
+    if old and percent >= 100:
+        # 旧側のタスクを止める。登録解除の遅延中は既存の接続がそのまま処理される
+        with job.stage("drain"):
+            # スケーリング対象のままだと最小タスク数まで戻されるため先に解除する
+            remove_autoscaling(old["service"])
+            scale_ecs_service(ecs, old["service"], 0)
+    return f"blue_green:{new_slot}", health
+
+
+def run_promote(job):
+    """カナリア中のアプリの振り分けを変更する（100で確定、0でロールバック）"""
+    percent = job.request.percent
+    config = get_resolved_config()
+    listener_arn = config.require("alb_listener_arn")
+    ecs = get_client("ecs")
+    try:
+        with job.stage("blue_green"):
+            state = resolve_slots(listener_arn, job.app_name)
+            slots = state["slots"]
+            new_slot = candidate_slot(slots)
+            if state["rule"] is None or new_slot is None:
+                raise HTTPException(status_code=400, detail=f"No canary in progress for {job.app_name}")
+            old_slot = other_slot(new_slot)
+            alb_path = state["rule"]["paths"][0]
+
+        with job.stage("switch"):
+            actions = forward_actions(slots[new_slot]["tg_arn"], percent, slots[old_slot]["tg_arn"])
+            listener_rules.ensure_rule(listener_arn, alb_path, actions)
+            job.emit("switch", "info", f"{new_slot} {percent}% / {old_slot} {100 - percent}%")
+
+        if percent >= 100:
+            # カナリアのデプロイ時に引き継いでいなければ、旧側を解除する前に設定をコピーする
+            with job.stage("autoscaling"):
+                copy_autoscaling(
+                    slots[old_slot]["service"], slots[new_slot]["service"], slots[new_slot]["tg_arn"], config.alb_arn,
+                    overwrite=False,
+                )
+
+        if percent >= 100 or percent <= 0:
+            drained = old_slot if percent >= 100 else new_slot
+            with job.stage("drain"):
+                remove_autoscaling(slots[drained]["service"])
+                scale_ecs_service(ecs, slots[drained]["service"], 0)
+
+        return {
+            "status": "success",
+            "app_name": job.app_name,
+            "alb_path": alb_path,
+            "weights": {new_slot: percent, old_slot: 100 - percent},
+            "promoted": percent >= 100,
+            "rolled_back": percent <= 0,
+        }
+    except Exception as e:
+        raise _wrap_error(e)
+
+
+def build_result(job, shared, deployed_url, commit_sha, image, deployment_type, health) -> dict:
+    req = job.request
+
+    # 成功ログとレスポンス
+    logger.info(f"🚀 Deployment completed: {deployed_url}")
+    logger.info(f"💾 Resources: CPU={req.cpu}, Memory={req.memory}")
+    if health["status"] == "healthy":
+        logger.info(f"⏱️  Service became healthy in {health['time_to_healthy_seconds']}s")
+
+    return {
+        "status": "success",
+        "message": f"{req.app_name} deployed successfully!",
+        "deployed_url": deployed_url,
+        "alb_dns_name": shared["config"].alb_dns_name,
+        "alb_path": req.alb_path,
+        "app_name": req.app_name,
+        "protocol": shared["protocol"],
+        "cpu": req.cpu,
+        "memory": req.memory,
+        "deployment_type": deployment_type,
+        "git_ref": req.git_ref,
+        "commit_sha": commit_sha,
+        "image": {k: v for k, v in image.items() if k != "build"},
+        "build": image["build"],
+        "health": health,
+        "capacity": _capacity_of(job.resources.get("service")),
+        "resources": dict(job.resources),
+    }
+
+
+def _capacity_of(service_name: str):
+    # 結果の表示用なので、問い合わせに失敗してもデプロイは失敗にしない
+    if not service_name:
+        return None
+    try:
+        return describe_capacity(service_name)
+    except Exception as e:
+        logger.warning(f"Could not describe capacity of {service_name}: {e}")
+        return None
+
+
+def _plan_image(req) -> list:
+    """ECRリポジトリとイメージの予定。内容キーのイメージがECRにあればビルドしない"""
+    ecr = get_client("ecr")
+    try:
+        repository = ecr.describe_repositories(repositoryNames=[req.app_name])["repositories"][0]
+    except ecr.exceptions.RepositoryNotFoundException:
+        repository = None
+    changes = [{"resource": "ecr_repository", "name": req.app_name, "action": "none" if repository else "create"}]
+
+    prefix = ""
+    if req.git_repo_url:
+        try:
+            commit_sha = mirror_cache.resolve_remote(req.git_repo_url, req.git_ref)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Git ref could not be resolved: {e}")
+        if commit_sha is None:
+            raise HTTPException(status_code=400, detail=f"Git ref not found: {req.git_ref or 'HEAD'}")
+    else:
+        commit_sha = get_git_commit_sha(req.docker_context)
+        prefix = git_context_prefix(req.docker_context) if commit_sha else ""
+
+    image = {"resource": "image", "name": None, "action": "build", "source": None}
+    if commit_sha:
+        # コミットが決まれば内容キーもクローンせずに決まる
+        image["source"] = git_source(commit_sha, prefix)
+        image["name"] = content_tag(image["source"], req.dockerfile, ARCHITECTURES[req.architecture]["platform"])
+        digest = find_image_digest(ecr, req.app_name, image["name"]) if repository and not req.force_rebuild else None
+        if digest:
+            image["action"] = "reuse"
+            image["uri"] = f"{repository['repositoryUri']}@{digest}"
+    else:
+        # 未コミットのローカルコンテキストは、デプロイ時にハッシュを計算してから判断する
+        image["action"] = "build_if_changed"
+    changes.append(image)
+    return changes
+
+
+def _log_group_exists(name: str) -> bool:
+    groups = get_client("logs").describe_log_groups(logGroupNamePrefix=name)["logGroups"]
+    return any(group["logGroupName"] == name for group in groups)
+
+
+def plan_deploy(req) -> dict:
+    """dry_run用。デプロイと同じ検証を行い、実際に行う変更の一覧を返す（AWSリソースは変更しない）
+
+    読み取りの問い合わせは互いに依存しないため並列に行う。
+    """
+    started = time.perf_counter()
+    check_deploy_request(req)
+    cpu, memory = parse_task_size(req.cpu, req.memory)
+    try:
+        config = prepare_config()
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    listener_arn = config.alb_listener_arn
+
+    graph = StepGraph("plan")
+    graph.add("environment", lambda: environment_validator.check(config))
+    graph.add("conflicts", lambda: find_path_conflicts(listener_arn, req.app_name, req.alb_path))
+    graph.add("protocol", lambda: resolve_protocol(config))
+    graph.add("slots", lambda: resolve_slots(listener_arn, req.app_name, req.alb_path))
+    graph.add("image", lambda: _plan_image(req))
+    graph.add("log_group", lambda: _log_group_exists(f"/ecs/{req.app_name}"))
+    results = graph.run()
+    if results["conflicts"]:
+        raise conflict_error(req.alb_path, results["conflicts"])
+    if req.capacity:
+        environment_validator.check_capacity_providers(config, capacity_strategy(req.capacity))
+
+    slots = results["slots"]["slots"]
+    check_rolling_slot(req, slots["green"]["weight"])
+    # 既存のイメージを使う場合はタスク定義まで比べられる
+    image_uri = next((c.get("uri") for c in results["image"] if c["resource"] == "image"), None)
+    _, gradio_root_path = deployed_url_for({"protocol": None, "config": config}, req.alb_path)
+    unchanged_slot = None
+    if req.deploy_strategy == "blue_green" and image_uri:
+        unchanged_slot = _serving_unchanged(req, slots, image_uri, config, gradio_root_path)
+    if unchanged_slot:
+        new_slot, old_slot = unchanged_slot, None
+    elif req.deploy_strategy == "blue_green":
+        new_slot, old_slot = choose_slots(slots)
+    else:
+        new_slot, old_slot = "blue", None
+    new = slots[new_slot]
+    old = slots[old_slot] if old_slot else None
+    service_active = "desired_count" in new
+
+    changes = list(results["image"])
+    changes.append({"resource": "target_group", "name": new["tg_name"], "action": "update" if new["tg_arn"] else "create"})
+    changes.append({
+        "resource": "log_group", "name": f"/ecs/{req.app_name}",
+        "action": "none" if results["log_group"] else "create",
+    })
+    task_definition = {"resource": "task_definition", "name": req.app_name, "action": "register", "cpu": cpu, "memory": memory}
+    definition_changed = True
+    if image_uri:
+        desired = desired_task_definition(req.app_name, req.cpu, req.memory, image_uri, config, gradio_root_path, req.architecture)
+        current = task_definitions.get(new["task_definition"]) if service_active else current_task_definition(None, req.app_name)
+        task_definition["diff"] = diff_task_definition(current, desired)
+        definition_changed = bool(task_definition["diff"])
+        if not definition_changed:
+            task_definition["action"] = "none"
+    changes.append(task_definition)
+
+    if req.desired_count is not None:
+        desired_count = req.desired_count
+    elif req.deploy_strategy == "blue_green" and not unchanged_slot:
+        desired_count = (old or {}).get("desired_count") or initial_desired_count(req)
+    else:
+        desired_count = new["desired_count"] if service_active else initial_desired_count(req)
+    # capacity未指定なら、ブルー/グリーンでは旧側の配分を引き継ぎ、それ以外は現在の配分のまま
+    strategy = capacity_strategy(req.capacity) if req.capacity else None
+    if strategy is None and old:
+        strategy = spot_monitor.original_strategy(old["service"], old.get("capacity_provider_strategy"))
+    current_strategy = new.get("capacity_provider_strategy") if service_active else None
+    strategy_changed = bool(strategy) and service_active and strategy_differs(
+        {"capacityProviderStrategy": current_strategy}, strategy
+    )
+    if service_active and req.force_recreate and new["service"] == req.app_name:
+        service_action = "recreate"
+    elif not service_active:
+        service_action = "create"
+    elif definition_changed or strategy_changed:
+        service_action = "update"
+    else:
+        service_action = "none" if desired_count == new["desired_count"] else "scale"
+    changes.append({
+        "resource": "service", "name": new["service"], "action": service_action, "desired_count": desired_count,
+        "capacity": _strategy_label(strategy or current_strategy),
+    })
+
+    rule = listener_rules.find_by_path(listener_arn, req.alb_path)
+    if req.deploy_strategy == "blue_green":
+        percent = req.canary_percent if old and req.canary_percent is not None else 100
+        weights = {new["tg_name"]: percent, **({old["tg_name"]: 100 - percent} if old else {})}
+    else:
+        weights = {new["tg_name"]: 100}
+    if rule is None:
+        rule_action = "create"
+    elif new["tg_arn"] and _weights_by_name(rule["actions"]) == {k: v for k, v in weights.items() if v}:
+        rule_action = "none"
+    else:
+        rule_action = "modify"
+    changes.append({
+        "resource": "listener_rule", "name": req.alb_path, "action": rule_action,
+        "priority": rule["priority"] if rule else None, "weights": weights,
+    })
+    if old and weights.get(old["tg_name"], 0) == 0:
+        changes.append({"resource": "service", "name": old["service"], "action": "drain", "desired_count": 0})
+    if req.autoscaling:
+        changes.append({
+            "resource": "autoscaling", "name": new["service"],
+            "action": "apply" if req.autoscaling.enabled else "remove",
+        })
+
+    deployed_url, _ = deployed_url_for({"protocol": results["protocol"], "config": config}, req.alb_path)
+    return {
+        "status": "dry_run",
+        "app_name": req.app_name,
+        "deploy_strategy": req.deploy_strategy,
+        "slot": new_slot if req.deploy_strategy == "blue_green" else None,
+        "changed": any(c["action"] not in ("none", "reuse") for c in changes),
+        "deployed_url": deployed_url,
+        "checks": results["environment"],
+        "changes": changes,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def _weights_by_name(actions) -> dict:
+    # ルールの転送先をターゲットグループ名と重み（%）で表す
+    weights = forward_weights(actions)
+    total = sum(weights.values()) or 1
+    return {target_group_name(arn): round(w * 100 / total) for arn, w in weights.items()}
+
+
+def plan_task_definition(app_name: str, service_name: str = None, image_uri: str = None, cpu: str = None,
+                         memory: str = None, alb_path: str = None, architecture: str = None) -> dict:
+    """アプリの現在のタスク定義と、指定した内容（未指定の項目は現在の値）で登録する定義との差分"""
+    if architecture is not None and architecture not in ARCHITECTURES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown architecture: {architecture} (available: {', '.join(ARCHITECTURES)})",
+        )
+    config = get_resolved_config()
+    service_name = service_name or app_name
+    current = current_task_definition(describe_service(service_name), app_name)
+    if current is None and not (image_uri and cpu and memory):
+        # 比べる定義が無く、未指定の項目を埋められない
+        raise HTTPException(status_code=404, detail=f"No task definition found for {app_name} (specify image, cpu and memory)")
+
+    container = (current or {}).get("containerDefinitions", [{}])[0]
+    environment = {e["name"]: e["value"] for e in container.get("environment", [])}
+    if alb_path:
+        _, gradio_root_path = deployed_url_for({"protocol": None, "config": config}, alb_path)
+    else:
+        gradio_root_path = environment.get("GRADIO_ROOT_PATH", "")
+    image_uri = image_uri or container.get("image")
+    cpu = cpu or current["cpu"]
+    memory = memory or current["memory"]
+    if architecture is None:
+        current_architecture = (current or {}).get("runtimePlatform", {}).get("cpuArchitecture", "X86_64")
+        architecture = "arm64" if current_architecture == "ARM64" else "amd64"
+    try:
+        desired = desired_task_definition(app_name, cpu, memory, image_uri, config, gradio_root_path, architecture)
+    except ValueError as e:
+        # 実行ロール等の設定が解決できない
+        raise HTTPException(status_code=400, detail=str(e))
+    diff = diff_task_definition(current, desired)
+    return {
+        "app_name": app_name,
+        "service": service_name,
+        "current_task_definition": current["taskDefinitionArn"] if current else None,
+        "changed": bool(diff),
+        "diff": diff,
+        "desired": {
+            "image": image_uri,
+            "cpu": desired["cpu"],
+            "memory": desired["memory"],
+            "cpu_architecture": desired["runtimePlatform"]["cpuArchitecture"],
+            "gradio_root_path": gradio_root_path,
+        },
+    }
+
+
+def run_deployment(job):
+    """デプロイジョブ本体。各ステージの進捗をjobへ記録しながら実行する
+
+    互いに依存しない手順（SGルール・プロトコル判定・ECRリポジトリ・クローン・ターゲットグループ・
+    リスナールール・ロググループ・既存サービスの確認）はビルドと並行して実行し、
+    サービスの作成/更新は必要な手順がすべて終わってから行う。
+    """
+    req = job.request
+    graph = StepGraph("deploy")
+    try:
+        config = prepare_config()
+        _, gradio_root_path = deployed_url_for({"protocol": None, "config": config}, req.alb_path)
+        validate_deploy(job, config)
+
+        graph.add("security_groups", lambda: apply_security_groups(job))
+        graph.add("protocol", lambda: resolve_protocol(config))
+        graph.add("ecr_repository", lambda: ensure_ecr_repository(job))
+        graph.add("source", lambda: prepare_source(job))
+        graph.add(
+            "image",
+            lambda: build_image(job, graph.results["source"][0], ecr_url=graph.results["ecr_repository"]),
+            after=("source", "ecr_repository"),
+        )
+
+        if req.deploy_strategy == "blue_green":
+            graph.run()
+        else:
+            def listener_rule():
+                errors = apply_listener_rules(config.alb_listener_arn, [(job, req.alb_path, graph.results["target_group"])])
+                if errors:
+                    raise errors[job.job_id]
+
+            graph.add("target_group", lambda: ensure_target_group(job, config.vpc_id))
+            # 新しいアプリのパスが空のターゲットグループへ向かないよう、ルールはビルド成功後に反映する
+            graph.add("listener_rule", listener_rule, after=("target_group", "image"))
+            graph.add("log_group", lambda: ensure_log_group(job))
+            graph.add("lookup", lambda: describe_service(req.app_name))
+            graph.add(
+                "task_definition",
+                lambda: register_task(job, graph.results["image"]["uri"], config, gradio_root_path, graph.results["lookup"]),
+                after=("image", "lookup"),
+            )
+            graph.add(
+                "service",
+                lambda: ensure_service(
+                    job, graph.results["target_group"], config,
+                    services=graph.results["lookup"], task_definition=graph.results["task_definition"],
+                ),
+                after=("task_definition", "log_group", "listener_rule", "security_groups", "lookup"),
+            )
+            graph.run()
+
+        shared = {"config": config, "protocol": graph.results["protocol"]}
+        _, _, commit_sha = graph.results["source"]
+        image = graph.results["image"]
+        deployed_url, _ = deployed_url_for(shared, req.alb_path)
+        logger.info(f"ALB DNS Name: {config.alb_dns_name}")
+        logger.info(f"Target URL: {deployed_url}")
+        logger.info(f"Gradio Root Path: {gradio_root_path}")
+        logger.info(f"Health Check Path: {HEALTH_CHECK_PATH}")
+
+        if req.deploy_strategy == "blue_green":
+            deployment_type, health = deploy_blue_green(job, image["uri"], shared, gradio_root_path)
+            return build_result(job, shared, deployed_url, commit_sha, image, deployment_type, health)
+
+        health = track_health(job, graph.results["target_group"])
+        return build_result(job, shared, deployed_url, commit_sha, image, graph.results["service"], health)
+
+    except Exception as e:
+        raise _wrap_error(e)
+    finally:
+        # クリーンアップ
+        if "source" in graph.results:
+            cleanup_source(graph.results["source"][1])
+
+
+def run_batch(batch):
+    """複数アプリのデプロイ。共通処理は1回だけ行い、ビルドは並列、ALBルールは一括で反映する"""
+    jobs = list(batch.jobs)
+    temp_dirs = []
+    prepared = {}
+
+    # 共通処理（SGルール・設定解決・プロトコル判定・ローカルビルド用のECRログイン）を1回だけ実行
+    shared = prepare_shared(batch)
+    config = shared["config"]
+    if build_pool.local is not None:
+        with batch.stage("ecr_login"):
+            ensure_docker_login()
+
+    def build_one(job):
+        job.mark_running()
+        validate_deploy(job, config)
+        docker_context, temp_dir, commit_sha = prepare_source(job)
+        temp_dirs.append(temp_dir)
+        image = build_image(job, docker_context, docker_logged_in=True)
+        # ブルー/グリーンはスロットのターゲットグループを後で用意する
+        tg_arn = None if job.request.deploy_strategy == "blue_green" else ensure_target_group(job, config.vpc_id)
+        return {"commit_sha": commit_sha, "image": image, "tg_arn": tg_arn}
+
+    def deploy_one(job):
+        item = prepared[job.job_id]
+        deployed_url, gradio_root_path = deployed_url_for(shared, job.request.alb_path)
+        if job.request.deploy_strategy == "blue_green":
+            deployment_type, health = deploy_blue_green(job, item["image"]["uri"], shared, gradio_root_path)
+            return build_result(job, shared, deployed_url, item["commit_sha"], item["image"], deployment_type, health)
+        deployment_type = deploy_service(job, item["image"]["uri"], item["tg_arn"], config, gradio_root_path)
+        health = track_health(job, item["tg_arn"])
+        return build_result(job, shared, deployed_url, item["commit_sha"], item["image"], deployment_type, health)
+
+    try:
+        # ビルド・プッシュ・ターゲットグループをbuild_concurrency並列で実行
+        with batch.stage("build"):
+            with ThreadPoolExecutor(max_workers=batch.build_concurrency, thread_name_prefix="batch-build") as pool:
+                futures = {job.job_id: pool.submit(build_one, job) for job in jobs}
+                for job in jobs:
+                    try:
+                        prepared[job.job_id] = futures[job.job_id].result()
+                    except Exception as e:
+                        job.fail(_wrap_error(e))
+
+        # ALBルールをまとめて反映（優先度はインデックスが衝突しないよう割り当てる）
+        ready = [job for job in jobs if job.job_id in prepared]
+        with batch.stage("listener_rules"):
+            errors = apply_listener_rules(
+                config.alb_listener_arn,
+                [(job, job.request.alb_path, prepared[job.job_id]["tg_arn"]) for job in ready
+                 if prepared[job.job_id]["tg_arn"]],
+            )
+        for job in ready:
+            if job.job_id in errors:
+                job.fail(errors[job.job_id])
+        ready = [job for job in ready if job.job_id not in errors]
+
+        # タスク定義・サービスの作成/更新
+        with batch.stage("services"):
+            with ThreadPoolExecutor(max_workers=batch.build_concurrency, thread_name_prefix="batch-service") as pool:
+                futures = {job.job_id: pool.submit(deploy_one, job) for job in ready}
+                for job in ready:
+                    try:
+                        job.succeed(futures[job.job_id].result())
+                    except Exception as e:
+                        job.fail(_wrap_error(e))
+    finally:
+        for temp_dir in temp_dirs:
+            cleanup_source(temp_dir)
+
+    return {
+        job.app_name: {
+            "job_id": job.job_id,
+            "status": job.status,
+            "deployed_url": (job.result or {}).get("deployed_url"),
+            "image": (job.result or {}).get("image"),
+            "error": job.error,
+        }
+        for job in jobs
+    }
@@ -0,0 +1,374 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+from utils.alb_rules import listener_rules
+from utils.aws import list_cluster_services
+from utils.clients import get_client
+from utils.common import get_resolved_config
+
+# デプロイ状態を記録するSQLiteファイル
+DEPLOY_REGISTRY_PATH = os.path.abspath(os.getenv("DEPLOY_REGISTRY_PATH", "deploy_registry.sqlite3"))
+# AWSの実際の状態と突き合わせる間隔（秒）。0なら突き合わせない
+DEPLOY_REGISTRY_RECONCILE_SECONDS = int(os.getenv("DEPLOY_REGISTRY_RECONCILE_SECONDS", "300"))
+# アプリごとに保持するデプロイ履歴の件数
+DEPLOY_REGISTRY_HISTORY_LIMIT = int(os.getenv("DEPLOY_REGISTRY_HISTORY_LIMIT", "100"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    app_name TEXT PRIMARY KEY,
+    alb_path TEXT,
+    deployed_url TEXT,
+    deploy_strategy TEXT,
+    service TEXT,
+    image_uri TEXT,
+    image_tag TEXT,
+    image_digest TEXT,
+    commit_sha TEXT,
+    task_definition_arn TEXT,
+    task_definition_revision INTEGER,
+    target_group_arn TEXT,
+    rule_arn TEXT,
+    rule_priority INTEGER,
+    cpu TEXT,
+    memory TEXT,
+    health_status TEXT,
+    service_status TEXT,
+    desired_count INTEGER,
+    running_count INTEGER,
+    last_job_id TEXT,
+    last_outcome TEXT,
+    last_error TEXT,
+    source TEXT,
+    deployed_at REAL,
+    updated_at REAL,
+    reconciled_at REAL
+);
+CREATE TABLE IF NOT EXISTS deployments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT UNIQUE,
+    batch_id TEXT,
+    app_name TEXT NOT NULL,
+    operation TEXT,
+    outcome TEXT,
+    error TEXT,
+    deployment_type TEXT,
+    alb_path TEXT,
+    image_tag TEXT,
+    image_digest TEXT,
+    commit_sha TEXT,
+    task_definition_arn TEXT,
+    task_definition_revision INTEGER,
+    target_group_arn TEXT,
+    rule_arn TEXT,
+    cpu TEXT,
+    memory TEXT,
+    health_status TEXT,
+    time_to_healthy_seconds REAL,
+    timings TEXT,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS deployments_app ON deployments (app_name, id);
+CREATE TABLE IF NOT EXISTS spot_fallbacks (
+    service TEXT PRIMARY KEY,
+    strategy TEXT,
+    until REAL,
+    updated_at REAL
+);
+"""
+
+_JSON_COLUMNS = ("timings",)
+
+
+def _revision(task_definition_arn):
+    if not task_definition_arn:
+        return None
+    return int(task_definition_arn.rsplit(":", 1)[1])
+
+
+def _row_dict(row) -> dict:
+    data = dict(row)
+    for column in _JSON_COLUMNS:
+        if column in data and data[column] is not None:
+            data[column] = json.loads(data[column])
+    return data
+
+
+class DeployRegistry:
+    """デプロイ結果をSQLiteに記録し、AWSへ問い合わせずにアプリ一覧・履歴を返す
+
+    デプロイジョブの完了時に記録し、バックグラウンドの突き合わせで
+    ECSサービスの実際の状態（タスク数・タスク定義・削除済みか）を反映する。
+    """
+
+    def __init__(self, path: str = DEPLOY_REGISTRY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._thread = None
+        self.last_reconcile = None
+
+    def _db(self) -> sqlite3.Connection:
+        # ロック取得済みの状態で呼ぶこと
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def record_job(self, job):
+        """デプロイジョブの結果を履歴とアプリの現在状態に反映する（同じジョブは上書き）"""
+        req = job.request
+        operation = "deploy" if job.runner is None else job.runner.__name__.replace("run_", "", 1)
+        result = job.result if isinstance(job.result, dict) else {}
+        resources = getattr(job, "resources", {})
+        image = result.get("image") or {}
+        health = result.get("health") or {}
+        task_definition_arn = resources.get("task_definition_arn")
+        entry = {
+            "job_id": job.job_id,
+            "batch_id": job.batch_id,
+            "app_name": job.app_name,
+            "operation": operation,
+            "outcome": job.status,
+            "error": None if job.error is None else str(job.error)[:2000],
+            "deployment_type": result.get("deployment_type"),
+            "alb_path": result.get("alb_path") or getattr(req, "alb_path", None),
+            "image_tag": image.get("tag"),
+            "image_digest": image.get("digest"),
+            "commit_sha": result.get("commit_sha"),
+            "task_definition_arn": task_definition_arn,
+            "task_definition_revision": _revision(task_definition_arn),
+            "target_group_arn": resources.get("target_group_arn"),
+            "rule_arn": resources.get("rule_arn"),
+            "cpu": getattr(req, "cpu", None) if operation == "deploy" else None,
+            "memory": getattr(req, "memory", None) if operation == "deploy" else None,
+            "health_status": health.get("status"),
+            "time_to_healthy_seconds": health.get("time_to_healthy_seconds"),
+            "timings": json.dumps(job.timings),
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+        }
+        columns = ", ".join(entry)
+        placeholders = ", ".join(f":{k}" for k in entry)
+        updates = ", ".join(f"{k} = excluded.{k}" for k in entry if k != "job_id")
+
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    f"INSERT INTO deployments ({columns}) VALUES ({placeholders}) "
+                    f"ON CONFLICT(job_id) DO UPDATE SET {updates}",
+                    entry,
+                )
+                db.execute(
+                    "DELETE FROM deployments WHERE app_name = ? AND id NOT IN "
+                    "(SELECT id FROM deployments WHERE app_name = ? ORDER BY id DESC LIMIT ?)",
+                    (job.app_name, job.app_name, DEPLOY_REGISTRY_HISTORY_LIMIT),
+                )
+                if operation != "deploy" or job.status == "superseded":
+                    return
+                # 後続のデプロイが既に記録されていれば（バックグラウンドのヘルス更新など）現在状態は上書きしない
+                latest = db.execute(
+                    "SELECT job_id FROM deployments WHERE app_name = ? AND operation = 'deploy' ORDER BY id DESC LIMIT 1",
+                    (job.app_name,),
+                ).fetchone()
+                if latest["job_id"] != job.job_id:
+                    return
+                db.execute(
+                    "INSERT INTO apps (app_name, source) VALUES (?, 'deploy') ON CONFLICT(app_name) DO NOTHING",
+                    (job.app_name,),
+                )
+                db.execute(
+                    "UPDATE apps SET last_job_id = ?, last_outcome = ?, last_error = ?, updated_at = ? WHERE app_name = ?",
+                    (job.job_id, job.status, entry["error"], time.time(), job.app_name),
+                )
+                if job.status != "succeeded":
+                    return
+                db.execute(
+                    """UPDATE apps SET alb_path = :alb_path, deployed_url = :deployed_url,
+                        deploy_strategy = :deploy_strategy, service = :service, image_uri = :image_uri,
+                        image_tag = :image_tag, image_digest = :image_digest, commit_sha = :commit_sha,
+                        task_definition_arn = :task_definition_arn,
+                        task_definition_revision = :task_definition_revision,
+                        target_group_arn = :target_group_arn,
+                        rule_arn = COALESCE(:rule_arn, rule_arn), rule_priority = COALESCE(:rule_priority, rule_priority),
+                        cpu = :cpu, memory = :memory, health_status = :health_status, deployed_at = :deployed_at
+                    WHERE app_name = :app_name""",
+                    {
+                        **entry,
+                        "deployed_url": result.get("deployed_url"),
+                        "deploy_strategy": req.deploy_strategy,
+                        "service": resources.get("service"),
+                        "image_uri": image.get("uri"),
+                        "rule_priority": resources.get("rule_priority"),
+                        "deployed_at": job.finished_at,
+                    },
+                )
+
+    def list_apps(self) -> list:
+        with self._lock:
+            rows = self._db().execute("SELECT * FROM apps ORDER BY app_name").fetchall()
+        return [_row_dict(row) for row in rows]
+
+    def get_app(self, app_name: str):
+        with self._lock:
+            row = self._db().execute("SELECT * FROM apps WHERE app_name = ?", (app_name,)).fetchone()
+        return _row_dict(row) if row else None
+
+    def history(self, app_name: str, limit: int = 20) -> list:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT * FROM deployments WHERE app_name = ? ORDER BY id DESC LIMIT ?", (app_name, limit)
+            ).fetchall()
+        return [_row_dict(row) for row in rows]
+
+    def spot_fallbacks(self) -> dict:
+        """オンデマンドへ寄せているサービス -> {"strategy": 元の配分, "until": 戻す時刻}"""
+        with self._lock:
+            rows = self._db().execute("SELECT service, strategy, until FROM spot_fallbacks").fetchall()
+        return {row["service"]: {"strategy": json.loads(row["strategy"]), "until": row["until"]} for row in rows}
+
+    def save_spot_fallback(self, service: str, strategy: list, until: float):
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT INTO spot_fallbacks (service, strategy, until, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(service) DO UPDATE SET strategy = excluded.strategy, until = excluded.until, "
+                    "updated_at = excluded.updated_at",
+                    (service, json.dumps(strategy), until, time.time()),
+                )
+
+    def delete_spot_fallback(self, service: str):
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM spot_fallbacks WHERE service = ?", (service,))
+
+    def start_reconciler(self, interval: float = DEPLOY_REGISTRY_RECONCILE_SECONDS):
+        """一定間隔でreconcile()を実行するデーモンスレッドを起動する"""
+        if interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    logger.warning(f"Registry reconcile failed: {e}")
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name="registry-reconciler", daemon=True)
+        self._thread.start()
+
+    def reconcile(self) -> dict:
+        """ECSクラスターのサービスを一覧し、記録と実際の状態を揃える
+
+        - 記録済みアプリ: サービスの状態・タスク数と、外部で変更されたタスク定義を反映
+        - サービスが無くなったアプリ: service_statusをMISSINGにする
+        - 記録の無いサービス: タスク定義とリスナールールから取り込む（ブルー/グリーンの-greenスロットは除く）
+        """
+        started = time.time()
+        ecs = get_client("ecs")
+        with self._lock:
+            known = {row["app_name"]: dict(row) for row in self._db().execute("SELECT * FROM apps").fetchall()}
+
+        services = list_cluster_services(ecs)
+
+        tracked = {row["service"] or app_name: app_name for app_name, row in known.items()}
+        updates = []
+        for service_name, app_name in tracked.items():
+            row = known[app_name]
+            service = services.get(service_name)
+            if service is None or service["status"] != "ACTIVE":
+                updates.append({"app_name": app_name, "service_status": "MISSING", "desired_count": 0, "running_count": 0})
+                continue
+            update = {
+                "app_name": app_name,
+                "service_status": service["status"],
+                "desired_count": service["desiredCount"],
+                "running_count": service["runningCount"],
+            }
+            if service["taskDefinition"] != row["task_definition_arn"]:
+                update.update(self._task_definition_fields(service["taskDefinition"]))
+            updates.append(update)
+
+        imported = []
+        slot_services = {f"{name}-green" for name in set(tracked) | set(services)}
+        listener_arn = get_resolved_config().alb_listener_arn
+        for service_name, service in services.items():
+            if service_name in tracked or service_name in known or service_name in slot_services or service["status"] != "ACTIVE":
+                continue
+            update = {
+                "app_name": service_name,
+                "service": service_name,
+                "service_status": service["status"],
+                "desired_count": service["desiredCount"],
+                "running_count": service["runningCount"],
+                "source": "reconciler",
+                **self._task_definition_fields(service["taskDefinition"]),
+            }
+            tg_arn = next((lb["targetGroupArn"] for lb in service.get("loadBalancers", []) if lb.get("targetGroupArn")), None)
+            update["target_group_arn"] = tg_arn
+            if tg_arn and listener_arn:
+                rule = listener_rules.find_by_target_group(listener_arn, tg_arn)
+                if rule:
+                    update.update(rule_arn=rule["rule_arn"], rule_priority=rule["priority"], alb_path=rule["paths"][0])
+            updates.append(update)
+            imported.append(service_name)
+
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                for update in updates:
+                    db.execute("INSERT INTO apps (app_name) VALUES (?) ON CONFLICT(app_name) DO NOTHING", (update["app_name"],))
+                    fields = {k: v for k, v in update.items() if k != "app_name"}
+                    fields["reconciled_at"] = now
+                    assignments = ", ".join(f"{k} = :{k}" for k in fields)
+                    db.execute(f"UPDATE apps SET {assignments} WHERE app_name = :app_name", {**fields, "app_name": update["app_name"]})
+
+        self.last_reconcile = {
+            "at": now,
+            "duration_seconds": round(now - started, 3),
+            "services": len(services),
+            "apps": len(updates),
+            "imported": imported,
+        }
+        if imported:
+            logger.info(f"Registry imported services: {', '.join(imported)}")
+        return self.last_reconcile
+
+    @staticmethod
+    def _task_definition_fields(task_definition_arn: str) -> dict:
+        task_definition = get_client("ecs").describe_task_definition(taskDefinition=task_definition_arn)["taskDefinition"]
+        image_uri = task_definition["containerDefinitions"][0]["image"]
+        return {
+            "task_definition_arn": task_definition_arn,
+            "task_definition_revision": task_definition["revision"],
+            "cpu": task_definition.get("cpu"),
+            "memory": task_definition.get("memory"),
+            "image_uri": image_uri,
+            "image_digest": image_uri.split("@", 1)[1] if "@" in image_uri else None,
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            db = self._db()
+            apps = db.execute("SELECT COUNT(*) FROM apps").fetchone()[0]
+            deployments = db.execute("SELECT COUNT(*) FROM deployments").fetchone()[0]
+        return {"path": self.path, "apps": apps, "deployments": deployments, "last_reconcile": self.last_reconcile}
+
+
+deploy_registry = DeployRegistry()
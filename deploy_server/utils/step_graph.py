@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from loguru import logger
+
+
+class StepGraph:
+    """依存関係のあるデプロイ手順を、依存が揃ったものから並列に実行する
+
+    各手順は依存先の結果を受け取らず、必要な値は戻り値をresults経由で参照する。
+    ある手順が失敗すると、まだ開始していない手順は実行せず、実行中の手順の終了を待ってから
+    最初の例外を送出する。
+    """
+
+    def __init__(self, name: str = "deploy"):
+        self.name = name
+        self.results = {}
+        self._steps = {}
+
+    def add(self, name: str, fn, after=()):
+        """手順を追加する。afterに指定した手順がすべて成功してから実行する"""
+        for dep in after:
+            if dep not in self._steps:
+                raise ValueError(f"Unknown dependency for {name}: {dep}")
+        self._steps[name] = (fn, tuple(after))
+        return self
+
+    def run(self) -> dict:
+        """全手順を実行して {手順名: 戻り値} を返す"""
+        pending = dict(self._steps)
+        running = {}
+        error = None
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max(1, len(pending)), thread_name_prefix=f"{self.name}-step") as pool:
+            while pending or running:
+                if error is None:
+                    ready = [name for name, (_, after) in pending.items() if all(dep in self.results for dep in after)]
+                    for name in ready:
+                        fn, _ = pending.pop(name)
+                        running[pool.submit(fn)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                        continue
+                    self.results[name] = result
+
+        if error is not None:
+            skipped = sorted(set(self._steps) - set(self.results))
+            logger.debug(f"Step graph {self.name} failed; not completed: {', '.join(skipped)}")
+            raise error
+        logger.debug(f"Step graph {self.name} finished in {time.perf_counter() - started:.2f}s")
+        return self.results
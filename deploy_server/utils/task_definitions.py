@@ -0,0 +1,125 @@
+import os
+import threading
+from collections import OrderedDict
+
+from loguru import logger
+
+from utils.clients import get_client
+
+# describe_task_definitionの結果を保持する件数（リビジョンの内容は変わらないためARN単位でキャッシュできる）
+TASK_DEFINITION_CACHE_SIZE = int(os.getenv("TASK_DEFINITION_CACHE_SIZE", "256"))
+
+# 差分の表示でコンテナ定義を名前で特定するフィールド
+_KEYED_LISTS = {"containerDefinitions": "name", "environment": "name", "secrets": "name"}
+# 登録時に省略するとECSが使う値（明示していない既存のリビジョンと比べても差分にしない）
+_IMPLICIT_DEFAULTS = {"runtimePlatform": {"cpuArchitecture": "X86_64", "operatingSystemFamily": "LINUX"}}
+
+
+class TaskDefinitionCache:
+    """タスク定義リビジョンの内容をARNごとにキャッシュする
+
+    サービスが使っているリビジョンは必要になった時点で1度だけdescribeし、以降は再利用する。
+    ファミリー名（最新リビジョン）での問い合わせは毎回行い、結果のARNでキャッシュする。
+    """
+
+    def __init__(self, max_size: int = TASK_DEFINITION_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._definitions = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, task_definition: str):
+        """ARN（またはファミリー名）のタスク定義を返す。見つからなければNone"""
+        is_arn = task_definition.startswith("arn:")
+        if is_arn:
+            with self._lock:
+                if task_definition in self._definitions:
+                    self._definitions.move_to_end(task_definition)
+                    self.hits += 1
+                    return self._definitions[task_definition]
+        ecs = get_client("ecs")
+        try:
+            definition = ecs.describe_task_definition(taskDefinition=task_definition)["taskDefinition"]
+        except ecs.exceptions.ClientException:
+            return None
+        with self._lock:
+            self.misses += 1
+            self._definitions[definition["taskDefinitionArn"]] = definition
+            while len(self._definitions) > self.max_size:
+                self._definitions.popitem(last=False)
+        return definition
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"cached": len(self._definitions), "hits": self.hits, "misses": self.misses}
+
+
+def _keyed(items: list, key: str) -> dict:
+    return {item.get(key): item for item in items if isinstance(item, dict)}
+
+
+def _diff(path: str, current, desired, changes: list, list_key: str = None):
+    # desiredに含まれるフィールドだけを比べる（ECSが補うデフォルト値やrevisionなどは無視する）
+    if isinstance(desired, dict):
+        current = current if isinstance(current, dict) else {}
+        for field, value in desired.items():
+            _diff(f"{path}.{field}" if path else field, current.get(field), value, changes, _KEYED_LISTS.get(field))
+        return
+    if isinstance(desired, list) and list_key:
+        current_items = _keyed(current or [], list_key)
+        desired_items = _keyed(desired, list_key)
+        for name in sorted(set(current_items) | set(desired_items), key=str):
+            item_path = f"{path}[{name}]"
+            if name not in desired_items:
+                changes.append({"field": item_path, "current": current_items[name], "desired": None})
+            elif name not in current_items:
+                changes.append({"field": item_path, "current": None, "desired": desired_items[name]})
+            else:
+                _diff(item_path, current_items[name], desired_items[name], changes)
+        return
+    if isinstance(desired, list):
+        current = current or []
+        if len(current) != len(desired):
+            changes.append({"field": path, "current": current, "desired": desired})
+            return
+        before = len(changes)
+        for i, (c, d) in enumerate(zip(current, desired)):
+            _diff(f"{path}[{i}]", c, d, changes)
+        if len(changes) > before:
+            # リストの一部だけ違う場合もリスト全体を1件として示す
+            del changes[before:]
+            changes.append({"field": path, "current": current, "desired": desired})
+        return
+    if current != desired:
+        changes.append({"field": path, "current": current, "desired": desired})
+
+
+def diff_task_definition(current: dict, desired: dict) -> list:
+    """登録済みのタスク定義と登録しようとしている定義の差分（[{"field", "current", "desired"}]）
+
+    currentがNoneなら、すべてが新規として1件の差分を返す。
+    """
+    if current is None:
+        return [{"field": "taskDefinition", "current": None, "desired": desired["family"]}]
+    changes = []
+    _diff("", {**_IMPLICIT_DEFAULTS, **current}, desired, changes)
+    return changes
+
+
+def current_task_definition(services: list, family: str):
+    """比較の基準にするタスク定義。ACTIVEなサービスがあればその定義、なければファミリーの最新リビジョン"""
+    active = next((s for s in services or [] if s.get("status") == "ACTIVE"), None)
+    if active:
+        return task_definitions.get(active["taskDefinition"])
+    definition = task_definitions.get(family)
+    if definition is not None and definition.get("status") != "ACTIVE":
+        return None
+    return definition
+
+
+def log_diff(name: str, changes: list):
+    for change in changes[:20]:
+        logger.info(f"Task definition {name} differs at {change['field']}: {change['current']!r} -> {change['desired']!r}")
+
+
+task_definitions = TaskDefinitionCache()
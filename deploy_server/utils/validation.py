@@ -0,0 +1,291 @@
+import fnmatch
+import os
+import posixpath
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+from loguru import logger
+
+from utils.alb_rules import listener_rules
+from utils.blue_green import SLOTS, slot_names
+from utils.clients import get_client
+from utils.step_graph import StepGraph
+
+# ロール・サブネット・SGの存在確認結果を再利用する秒数（設定が変わればすぐ取り直す）
+DEPLOY_VALIDATION_CACHE_SECONDS = int(os.getenv("DEPLOY_VALIDATION_CACHE_SECONDS", "300"))
+
+# Fargateで指定できるCPU（CPUユニット）ごとのメモリ（MiB）
+FARGATE_TASK_SIZES = {
+    256: (512, 1024, 2048),
+    512: tuple(range(1024, 4097, 1024)),
+    1024: tuple(range(2048, 8193, 1024)),
+    2048: tuple(range(4096, 16385, 1024)),
+    4096: tuple(range(8192, 30721, 1024)),
+    8192: tuple(range(16384, 61441, 4096)),
+    16384: tuple(range(32768, 122881, 8192)),
+}
+
+# アプリ名はECRリポジトリ・ECSサービス・ターゲットグループ名にそのまま使う
+_APP_NAME_RE = re.compile(r"^[a-z0-9](?:[a-z0-9-]*[a-z0-9])?$")
+_TARGET_GROUP_NAME_MAX = 32
+# ALBのpath-patternで使える文字（*と?はワイルドカード）
+_ALB_PATH_RE = re.compile(r"^/[A-Za-z0-9_\-.$/~\"'@:+&*?]*$")
+_ALB_PATH_MAX = 128
+
+
+def _parse_size(value: str, unit: str, factor: int):
+    # "1024" または "1 vCPU" / "2 GB" の形式（ECSのタスク定義と同じ表記）を受け付ける
+    text = str(value).strip()
+    m = re.fullmatch(rf"(\d+(?:\.\d+)?)\s*{unit}", text, re.IGNORECASE)
+    if m:
+        return int(float(m.group(1)) * factor)
+    if text.isdigit():
+        return int(text)
+    return None
+
+
+def parse_task_size(cpu: str, memory: str):
+    """(CPUユニット, メモリMiB) を返す。Fargateで指定できない組み合わせは400"""
+    cpu_units = _parse_size(cpu, "vcpu", 1024)
+    memory_mib = _parse_size(memory, "gb", 1024)
+    if cpu_units not in FARGATE_TASK_SIZES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported Fargate cpu: {cpu} (available: {', '.join(str(c) for c in FARGATE_TASK_SIZES)})",
+        )
+    allowed = FARGATE_TASK_SIZES[cpu_units]
+    if memory_mib not in allowed:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Unsupported Fargate memory for cpu {cpu_units}: {memory} "
+                f"(allowed: {allowed[0]}-{allowed[-1]} MiB in steps of {allowed[1] - allowed[0]})"
+            ),
+        )
+    return cpu_units, memory_mib
+
+
+def validate_app_name(app_name: str, deploy_strategy: str = "rolling"):
+    if not _APP_NAME_RE.match(app_name or ""):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid app_name: {app_name!r} (lowercase letters, digits and hyphens; must not start or end with a hyphen)",
+        )
+    slots = SLOTS if deploy_strategy == "blue_green" else ("blue",)
+    longest = max((slot_names(app_name, slot)[1] for slot in slots), key=len)
+    if len(longest) > _TARGET_GROUP_NAME_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"app_name is too long: target group name {longest} exceeds {_TARGET_GROUP_NAME_MAX} characters",
+        )
+
+
+def validate_alb_path(alb_path: str):
+    if not alb_path or len(alb_path) > _ALB_PATH_MAX or not _ALB_PATH_RE.match(alb_path):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid alb_path: {alb_path!r} (must start with '/', up to {_ALB_PATH_MAX} characters, ALB path-pattern syntax)",
+        )
+    # ルートにデプロイする"/*"は許可し、"/**"・"//*"のようにパスを含まない誤記だけを拒否する
+    if alb_path != "/*" and not alb_path.rstrip("/*").rstrip("/"):
+        raise HTTPException(status_code=400, detail=f"alb_path must include a path prefix: {alb_path!r}")
+
+
+def validate_dockerfile(dockerfile: str):
+    # 内容キーはビルドコンテキストの中身から決まるため、コンテキスト外のDockerfileは変更を検出できない
+    # （リモートのビルドワーカーにもコンテキストしか送らない）
+    path = (dockerfile or "").replace("\\", "/")
+    normalized = posixpath.normpath(path)
+    if not path or posixpath.isabs(path) or normalized == ".." or normalized.startswith("../"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid dockerfile: {dockerfile!r} (must be a relative path inside docker_context)",
+        )
+
+
+def validate_request(req):
+    """リクエスト単体で判定できる誤り（アプリ名・パス・Dockerfile・タスクサイズ）を400で返す"""
+    validate_app_name(req.app_name, req.deploy_strategy)
+    validate_alb_path(req.alb_path)
+    validate_dockerfile(req.dockerfile)
+    parse_task_size(req.cpu, req.memory)
+
+
+def _sample(pattern: str) -> str:
+    return pattern.replace("*", "").replace("?", "x")
+
+
+def paths_overlap(a: str, b: str) -> bool:
+    """2つのALBパスパターンが同じリクエストに一致しうるか"""
+    if a == b:
+        return True
+    return fnmatch.fnmatchcase(_sample(b), a) or fnmatch.fnmatchcase(_sample(a), b)
+
+
+def target_group_name(tg_arn: str) -> str:
+    # arn:aws:elasticloadbalancing:...:targetgroup/{name}/{id}
+    return tg_arn.split(":targetgroup/", 1)[-1].split("/", 1)[0]
+
+
+def find_path_conflicts(listener_arn: str, app_name: str, alb_path: str) -> list:
+    """他のアプリへ転送しているルールのうち、alb_pathと重なるものを返す"""
+    own = {slot_names(app_name, slot)[1] for slot in SLOTS}
+    conflicts = []
+    for rule in listener_rules.list_rules(listener_arn):
+        owners = {target_group_name(arn) for arn in rule["target_groups"]}
+        if not owners or owners <= own:
+            continue
+        for path in rule["paths"]:
+            if paths_overlap(path, alb_path):
+                conflicts.append({
+                    "path": path,
+                    "priority": rule["priority"],
+                    "rule_arn": rule["rule_arn"],
+                    "target_groups": sorted(owners),
+                })
+    return conflicts
+
+
+def conflict_error(alb_path: str, conflicts: list) -> HTTPException:
+    described = ", ".join(f"{c['path']} -> {'/'.join(c['target_groups'])} (priority {c['priority']})" for c in conflicts)
+    return HTTPException(status_code=409, detail=f"alb_path {alb_path} overlaps rules of other apps: {described}")
+
+
+def check_path_conflicts(listener_arn: str, app_name: str, alb_path: str):
+    """他のアプリとパスが重なっていれば409"""
+    conflicts = find_path_conflicts(listener_arn, app_name, alb_path)
+    if conflicts:
+        raise conflict_error(alb_path, conflicts)
+
+
+def check_batch_paths(reqs):
+    """バッチ内で同じアプリ・重なるパスが複数あれば400"""
+    seen = {}
+    for req in reqs:
+        if req.app_name in seen:
+            raise HTTPException(status_code=400, detail=f"Duplicate app_name in batch: {req.app_name}")
+        for other, path in seen.items():
+            if paths_overlap(path, req.alb_path):
+                raise HTTPException(status_code=400, detail=f"alb_path {req.alb_path} of {req.app_name} overlaps {path} of {other}")
+        seen[req.app_name] = req.alb_path
+
+
+class EnvironmentValidator:
+    """デプロイ先の環境（クラスター・ロール・サブネット・SG）が実在するかを確認する
+
+    設定値の組ごとに結果をキャッシュし、設定が変わったときとTTL切れのときだけAWSへ問い合わせる。
+    IAMの読み取り権限がない場合はロールの確認を省略する。
+    """
+
+    def __init__(self, ttl_seconds: int = DEPLOY_VALIDATION_CACHE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._cache = {}
+        self.checks = 0
+        # クラスター名 -> 関連付けられたキャパシティプロバイダー（checkのたびに更新）
+        self.capacity_providers = {}
+
+    @staticmethod
+    def _key(config):
+        return (
+            config.ecs_cluster_name, config.vpc_id, config.ecs_task_execution_role_arn, config.ecs_task_role_arn,
+            config.subnets, config.security_groups,
+        )
+
+    def check(self, config) -> dict:
+        """確認結果（項目ごとの"ok"/"skipped"）を返す。問題があれば500で全項目をまとめて返す"""
+        key = self._key(config)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and time.time() - cached[0] < self.ttl_seconds:
+                return cached[1]
+
+        problems = []
+        graph = StepGraph("validate")
+        graph.add("cluster", lambda: self._check_cluster(config, problems))
+        graph.add("roles", lambda: self._check_roles(config, problems))
+        graph.add("subnets", lambda: self._check_subnets(config, problems))
+        graph.add("security_groups", lambda: self._check_security_groups(config, problems))
+        results = graph.run()
+        self.checks += 1
+        if problems:
+            raise HTTPException(status_code=500, detail=f"Deploy environment is not ready: {'; '.join(problems)}")
+        with self._lock:
+            self._cache[key] = (time.time(), results)
+        return results
+
+    def _check_cluster(self, config, problems):
+        clusters = get_client("ecs").describe_clusters(clusters=[config.ecs_cluster_name])["clusters"]
+        if not clusters or clusters[0]["status"] != "ACTIVE":
+            problems.append(f"ECS cluster {config.ecs_cluster_name} not found or not active")
+        else:
+            self.capacity_providers[config.ecs_cluster_name] = clusters[0].get("capacityProviders", [])
+        return "ok"
+
+    def check_capacity_providers(self, config, strategy: list):
+        """配分に使うキャパシティプロバイダーがクラスターに関連付けられていなければ400（check()の後に呼ぶ）"""
+        available = set(self.capacity_providers.get(config.ecs_cluster_name, []))
+        missing = sorted({s["capacityProvider"] for s in strategy} - available)
+        if missing:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Capacity providers not associated with cluster {config.ecs_cluster_name}: {', '.join(missing)}",
+            )
+
+    def _check_roles(self, config, problems):
+        iam = get_client("iam")
+        for field in ("ecs_task_execution_role_arn", "ecs_task_role_arn"):
+            arn = getattr(config, field)
+            if not arn:
+                problems.append(f"{field} is not configured")
+                continue
+            try:
+                iam.get_role(RoleName=arn.rsplit("/", 1)[-1])
+            except iam.exceptions.NoSuchEntityException:
+                problems.append(f"IAM role not found: {arn}")
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in ("AccessDenied", "AccessDeniedException"):
+                    raise
+                logger.warning(f"Skipping IAM role validation (no permission): {e}")
+                return "skipped"
+        return "ok"
+
+    def _check_subnets(self, config, problems):
+        if not config.subnets:
+            problems.append("No subnets configured (SUBNETS or private_subnet_ids)")
+            return "ok"
+        ec2 = get_client("ec2")
+        try:
+            subnets = ec2.describe_subnets(SubnetIds=list(config.subnets))["Subnets"]
+        except ClientError as e:
+            problems.append(f"Subnets not found: {e.response.get('Error', {}).get('Message', e)}")
+            return "ok"
+        wrong_vpc = [s["SubnetId"] for s in subnets if config.vpc_id and s["VpcId"] != config.vpc_id]
+        if wrong_vpc:
+            problems.append(f"Subnets outside VPC {config.vpc_id}: {', '.join(wrong_vpc)}")
+        return "ok"
+
+    def _check_security_groups(self, config, problems):
+        if not config.security_groups:
+            problems.append("No security groups configured (SECURITY_GROUPS or ecs_security_group_id)")
+            return "ok"
+        ec2 = get_client("ec2")
+        try:
+            groups = ec2.describe_security_groups(GroupIds=list(config.security_groups))["SecurityGroups"]
+        except ClientError as e:
+            problems.append(f"Security groups not found: {e.response.get('Error', {}).get('Message', e)}")
+            return "ok"
+        wrong_vpc = [g["GroupId"] for g in groups if config.vpc_id and g["VpcId"] != config.vpc_id]
+        if wrong_vpc:
+            problems.append(f"Security groups outside VPC {config.vpc_id}: {', '.join(wrong_vpc)}")
+        return "ok"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"cached": len(self._cache), "checks": self.checks, "ttl_seconds": self.ttl_seconds}
+
+
+environment_validator = EnvironmentValidator()
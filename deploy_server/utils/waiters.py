@@ -0,0 +1,227 @@
+import os
+import random
+import threading
+import time
+
+from loguru import logger
+
+from utils.clients import get_client
+from utils.common import CLUSTER_NAME
+
+# ポーリング間隔の初期値と上限（秒）。間隔は指数的に伸ばし、ジッターを加える
+WAITER_MIN_DELAY_SECONDS = float(os.getenv("WAITER_MIN_DELAY_SECONDS", "2"))
+WAITER_MAX_DELAY_SECONDS = float(os.getenv("WAITER_MAX_DELAY_SECONDS", "30"))
+# サービスが正常になるまで・削除が完了するまでの待機上限（秒）
+WAITER_HEALTHY_TIMEOUT_SECONDS = int(os.getenv("WAITER_HEALTHY_TIMEOUT_SECONDS", "900"))
+WAITER_DELETE_TIMEOUT_SECONDS = int(os.getenv("WAITER_DELETE_TIMEOUT_SECONDS", "300"))
+# この秒数以内に予定されている監視は同じ問い合わせにまとめる
+WAITER_COALESCE_SECONDS = 1.0
+# describe_servicesで1回に指定できるサービス数
+DESCRIBE_SERVICES_BATCH = 10
+
+
+class ServiceWatch:
+    """1つのECSサービスの待機状態。完了するとoutcomeが設定される"""
+
+    def __init__(self, kind: str, service: str, cluster: str, tg_arn: str = None, timeout: float = None):
+        self.kind = kind  # "healthy" | "deleted"
+        self.service = service
+        self.cluster = cluster
+        self.tg_arn = tg_arn
+        self.started_at = time.time()
+        self.deadline = self.started_at + timeout
+        self.delay = WAITER_MIN_DELAY_SECONDS
+        self.next_poll = self.started_at + self.delay
+        self.outcome = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> dict:
+        """完了まで待ってoutcomeを返す（timeout経過時はNone）"""
+        self._done.wait(timeout)
+        return self.outcome
+
+    def add_done_callback(self, fn):
+        """完了時にfn(outcome)を呼ぶ。既に完了していれば即座に呼ぶ"""
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self.outcome)
+
+    def backoff(self):
+        self.delay = min(self.delay * 2, WAITER_MAX_DELAY_SECONDS)
+        # 多数の監視が同じタイミングで問い合わせないようジッターを加える
+        self.next_poll = time.time() + random.uniform(self.delay / 2, self.delay)
+
+    def finish(self, status: str, message: str = None, **extra):
+        with self._lock:
+            if self.done:
+                return
+            self.outcome = {
+                "status": status,
+                "elapsed_seconds": round(time.time() - self.started_at, 1),
+                "message": message,
+                **extra,
+            }
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self.outcome)
+            except Exception as e:
+                logger.warning(f"Waiter callback failed for {self.service}: {e}")
+
+
+class ServiceWaiter:
+    """ECSサービスの安定化・削除完了をバックグラウンドの1スレッドでまとめて監視する
+
+    待機中のサービスはクラスターごとに最大10件ずつdescribe_servicesで問い合わせ、
+    ターゲットヘルスもターゲットグループごとに1回だけ取得する。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._watches = []
+        self._thread = None
+        self.counters = {"polls": 0, "describe_services_calls": 0, "describe_target_health_calls": 0}
+
+    def watch_healthy(self, service: str, tg_arn: str = None, timeout: float = WAITER_HEALTHY_TIMEOUT_SECONDS,
+                      cluster: str = CLUSTER_NAME) -> ServiceWatch:
+        """ロールアウト完了とターゲットのヘルスチェック成功を待つ"""
+        return self._add(ServiceWatch("healthy", service, cluster, tg_arn, timeout))
+
+    def watch_deleted(self, service: str, timeout: float = WAITER_DELETE_TIMEOUT_SECONDS,
+                      cluster: str = CLUSTER_NAME) -> ServiceWatch:
+        """サービスの削除（INACTIVE化）完了を待つ"""
+        watch = ServiceWatch("deleted", service, cluster, timeout=timeout)
+        # 削除は数秒で終わることも多いので初回はすぐに確認する
+        watch.next_poll = watch.started_at
+        return self._add(watch)
+
+    def _add(self, watch: ServiceWatch) -> ServiceWatch:
+        with self._cond:
+            self._watches.append(watch)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="service-waiter", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return watch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    self._watches = [w for w in self._watches if not w.done]
+                    now = time.time()
+                    if self._watches:
+                        next_poll = min(w.next_poll for w in self._watches)
+                        if next_poll <= now:
+                            break
+                        self._cond.wait(next_poll - now)
+                    else:
+                        self._cond.wait()
+                due = [w for w in self._watches if w.next_poll <= now + WAITER_COALESCE_SECONDS]
+            try:
+                self._poll(due)
+            except Exception as e:
+                logger.warning(f"Service waiter poll failed: {e}")
+                for watch in due:
+                    watch.backoff()
+
+    def _poll(self, due):
+        self.counters["polls"] += 1
+        ecs = get_client("ecs")
+        elbv2 = get_client("elbv2")
+
+        # クラスターごとに最大10件ずつまとめて問い合わせる
+        services = {}
+        by_cluster = {}
+        for watch in due:
+            by_cluster.setdefault(watch.cluster, set()).add(watch.service)
+        for cluster, names in by_cluster.items():
+            names = sorted(names)
+            for i in range(0, len(names), DESCRIBE_SERVICES_BATCH):
+                response = ecs.describe_services(cluster=cluster, services=names[i:i + DESCRIBE_SERVICES_BATCH])
+                self.counters["describe_services_calls"] += 1
+                for service in response["services"]:
+                    services[(cluster, service["serviceName"])] = service
+
+        # ロールアウトが終わったサービスのターゲットグループだけヘルスを確認
+        target_health = {}
+        for watch in due:
+            service = services.get((watch.cluster, watch.service))
+            if watch.kind != "healthy" or not watch.tg_arn or watch.tg_arn in target_health:
+                continue
+            if service and _rollout_state(service)[0] == "completed":
+                descriptions = elbv2.describe_target_health(TargetGroupArn=watch.tg_arn)["TargetHealthDescriptions"]
+                self.counters["describe_target_health_calls"] += 1
+                target_health[watch.tg_arn] = descriptions
+
+        for watch in due:
+            self._evaluate(watch, services.get((watch.cluster, watch.service)), target_health)
+
+    def _evaluate(self, watch: ServiceWatch, service, target_health):
+        if watch.kind == "deleted":
+            if not service or service["status"] == "INACTIVE":
+                watch.finish("deleted")
+                return
+        else:
+            if not service or service["status"] != "ACTIVE":
+                watch.finish("failed", f"Service {watch.service} is not active")
+                return
+            state, reason = _rollout_state(service)
+            if state == "failed":
+                watch.finish("failed", reason, running_count=service["runningCount"], desired_count=service["desiredCount"])
+                return
+            if state == "completed" and service["desiredCount"] == 0:
+                # スケール・トゥ・ゼロ中のサービスは正常になるのを待たない
+                watch.finish("scaled_to_zero", running_count=0, desired_count=0, healthy_targets=0)
+                return
+            if state == "completed":
+                healthy = None
+                if watch.tg_arn:
+                    states = [t["TargetHealth"]["State"] for t in target_health.get(watch.tg_arn, [])]
+                    healthy = states.count("healthy")
+                if healthy is None or healthy >= service["desiredCount"]:
+                    watch.finish(
+                        "healthy",
+                        running_count=service["runningCount"],
+                        desired_count=service["desiredCount"],
+                        healthy_targets=healthy,
+                    )
+                    return
+
+        if time.time() >= watch.deadline:
+            watch.finish("timeout", f"Timed out waiting for {watch.service} to become {watch.kind}")
+            return
+        watch.backoff()
+
+    def stats(self) -> dict:
+        with self._cond:
+            watching = sum(1 for w in self._watches if not w.done)
+        return {"watching": watching, **self.counters}
+
+
+def _rollout_state(service):
+    """("completed" | "failed" | "in_progress", 理由) を返す"""
+    deployments = service.get("deployments", [])
+    primary = next((d for d in deployments if d["status"] == "PRIMARY"), None)
+    if primary is None:
+        return "in_progress", None
+    if primary.get("rolloutState") == "FAILED":
+        return "failed", primary.get("rolloutStateReason")
+    if primary.get("rolloutState") == "COMPLETED":
+        return "completed", None
+    # rolloutStateが無い場合は旧デプロイが消えて必要数が起動したら完了とみなす
+    if len(deployments) == 1 and primary["runningCount"] >= primary["desiredCount"]:
+        return "completed", None
+    return "in_progress", None
+
+
+service_waiter = ServiceWaiter()
@@ -10,4 +10,15 @@ resource "aws_ecs_cluster" "main" {
   tags = {
     Name = "${var.project_name}-cluster"
   }
-}
\ No newline at end of file
+}
+
+# Fargate / Fargate Spotのキャパシティプロバイダー（デプロイ時のcapacity指定で使用）
+resource "aws_ecs_cluster_capacity_providers" "main" {
+  cluster_name       = aws_ecs_cluster.main.name
+  capacity_providers = ["FARGATE", "FARGATE_SPOT"]
+
+  default_capacity_provider_strategy {
+    capacity_provider = "FARGATE"
+    weight            = 1
+  }
+}